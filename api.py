@@ -1,34 +1,160 @@
-from flask import Flask,request,make_response,Response
-from dict2xml import dict2xml
+from flask import Flask,request,make_response,Response,current_app,g
 from flask_restful import Resource, Api
 from flask_paginate import get_page_args
-import pandas as pd
-import os
+import base64
 import collections
+import hashlib
+import json
+import time
+from metrics import Profiler, metrics, process_memory, span
+from store import DATASET_PATH, get_store, registry
+from cache import cache_for
+from filters import parse_filter
+from validation import validate_records, validate_value
+from vcf import to_records
+from xmlwriter import frame_xml, to_xml
 
 
-def read_vcf(path):
+ACCEPTED_HEADERS=['application/json','application/xml','*/*'] #list of the supported Accept header values
+STREAMING_HEADERS=['application/x-ndjson'] #Accept header values only supported by the GET requests, whose results can be streamed
+GET_PARAMETERS=['id','chrom','pos','region','page','per_page','cursor','stream','dataset','sample','filter'] #query arguments of the GET requests of /result
+STREAM_CHUNKSIZE=10000 #number of entries taken from the dataset at once when streaming a response
+
+
+def dataset():
     '''
-            Auxiliary function used to read the "database".
-            For better handling of the data the dataset is read in its vcf format but is then wrote back in csv format.
-            If a csv version of the dataset alreasy exists in the current folder then the fucntion will read in that file.
+        Return:
+        VariantStore: the store of the dataset of the request, the one named by its dataset parameter (see select_datasets),
+                      by default the DATASET_PATH one of the app config
+    '''
+    names = g.get('datasets')
+    if names:
+        return registry.get(names[0])
+    return get_store(current_app.config['DATASET_PATH'])
 
-            Parameters:
-            path,str: The path to the dataset file
 
-            Return:
-            df,DataFrame: A pandas DataFrame containing the dataset's data
-        '''
-    is_csv = True if len([x for x in os.listdir() if x.endswith('.csv')]) >0 else False
-    if is_csv:
-        df = pd.read_csv('./NA12877_API_10.csv')
-    else:
-        with open(path, 'r') as f:
-            lines = [l.rstrip('\n').split('\t') for l in f if not l.startswith('##')]
-        df=pd.DataFrame(lines[1:],columns=[x if '#' not in x else 'CHROM' for x in lines[0]])
-        if path.endswith('.vcf'):
-            df.to_csv('./NA12877_API_10.csv',index=False)
-    return df
+def response_cache():
+    '''
+        Return:
+        ResponseCache: the cache of the GET responses of the dataset served by the app (CACHE_* settings of the app config)
+    '''
+    config = current_app.config
+    return cache_for(dataset(),config['CACHE_MAX_ENTRIES'],config['CACHE_MAX_BYTES'],config['CACHE_TTL'])
+
+
+def negotiate_representation(streaming=False):
+    '''
+        Reads the Accept header of the request.
+
+        Parameters:
+        streaming,bool: True if the endpoint can stream its response as newline delimited json
+
+        Return:
+        str: 'application/json', 'application/xml' or 'application/x-ndjson' (streaming endpoints only),
+             None if the header is missing, has several values or is not supported
+    '''
+    accept_headers=[] if 'Accept' not in request.headers else request.headers['Accept'].split(',') #read accept headers
+    if len(accept_headers) != 1 or accept_headers[0] not in ACCEPTED_HEADERS+(STREAMING_HEADERS if streaming else []):
+        return None
+    if accept_headers[0] in STREAMING_HEADERS+['application/xml']:
+        return accept_headers[0]
+    return 'application/json'
+
+
+def not_acceptable():
+    '''
+        Return:
+        dict,int: the error returned when the Accept header is not acceptable
+    '''
+    return {'error': 'Accept header not acceptable','meassage':'One header has to be passed and it has to be one of the following: "application/json","application/xml" and "*/*"'},406
+
+
+def make_representation(data,representation,etag=None):
+    '''
+        Builds a successful response in the negotiated representation.
+
+        Parameters:
+        data,dict: the response body, for xml its DataFrame values are rendered like their to_records dictionary (see xmlwriter.to_xml)
+        representation,str: 'application/json' or 'application/xml', see negotiate_representation
+        etag,str: optional, the etag of the response
+
+        Return:
+        Response: the response
+    '''
+    with span('serialize'):
+        if representation=='application/xml': #handle xml response type
+            my_resp = make_response(to_xml(data))
+            my_resp.mimetype = 'application/xml'
+            my_resp.etag=etag
+        else: #handle json response type and default fallback
+            my_resp = make_response(data)
+            my_resp.mimetype = 'application/json'
+    my_resp.status_code=200
+    if etag is not None:
+        my_resp.headers['etag']=etag
+    return my_resp
+
+
+def cached_representation(entry,status):
+    '''
+        Builds a response from a cached rendered body.
+
+        Parameters:
+        entry,CacheEntry: the cached response
+        status,str: 'HIT' or 'MISS', returned in the X-Cache header
+
+        Return:
+        Response: the response, whose etag is the content hash of the body
+    '''
+    my_resp = Response(entry.body,status=200,mimetype=entry.mimetype)
+    my_resp.headers['etag']=entry.etag
+    my_resp.headers['X-Cache']=status
+    return my_resp
+
+
+def stream_representation(store,labels,representation,columns=None):
+    '''
+        Streams entries one chunk at a time, so that memory use does not grow with the number of entries
+        and the first entries are sent before the last ones are read.
+
+        Parameters:
+        store,VariantStore: the store the entries are taken from
+        labels,ndarray: the labels of the entries, see VariantStore.lookup_labels
+        representation,str: 'application/x-ndjson' for one json object per line and per entry,
+                            'application/xml' for the same document as the "data" element of a non streamed response
+        columns,list: optional, the columns of the entries, see Result.sample_columns
+
+        Return:
+        Response: the streamed response, whose X-Total-Count header is the number of entries
+    '''
+    def generate():
+        if representation=='application/xml':
+            yield '<data>\n'
+        for start in range(0,len(labels),STREAM_CHUNKSIZE):
+            with span('serialize'):
+                rows = store.rows(labels[start:start+STREAM_CHUNKSIZE])
+                if columns is not None:
+                    rows = rows[columns]
+                if representation=='application/xml':
+                    chunk = frame_xml(rows,depth=1)+'\n' if rows.shape[0] else ''
+                else:
+                    chunk = ''.join(json.dumps(row)+'\n' for row in to_records(rows).values())
+            yield chunk
+        if representation=='application/xml':
+            yield '</data>\n'
+    my_resp = Response(generate(),status=200,mimetype=representation)
+    my_resp.headers['X-Total-Count']=str(len(labels))
+    return my_resp
+
+
+def not_modified():
+    '''
+        Return:
+        Response: the response returned when the If-None-Match header of the request matches the etag of the response
+    '''
+    my_resp=make_response({'message':'etag_recognized, computation skipped'})
+    my_resp.status_code=304
+    return my_resp
 
 
 # Instantiate Result class
@@ -41,7 +167,8 @@ class Result(Resource):
     def validate_json(self,body):
         '''
             An auxiliary function to validate the json payload of the post and put requests.
-            The funciton checks whether all expected fields are present in the payload and that they have the correct format
+            The funciton checks whether all expected fields are present in the payload and that they have the correct format,
+            see validation.validate_records
 
             Parameters:
             body,dict: the json dictionary containing the payload data
@@ -50,53 +177,125 @@ class Result(Resource):
             errors,dict: the dictionary containing all the errors encountered while validating the payload
         '''
         errors=collections.defaultdict(list)
-        expected_fields=['CHROM','ID','POS','ALT','REF'] #List of the field we want to see in the payload
-        all_fields=['CHROM','POS','ID','REF','ALT','QUAL','FILTER','INFO','FORMAT','NA12877 single 20180302'] #List of all the fields in the database
-        missing_fields=set(expected_fields)-set(list(body.keys()))
-        #If there is any missing field return an error
-        if len(missing_fields)>0:
-            errors['message'].append('Request body is missing this requiered field(s):'+str(list(missing_fields)))
-            return errors
-        
-        #If there are more fields that are not in the database throw an error
-        extra_fields=set(list(body.keys()))-set(all_fields)
-        if len(extra_fields)>0:
-            errors['message'].append('Request body has some extra unsupported field(s):'+str(list(extra_fields)))
-            return errors
-        
-        #Check that CHROM field is correctly formed (must start with 'chr' and end with either 'X,Y or M' or with a number between 1 and 22)
-        if body['CHROM'].startswith('chr'):
-            chrom = body['CHROM'].lstrip('chr')
-            if chrom.isnumeric():
-                if (int(chrom) > 22 or int(chrom) < 1):
-                    errors['message'].append('CHROM field must end with a number between 1 and 22')
+        for error in validate_records([body],dataset().fields)[0]:
+            errors['message'].append(error)
+        return errors
+
+    def validate_chrom(self,chrom):
+        '''
+            An auxiliary function to validate a chromosome name, used for region queries.
+
+            Parameters:
+            chrom,str: the chromosome name
+
+            Return:
+            errors,list: the error messages, empty if the chromosome name is valid
+        '''
+        return validate_value('CHROM',chrom)
+
+    def parse_region(self,region):
+        '''
+            An auxiliary function to parse a region parameter.
+            Regions look like chr7:117,400,000-117,700,000, a single position (chr7:117400000) or a whole chromosome (chr7).
+
+            Parameters:
+            region,str: the region as written in the URL
+
+            Return:
+            tuple: (chrom,start,end), start and end are None for a whole chromosome
+            errors,list: the error messages, empty if the region is valid
+        '''
+        chrom,_,span = region.partition(':')
+        errors=self.validate_chrom(chrom)
+        start,end = None,None
+        if span:
+            first,_,last = span.replace(',','').partition('-')
+            if not first.isnumeric() or (last and not last.isnumeric()):
+                errors.append('Region %s must look like chrN:start-end with integer start and end'%region)
             else:
-                if not chrom in ['X','Y','M']:
-                    errors['message'].append('CHROM field must end with one character among X,Y and M')
-        else:
-            errors['message'].append('CHROM field must start with chr')
-        
-        #Check POS field (must be an integer)
-        if not type(body['POS']) is int:
-            errors['message'].append('POS field must be an integer')
-        
-        #Check ID field (must start with rs and end with an integer)
-        if not body['ID'].startswith('rs'):
-            errors['message'].append('ID field must start with rs')
-        else:
-            id = body['ID']
-            if not id.lstrip('rs').isnumeric():
-                errors['message'].append('ID field must only have integers after the rs string')
-        
+                start = int(first)
+                end = int(last) if last else start
+                if start > end:
+                    errors.append('Region %s must have a start lower than its end'%region)
+        return (chrom,start,end),errors
 
-        accepted_alt_ref=['A','C','G','T','.'] #list of accepted ALT and REF fields values
-        #Check ALT and REF fields (their value must be 'A','C','G','T' or '.')
-        if not body['ALT'] in accepted_alt_ref:
-            errors['message'].append('ALT field must have onw of this values: [A,C,G,T,.]')
-        if not body['REF'] in accepted_alt_ref:
-            errors['message'].append('REF field must have onw of this values: [A,C,G,T,.]')
-        
-        return errors
+    def query_fingerprint(self,id,chrom,pos,regions,dataset=None,filters=None):
+        '''
+            An auxiliary function computing a short hash of the selection of a GET request, kept in its cursors.
+
+            Return:
+            str: the hash of the id, chromosome position, regions, dataset and filters of the request
+        '''
+        return hashlib.sha1(json.dumps([id,chrom,pos,regions]+([dataset] if dataset else [])+([filters] if filters else [])).encode()).hexdigest()[:12]
+
+    def filter_conditions(self,store,filters,samples):
+        '''
+            An auxiliary function parsing the filter parameters of a request for a dataset.
+
+            Parameters:
+            store,VariantStore: the store of the dataset
+            filters,list: the filter expressions, see filters.parse_filter
+            samples,list: the requested samples, whose FORMAT keys are compared; None for all the samples
+
+            Return:
+            conditions,list: the conditions, None if there is no filter
+            errors,list: the error messages, empty if the filters are valid
+        '''
+        if not filters:
+            return None,[]
+        store_samples = store.samples
+        if samples is not None:
+            store_samples = [sample for sample in store_samples if sample in samples]
+        return parse_filter(filters,store.columns,store.definitions,store_samples)
+
+    def sample_columns(self,store,samples):
+        '''
+            An auxiliary function selecting the columns returned for the requested samples.
+
+            Parameters:
+            store,VariantStore: the store of the dataset
+            samples,list: the requested samples
+
+            Return:
+            list: the columns of the dataset without the sample columns that were not requested, None if the dataset has none of the samples
+        '''
+        store_samples = store.samples
+        if not any(sample in store_samples for sample in samples):
+            return None
+        return [col for col in store.columns if col not in store_samples or col in samples]
+
+    def encode_cursor(self,fingerprint,key):
+        '''
+            An auxiliary function building the opaque cursor of the next page.
+
+            Parameters:
+            fingerprint,str: the hash of the selection of the request, see query_fingerprint
+            key,tuple: the (CHROM,POS,label) key of the last entry of the page
+
+            Return:
+            str: the url safe cursor
+        '''
+        chrom,pos,label = key
+        return base64.urlsafe_b64encode(json.dumps([fingerprint,str(chrom),int(pos),int(label)]).encode()).decode().rstrip('=')
+
+    def decode_cursor(self,cursor,fingerprint):
+        '''
+            An auxiliary function reading a cursor built by encode_cursor.
+
+            Parameters:
+            cursor,str: the cursor
+            fingerprint,str: the hash of the selection of the request, which must be the one the cursor was built for
+
+            Return:
+            tuple: the (CHROM,POS,label) key of the last entry of the previous page, None if the cursor is not valid
+        '''
+        try:
+            cursor_fingerprint,chrom,pos,label = json.loads(base64.urlsafe_b64decode(cursor+'='*(-len(cursor)%4)))
+        except (ValueError,TypeError):
+            return None
+        if cursor_fingerprint != fingerprint or not isinstance(chrom,str) or not isinstance(pos,int) or not isinstance(label,int):
+            return None
+        return chrom,pos,label
 
     # implement get request
     def get(self):
@@ -118,58 +317,217 @@ class Result(Resource):
             return {'error':'per_page parameter, if specified, cannot be lower than 0'},400
 
         id = request.args.get('id')
+        chrom = request.args.get('chrom')
+        pos = request.args.get('pos',type=int)
+        regions = request.args.getlist('region')
 
-        if not id:
+        if not id and not (chrom and pos is not None) and not regions:
             return {'error':'No ID was provided in the URL'},400
 
-        #generate a unique etag for the request
-        etag='%s_%s_%s'%(id,str(page),str(per_page))
-        #check if request has If None Match header and if its value is equal to the etag
-        if request.if_none_match and etag in request.if_none_match:
-            my_resp=make_response({'message':'etag_recognized, computation skipped'})
-            my_resp.status_code=304
-            return my_resp
-
-        #read data
-        data = read_vcf('./NA12877_API_10.vcf')
-
-        #instantiate repsonse 
-        response = data[data['ID']==id] #select rows with the specificed id
-        pagination_data = response.iloc[(page-1)*per_page:page*per_page] #limit results to one "page"
-        total = response.shape[0]
-        pages_overall = int(total/per_page)+1
-
-        accept_headers=[] if 'Accept' not in request.headers else request.headers['Accept'].split(',') #read accept headers
-        accepted_headers=['application/json','application/xml','*/*']
-        #define response body
+        #parse and validate the requested regions
+        parsed_regions=[]
+        for region in regions:
+            parsed,errors = self.parse_region(region)
+            if errors:
+                return {'error':'Bad request','message':errors},400
+            parsed_regions.append(parsed)
+
+        #an & left unencoded in a filter splits it into query arguments of their own, which must not be silently ignored
+        filters = request.args.getlist('filter')
+        unknown = [arg for arg in request.args if arg not in GET_PARAMETERS]
+        if filters and unknown:
+            return {'error':'Bad request','message':['unknown parameters %s, the & joining filter conditions must be sent as %%26'%','.join(unknown)]},400
+
+        #read the cursor of the previous page, which must have been returned for the same selection
+        fingerprint = self.query_fingerprint(id,chrom,pos,regions,request.args.get('dataset'),filters)
+        cursor = request.args.get('cursor')
+        after = None
+        if cursor is not None:
+            if 'page' in request.args:
+                return {'error':'Bad request','message':['page and cursor parameters cannot be used together']},400
+            after = self.decode_cursor(cursor,fingerprint)
+            if after is None:
+                return {'error':'Bad request','message':['cursor parameter is not valid for this request']},400
+
+        #stream the entries as newline delimited json, or as xml when asked to, instead of building the whole response
+        representation = negotiate_representation(streaming=True)
+        stream = representation=='application/x-ndjson' or (representation=='application/xml' and request.args.get('stream')=='true')
+
+        #fan out the requests targeting several datasets, see get_many
+        samples = request.args.get('sample')
+        samples = [sample for sample in samples.split(',') if sample] if samples else None
+        names = g.get('datasets')
+        if names is not None and len(names)>1:
+            if cursor is not None or stream:
+                return {'error':'Bad request','message':['cursor and stream parameters can only be used with a single dataset']},400
+            return self.get_many(names,id,chrom,pos,parsed_regions,page,per_page,samples,filters,representation)
+        if cursor is not None and stream:
+            #streamed responses have no meta section, hence no cursor of the next page to follow
+            return {'error':'Bad request','message':['cursor and stream parameters cannot be used together']},400
+
+        #only return the sample columns that were asked for
+        columns = None
+        if samples is not None:
+            columns = self.sample_columns(dataset(),samples)
+            if columns is None:
+                return {'error':'Sample not found','message':'The dataset has none of the samples '+str(samples)},404
+
+        #filters are evaluated on the matching entries before they are paginated
+        where,errors = self.filter_conditions(dataset(),filters,samples)
+        if errors:
+            return {'error':'Bad request','message':errors},400
+
+        if stream:
+            store = dataset()
+            labels = store.lookup_labels(id=id,chrom=chrom,pos=pos,regions=parsed_regions,where=where)
+            if 'page' in request.args or 'per_page' in request.args:
+                labels = labels[(page-1)*per_page:page*per_page] #limit results to one "page" if asked to
+            if len(labels)==0:
+                return {'error':'data entry not found'},404
+            return stream_representation(store,labels,representation,columns)
+
+        #look for the rendered response in the cache, its etag being the hash of its content
+        dataset().refresh() #catch up with the writes of other processes, which invalidates the affected responses
+        cache = response_cache()
+        key = (representation,tuple(request.args.items(multi=True)))
+        entry = cache.get(key) if representation is not None else None
+        if entry is not None:
+            #check if request has If None Match header and if its value is equal to the etag
+            if request.if_none_match and entry.etag in request.if_none_match:
+                return not_modified()
+            return cached_representation(entry,'HIT')
+        version = cache.version
+
+        if id:
+            scope = {'ids':[id]}
+        elif chrom and pos is not None:
+            scope = {'positions':[(chrom,pos)]}
+        else:
+            scope = {'regions':parsed_regions}
+        if after is not None:
+            #keyset pagination: the page starts right after the last entry of the previous page
+            labels,total,next = dataset().lookup_page(id=id,chrom=chrom,pos=pos,regions=parsed_regions,after=after,limit=per_page,where=where)
+            with span('paginate'):
+                pagination_data = dataset().rows(labels)
+                if columns is not None:
+                    pagination_data = pagination_data[columns]
+            with span('serialize'):
+                #the xml writer renders the rows straight from the columns of the page
+                records = pagination_data if representation=='application/xml' else to_records(pagination_data)
+            data = {'meta':{
+                        'entries_per_page':per_page,
+                        'has_next_page':next is not None,
+                        'next':None if next is None else self.encode_cursor(fingerprint,next),
+                        'entries':total},'data':records}
+        else:
+            #select the labels of the rows with the specificed id (or chromosome position or regions) through the store index
+            labels = dataset().lookup_labels(id=id,chrom=chrom,pos=pos,regions=parsed_regions,where=where)
+            #instantiate repsonse, only the rows of the requested page are taken from the dataset
+            with span('paginate'):
+                pagination_data = dataset().rows(labels[(page-1)*per_page:page*per_page]) #limit results to one "page"
+                if columns is not None:
+                    pagination_data = pagination_data[columns]
+                total = len(labels)
+                pages_overall = -(-total//per_page) if per_page>0 else 0
+                next = None
+                if page < pages_overall and pagination_data.shape[0]>0:
+                    last = pagination_data.iloc[-1]
+                    next = self.encode_cursor(fingerprint,(last['CHROM'],last['POS'],pagination_data.index[-1]))
+            with span('serialize'):
+                #the xml writer renders the rows straight from the columns of the page
+                records = pagination_data if representation=='application/xml' else to_records(pagination_data)
+
+            #define response body
+            data = {'meta':{
+                        'entries_per_page':per_page,
+                        'displayed_page':page,
+                        'has_prev_page':True if page != 1 else False,
+                        'has_next_page':True if page < pages_overall else False,
+                        'pages':pages_overall,
+                        'next':next,
+                        'entries':total},'data':records}
+
+        #if no accept header is specified or if the specified one is not among the allowed ones return error 
+        if representation is None:
+            return not_acceptable()
+        if total>0:
+            rendered = make_representation(data,representation)
+            entry = cache.put(key,rendered.get_data(),rendered.mimetype,scope,version)
+            if request.if_none_match and entry.etag in request.if_none_match:
+                return not_modified()
+            return cached_representation(entry,'MISS')
+        return {'error':'data entry not found'},404 #if no entry is found return error
+
+    def get_many(self,names,id,chrom,pos,regions,page,per_page,samples,filters,representation):
+        '''
+            Implements the GET functionality over several datasets: the lookups run in parallel, one per dataset,
+            and the entries are listed dataset by dataset (in the order of the dataset parameter) before being paginated.
+            Only the rows of the page are taken from the datasets it overlaps. Entries are keyed by dataset:label.
+
+            Parameters:
+            names,list: the names of the datasets
+            id,str: the id to look for
+            chrom,str: the chromosome, used with pos when no id is given
+            pos,int: the position on the chromosome
+            regions,list: the parsed regions used when no id nor position is given
+            page,int: the page to return
+            per_page,int: the number of entries per page
+            samples,list: the requested samples, only the datasets having one of them are queried; None for all the samples
+            filters,list: the filter expressions, parsed for every dataset with its own INFO and FORMAT keys
+            representation,str: see negotiate_representation
+
+            Return:
+            Response: the page of entries, or the error message and its status code
+        '''
+        if representation is None:
+            return not_acceptable()
+        if samples is not None:
+            names = [name for name in names if any(sample in registry.samples(name) for sample in samples)]
+            if not names:
+                return {'error':'Sample not found','message':'No dataset has any of the samples '+str(samples)},404
+        conditions={}
+        for name in names:
+            conditions[name],errors = self.filter_conditions(registry.get(name),filters,samples)
+            if errors:
+                return {'error':'Bad request','message':['%s: %s'%(name,error) for error in errors]},400
+
+        def lookup(name):
+            store = registry.get(name)
+            return name,store,store.lookup_labels(id=id,chrom=chrom,pos=pos,regions=regions,where=conditions[name])
+        shards = registry.map(lookup,names)
+        total = sum(len(labels) for _,_,labels in shards)
+        if total==0:
+            return {'error':'data entry not found'},404
+
+        #take the labels of the page from the datasets it overlaps
+        start,end = (page-1)*per_page,page*per_page
+        slices,offset = [],0
+        for name,store,labels in shards:
+            first,last = max(start-offset,0),min(end-offset,len(labels))
+            if first < last:
+                slices.append((name,store,labels[first:last]))
+            offset += len(labels)
+
+        def fetch(shard):
+            name,store,labels = shard
+            rows = store.rows(labels)
+            if samples is not None:
+                rows = rows[self.sample_columns(store,samples)]
+            return {'%s:%d'%(name,label):row for label,row in to_records(rows).items()}
+        records={}
+        for part in registry.map(fetch,slices):
+            records.update(part)
+        pages_overall = -(-total//per_page) if per_page>0 else 0
         data = {'meta':{
                     'entries_per_page':per_page,
                     'displayed_page':page,
                     'has_prev_page':True if page != 1 else False,
                     'has_next_page':True if page < pages_overall else False,
                     'pages':pages_overall,
-                    'entries':total},'data':pagination_data.to_dict(orient='index')}
-        
-        #if no accept header is specified or if the specified one is not among the allowed ones return error 
-        if len(accept_headers) > 1 or len(accept_headers)==0 or accept_headers[0] not in accepted_headers:
-            return {'error': 'Accept header not acceptable','meassage':'One header has to be passed and it has to be one of the following: "application/json","application/xml" and "*/*"'},406
-        elif accept_headers[0]=='application/json' or  accept_headers[0]=='*/*': #handle json response type and default fallback
-            if response.shape[0]>0:
-                my_resp = make_response(data)
-                my_resp.mimetype = 'application/json' 
-                my_resp.status_code=200
-                my_resp.headers['etag']=etag
-                return my_resp
-        elif accept_headers[0]=='application/xml': #handle xml response type
-            if response.shape[0]>0:
-                my_resp = make_response(dict2xml(data))
-                my_resp.mimetype = 'application/xml' 
-                my_resp.status_code=200
-                my_resp.etag=etag
-                my_resp.headers['etag']=etag
-                return my_resp
-        return {'error':'data entry not found'},404 #if no entry is found return error
-    
+                    'entries':total,
+                    'datasets':{name:len(labels) for name,_,labels in shards}},'data':records}
+        return make_representation(data,representation)
+
     # Implement POST function
     def post(self):
         '''
@@ -197,26 +555,8 @@ class Result(Resource):
                 errors['error']='Bad request'
                 return errors,400
             #add post data to "database"
-            new_data = pd.DataFrame({
-                'CHROM':json['CHROM'],
-                'POS':json['POS'],
-                'ALT':json['ALT'],
-                'REF':json['REF'],
-                'ID':json['ID']
-            },index=[0])
-            # read our CSV
-            data = read_vcf('./NA12877_API_10.vcf')
-            #add missing columns to new data and reorder them
-            for col in list(data.columns):
-                if 'Unnamed' in col:
-                    new_data[col]=data[col].max()+1
-                elif col not in json:
-                    new_data[col]='-'
-            new_data=new_data[list(data.columns)]
-            # add the newly provided values
-            data = data.append(new_data,ignore_index=True)
-            data.to_csv('./NA12877_API_10.csv',index=False)
-            return {'data': new_data.to_dict()}, 201  # return data with 201 CREATED status code
+            new_data = dataset().insert(json)
+            return {'data': to_records(new_data,orient='dict')}, 201  # return data with 201 CREATED status code
         else:
             #return content type error
             return {'message':'Content-Type not supported, please specify the correct content type (application/json) in the request header'},400
@@ -254,20 +594,10 @@ class Result(Resource):
                 errors['error']='Bad request'
                 return errors,400
             
-            #read data
-            data = read_vcf('./NA12877_API_10.vcf')
-
-            #select data that have the id provided by the user and change their values
-            if not id in data["ID"].to_list():
+            #change all entries according to PUT BODY, if the provided id is not present in the dataset return an error
+            if not dataset().update(id,json):
                 return {'error':'Entry not found','message':'The id you are looking fore is not in the dataset'},404 
             
-            #change all entries according to PUT BODY
-            for key in json:
-                data.loc[data["ID"] == id, key] = json[key]
-            
-            #rewrite dataset
-            data.to_csv('./NA12877_API_10.csv',index=False)
-            
             #return success code
             return {'message':'Fields updated succesfully'},200
         else:
@@ -294,28 +624,295 @@ class Result(Resource):
         if not id:
             return {'error':'The user is trying to perform a DELETE request but is not providing any id parameter in the URL'},400
         
-        #read data
-        data = read_vcf('./NA12877_API_10.vcf')
-        #if the provided id is not present in the dataset return an error
-        if not id in data["ID"].to_list():
+        #delete all entries that have the id provided by the user, if the provided id is not present in the dataset return an error
+        if not dataset().delete(id):
             return {'error':'Entry not found','message':'The id you are looking fore is not in the dataset'},404 
         
-        #delete all entries that have the id provided by the user
-        data.drop(data[data['ID'] == id].index, inplace=True)
-        #rewrite the dataset
-        data.to_csv('./NA12877_API_10.csv',index=False)
         #return success message
         return {'message':'Entries deleted succesfully'},204
 
 
+class Query(Resource):
+
+    '''
+        The Query class implements the /result/query endpoint, which resolves many ids and regions in a single request
+    '''
+
+    max_keys=10000 #maximum number of ids and regions per request
+
+    def post(self):
+        '''
+            Implements the POST functionalty of the endpoint.
+            The json body lists the ids and/or the regions to look for: {"ids": ["rs1", ...], "regions": ["chr1:100-200", ...]}.
+            All the keys are resolved in one pass and the entries are returned grouped by key, in the order of the request.
+
+            Return:
+            dict: The dictionary containing the results or the error message
+            int: THe status code
+        '''
+        #make sure that content type is json
+        if request.headers.get('Content-Type') != 'application/json':
+            return {'message':'Content-Type not supported, please specify the correct content type (application/json) in the request header'},400
+        body = request.get_json(silent=True)
+        if not isinstance(body,dict):
+            return {'error':'Bad request','message':['Request body must be a json object']},400
+        ids = body.get('ids',[])
+        regions = body.get('regions',[])
+        if not isinstance(ids,list) or not isinstance(regions,list) or not all(isinstance(x,str) for x in ids+regions):
+            return {'error':'Bad request','message':['ids and regions must be lists of strings']},400
+        if not ids and not regions:
+            return {'error':'Bad request','message':['Request body must contain at least one id or region']},400
+        if len(ids)+len(regions) > self.max_keys:
+            return {'error':'Bad request','message':['A request can contain at most %d ids and regions'%self.max_keys]},400
+
+        #parse and validate the requested regions
+        parsed_regions=[]
+        for region in regions:
+            parsed,errors = Result().parse_region(region)
+            if errors:
+                return {'error':'Bad request','message':errors},400
+            parsed_regions.append(parsed)
+
+        representation = negotiate_representation()
+        if representation is None:
+            return not_acceptable()
+
+        response,groups = dataset().lookup_many(ids,parsed_regions)
+        with span('serialize'):
+            records = to_records(response)
+        results = [{'key':key,'entries':len(group),'data':{label:records[label] for label in group}} for key,group in zip(ids+regions,groups)]
+        data = {'meta':{
+                    'keys':len(results),
+                    'entries':sum(result['entries'] for result in results),
+                    'not_found':[result['key'] for result in results if result['entries']==0]},
+                'results':results}
+        return make_representation(data,representation)
+
+
+class Batch(Resource):
+
+    '''
+        The Batch class implements the /result/batch endpoint, which applies many inserts, updates and deletes
+        in a single transaction
+    '''
+
+    max_operations=100000 #maximum number of operations per request
+    statuses={'insert':201,'update':200,'delete':204} #status of every kind of operation when it succeeds
+
+    def validate_operation(self,item):
+        '''
+            An auxiliary function to validate the structure of one operation of a batch, its data being validated
+            with the ones of the other operations (see post).
+
+            Parameters:
+            item,dict: the operation, {"op": "insert", "data": {...}}, {"op": "update", "id": "rs1", "data": {...}} or {"op": "delete", "id": "rs1"}
+
+            Return:
+            errors,list: the error messages, empty if the operation is valid
+        '''
+        if not isinstance(item,dict) or item.get('op') not in self.statuses:
+            return ['Every operation must be a json object whose op field is one of: "insert","update","delete"']
+        errors=[]
+        if item['op'] != 'insert' and (not isinstance(item.get('id'),str) or not item['id']):
+            errors.append('The %s operation must have an id field'%item['op'])
+        if item['op'] != 'delete':
+            if not isinstance(item.get('data'),dict):
+                errors.append('The %s operation must have a data field containing a json object'%item['op'])
+        return errors
+
+    def post(self):
+        '''
+            Implements the POST functionalty of the endpoint.
+            The json body lists the operations to apply in order: {"operations": [...], "strict": false}, see validate_operation.
+            All the operations are validated first, then the valid ones are applied together and persisted with a single write.
+            Invalid operations and updates or deletes of missing ids are reported without aborting the other operations,
+            unless strict is true, in which case nothing is applied if any operation fails (400 or 404 status).
+
+            Return:
+            dict: The dictionary containing the result of every operation or the error message
+            int: THe status code
+        '''
+        secret='password'
+        #check that the user provide sthe correct authorization to post a request.
+        #return unauthorized error if user does not provide an authorization header or if the value of the header is diffrerent from secret
+        if 'Authorization' not in request.headers or request.headers['Authorization'] != secret:
+            return {"message": "Make sure that you provide an Authorization header and the correct secret as its value","error":"Permission denied"},403
+        #make sure that content type is json
+        if request.headers.get('Content-Type') != 'application/json':
+            return {'message':'Content-Type not supported, please specify the correct content type (application/json) in the request header'},400
+        body = request.get_json(silent=True)
+        if not isinstance(body,dict):
+            return {'error':'Bad request','message':['Request body must be a json object']},400
+        operations = body.get('operations')
+        strict = body.get('strict',False)
+        if not isinstance(operations,list) or not operations:
+            return {'error':'Bad request','message':['Request body must contain a non empty list of operations']},400
+        if len(operations) > self.max_operations:
+            return {'error':'Bad request','message':['A request can contain at most %d operations'%self.max_operations]},400
+        if not isinstance(strict,bool):
+            return {'error':'Bad request','message':['strict must be a boolean']},400
+
+        #validate all the operations before applying any of them, the payloads being validated together in one pass
+        errors = [self.validate_operation(item) for item in operations]
+        payloads = [i for i,item in enumerate(operations) if not errors[i] and item['op'] != 'delete']
+        for i,payload_errors in zip(payloads,validate_records([operations[i]['data'] for i in payloads],dataset().fields)):
+            errors[i] = payload_errors
+        results=[]
+        ops=[]
+        for i,item in enumerate(operations):
+            results.append({'index':i,'op':item.get('op') if isinstance(item,dict) else None})
+            if errors[i]:
+                results[i].update({'status':400,'error':'Bad request','message':errors[i]})
+            elif item['op'] == 'insert':
+                ops.append((i,{'op':'insert','row':item['data']}))
+            elif item['op'] == 'update':
+                ops.append((i,{'op':'update','id':item['id'],'fields':item['data']}))
+            else:
+                ops.append((i,{'op':'delete','id':item['id']}))
+
+        if strict and len(ops) < len(operations):
+            applied = [None]*len(ops) #strict mode: one invalid operation aborts the whole batch
+        else:
+            #apply the valid operations in one transaction
+            applied = dataset().apply([op for i,op in ops],strict=strict) if ops else []
+        for (i,op),result in zip(ops,applied):
+            if result is False:
+                results[i].update({'status':404,'error':'Entry not found','message':['The id you are looking fore is not in the dataset']})
+            elif result is None:
+                results[i].update({'status':409,'error':'Not applied','message':['The batch was not applied because another operation failed']})
+            else:
+                results[i].update({'status':self.statuses[op['op']],'id':op['row']['ID'] if op['op']=='insert' else op['id']})
+
+        failed = sum(1 for result in results if result['status']>=400)
+        data = {'meta':{'operations':len(results),'applied':len(results)-failed,'failed':failed,'strict':strict},'results':results}
+        if strict and failed:
+            return data,400 if any(result['status']==400 for result in results) else 404
+        return data,200
+
+
+class CacheStats(Resource):
+
+    '''
+        The CacheStats class implements the /result/cache endpoint, which reports the hit, miss and eviction counts of the response cache
+    '''
+
+    def get(self):
+        '''
+            Return:
+            dict: the statistics of the response cache of the dataset, see ResponseCache.stats
+        '''
+        return response_cache().stats(),200
+
+
+class MetricsReport(Resource):
+
+    '''
+        The MetricsReport class implements the /metrics endpoint, which reports the request counts, the request and stage
+        latency histograms and the size of the datasets kept in memory in the Prometheus text format
+    '''
+
+    def get(self):
+        '''
+            Return:
+            Response: the metrics of this process, see Metrics.render
+        '''
+        config = current_app.config
+        stores = registry.resident()
+        sizes = [store.resident_size for store in stores]
+        loaded = [store for store,size in zip(stores,sizes) if size is not None]
+        caches = [cache_for(store,config['CACHE_MAX_ENTRIES'],config['CACHE_MAX_BYTES'],config['CACHE_TTL']).stats() for store in loaded]
+        resident,peak = process_memory()
+        gauges = {'vcf_api_datasets_registered':len(registry.names()),
+                  'vcf_api_datasets_resident':len(stores),
+                  'vcf_api_dataset_rows':sum(size[0] for size in sizes if size is not None),
+                  'vcf_api_dataset_bytes':sum(size[1] for size in sizes if size is not None),
+                  'vcf_api_cache_entries':sum(cache['entries'] for cache in caches),
+                  'vcf_api_cache_bytes':sum(cache['bytes'] for cache in caches),
+                  'vcf_api_process_resident_bytes':resident,
+                  'vcf_api_process_peak_resident_bytes':peak}
+        return Response(metrics.render(gauges),status=200,mimetype='text/plain; version=0.0.4')
+
+
 #instantiate Flask API
 app=Flask(__name__)
+app.config['DATASET_PATH']=DATASET_PATH
+app.config['CACHE_MAX_ENTRIES']=1024 #maximum number of cached GET responses
+app.config['CACHE_MAX_BYTES']=64*1024*1024 #maximum total size of the cached GET responses
+app.config['CACHE_TTL']=300 #number of seconds a GET response stays cached
+app.config['DATASETS']={} #vcf files served besides DATASET_PATH, by dataset name, see select_datasets
+app.config['DATASET_DIR']=None #optional folder whose name.vcf and name.vcf.gz files are served as the dataset name
+app.config['MAX_RESIDENT_DATASETS']=8 #maximum number of datasets kept in memory, the least recently used one being closed first
+app.config['METRICS_ENABLED']=True #record the request and stage metrics reported by /metrics
+app.config['PROFILE_EVERY']=0 #run one request out of every N under cProfile, 0 to never profile
+app.config['PROFILE_DIR']='./profiles' #folder of the cProfile dumps
 api=Api(app)
 
+
+@app.before_request
+def start_request():
+    '''
+        Starts timing the request and, one request out of every PROFILE_EVERY, profiling it.
+    '''
+    metrics.enabled = current_app.config['METRICS_ENABLED']
+    if metrics.enabled:
+        g.request_start = time.perf_counter()
+    every = current_app.config['PROFILE_EVERY']
+    if every > 0:
+        number = metrics.next_request()
+        if number%every == 0:
+            profiler = Profiler(current_app.config['PROFILE_DIR'])
+            if profiler.start():
+                g.profiler = (profiler,number)
+
+
+@app.before_request
+def select_datasets():
+    '''
+        Reads the dataset parameter of the request: a dataset name, a comma separated list of names or * for all the datasets.
+        Only GET /result requests can target several datasets, the other requests are sent to the default dataset when
+        they have no dataset parameter.
+    '''
+    config = current_app.config
+    registry.max_resident = config['MAX_RESIDENT_DATASETS']
+    registry.folder = config['DATASET_DIR']
+    registry.replace(config['DATASETS']) #datasets removed from the config are no longer served
+    names = request.args.get('dataset')
+    if names is None:
+        return None
+    names = registry.names() if names == '*' else [name for name in names.split(',') if name]
+    unknown = [name for name in names if registry.path(name) is None]
+    if unknown or not names:
+        return {'error':'Dataset not found','message':'Unknown dataset(s):'+str(unknown) if unknown else 'No dataset is registered'},404
+    if len(names) > 1 and (request.method != 'GET' or request.path != '/result'):
+        return {'error':'Bad request','message':['Only GET /result requests can target several datasets']},400
+    g.datasets = names
+
+
+@app.after_request
+def end_request(response):
+    '''
+        Records the latency of the request by method, status and representation, and dumps its profile if it was profiled.
+        Streamed responses are timed until their first chunk.
+    '''
+    if 'profiler' in g:
+        profiler,number = g.pop('profiler')
+        profiler.stop(number,request.method,request.path)
+    if metrics.enabled and 'request_start' in g:
+        labels = (('method',request.method),('status',str(response.status_code)),('representation',response.mimetype or ''))
+        metrics.inc('vcf_api_requests_total',labels)
+        metrics.observe('vcf_api_request_duration_seconds',labels,time.perf_counter()-g.request_start)
+    return response
+
+
 # Add endpoint to API
 api.add_resource(Result,'/result')
+api.add_resource(Query,'/result/query')
+api.add_resource(Batch,'/result/batch')
+api.add_resource(CacheStats,'/result/cache')
+api.add_resource(MetricsReport,'/metrics')
 
 if __name__ == '__main__':
+    get_store(app.config['DATASET_PATH']).refresh() #load the dataset once before serving requests
     app.run() #run app
 
 
@@ -0,0 +1,315 @@
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import io
+import json
+import multiprocessing
+import os
+import sys
+from urllib.parse import parse_qs
+
+
+MAX_THREADS=8 #number of threads answering the cheap requests
+MAX_PROCESSES=os.cpu_count() or 2 #number of worker processes answering the heavy requests
+MAX_PENDING=32 #maximum number of requests waiting or running per pool, above which 503 is returned
+HEAVY_REGION_SPAN=1000000 #regions spanning more positions than this (or whole chromosomes) are heavy
+HEAVY_PAGE_SIZE=1000 #pages of more entries than this are heavy
+HEAVY_BODY_BYTES=64*1024 #bulk lookups with a bigger body are heavy
+
+
+def build_environ(scope,body):
+    '''
+        Builds the WSGI environ of an ASGI http request.
+
+        Parameters:
+        scope,dict: the ASGI scope of the request
+        body,bytes: the complete request body
+
+        Return:
+        dict: the WSGI environ, without the wsgi.input and wsgi.errors streams (see with_streams) so that it can be pickled
+    '''
+    server = scope.get('server') or ('localhost',80)
+    environ = {
+        'REQUEST_METHOD':scope['method'],
+        'SCRIPT_NAME':scope.get('root_path','').encode('utf8').decode('latin1'),
+        'PATH_INFO':scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING':scope['query_string'].decode('latin1'),
+        'SERVER_NAME':server[0],
+        'SERVER_PORT':str(server[1]),
+        'SERVER_PROTOCOL':'HTTP/%s'%scope.get('http_version','1.1'),
+        'CONTENT_LENGTH':str(len(body)),
+        'wsgi.version':(1,0),
+        'wsgi.url_scheme':scope.get('scheme','http'),
+        'wsgi.multithread':True,
+        'wsgi.multiprocess':True,
+        'wsgi.run_once':False,
+        'asgi.body':body}
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name,value in scope.get('headers',[]):
+        name = name.decode('latin1').upper().replace('-','_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_'+name
+            environ[key] = environ[key]+','+value if key in environ else value
+    return environ
+
+
+def with_streams(environ):
+    '''
+        Return:
+        dict: a copy of an environ built by build_environ, with its wsgi.input and wsgi.errors streams
+    '''
+    environ = dict(environ)
+    environ['wsgi.input'] = io.BytesIO(environ.pop('asgi.body'))
+    environ['wsgi.errors'] = sys.stderr
+    return environ
+
+
+def _start_response(response):
+    '''
+        Return:
+        function: a WSGI start_response storing the status and the headers in the response dict
+    '''
+    def start_response(status,headers,exc_info=None):
+        response['status'] = int(status.split(' ',1)[0])
+        response['headers'] = [(name.lower().encode('latin1'),value.encode('latin1')) for name,value in headers]
+    return start_response
+
+
+_worker_app=None
+
+
+def _init_worker(config):
+    '''
+        Initializes a worker process of the pool, which serves the heavy requests with its own copy of the app.
+        The dataset is memory-mapped from the same snapshot and kept up to date through the same change log
+        as the main process, so that both see the same data.
+
+        Parameters:
+        config,dict: the settings of the app config of the main process
+    '''
+    global _worker_app
+    from api import app
+    app.config.update(config)
+    _worker_app = app
+
+
+def run_in_worker(environ):
+    '''
+        Serves a request in a worker process of the pool.
+
+        Parameters:
+        environ,dict: the environ of the request, see build_environ
+
+        Return:
+        dict: the status, the headers and the complete body of the response
+    '''
+    response={}
+    result = _worker_app.wsgi_app(with_streams(environ),_start_response(response))
+    try:
+        response['body'] = b''.join(result)
+    finally:
+        if hasattr(result,'close'):
+            result.close()
+    return response
+
+
+def is_heavy(environ):
+    '''
+        Tells whether a request is CPU heavy and must be served by the process pool: batches, big bulk lookups,
+        GET requests targeting several datasets, scanning wide regions or rendering big pages.
+        Streamed GET requests are never heavy, since their memory use is flat and their entries must be sent as they come.
+
+        Parameters:
+        environ,dict: the environ of the request, see build_environ
+
+        Return:
+        bool: True if the request is heavy
+    '''
+    from api import Result
+    method,path = environ['REQUEST_METHOD'],environ['PATH_INFO']
+    if method == 'POST' and path == '/result/batch':
+        return True
+    if method == 'POST' and path == '/result/query':
+        return len(environ['asgi.body']) > HEAVY_BODY_BYTES
+    if method != 'GET' or path != '/result':
+        return False
+    args = parse_qs(environ['QUERY_STRING'])
+    if any(',' in names or names == '*' for names in args.get('dataset',[])):
+        return True #fans out to several datasets
+    accept = environ.get('HTTP_ACCEPT','')
+    if accept == 'application/x-ndjson' or args.get('stream') == ['true']:
+        return False
+    try:
+        per_page = int(args.get('per_page',['10'])[0])
+    except ValueError:
+        per_page = 10
+    if per_page > HEAVY_PAGE_SIZE:
+        return True
+    for region in args.get('region',[]):
+        (chrom,start,end),errors = Result().parse_region(region)
+        if not errors and (start is None or end-start > HEAVY_REGION_SPAN):
+            return True
+    return False
+
+
+class AsgiApp:
+
+    '''
+        ASGI application serving the WSGI (Flask) app: cheap requests are answered by a bounded thread pool of the
+        server process, streamed responses included, while CPU heavy requests (see is_heavy) are sent to a bounded pool
+        of worker processes so that they cannot hold up the cheap ones.
+        When a pool already has max_pending requests waiting or running, new requests get a 503 right away
+        instead of an unbounded latency.
+    '''
+
+    def __init__(self,wsgi_app,threads=MAX_THREADS,processes=MAX_PROCESSES,max_pending=MAX_PENDING):
+        '''
+            Parameters:
+            wsgi_app,Flask: the app
+            threads,int: the number of threads answering the cheap requests
+            processes,int: the number of worker processes answering the heavy requests, 0 to answer them with the threads
+            max_pending,int: the maximum number of requests waiting or running per pool
+        '''
+        self.wsgi_app=wsgi_app
+        self.threads=threads
+        self.processes=processes
+        self.max_pending=max_pending
+        self.pending={'inline':0,'heavy':0}
+        self._thread_pool=None
+        self._process_pool=None
+
+    def thread_pool(self):
+        if self._thread_pool is None:
+            self._thread_pool = concurrent.futures.ThreadPoolExecutor(self.threads,thread_name_prefix='asgi')
+        return self._thread_pool
+
+    def process_pool(self):
+        if self._process_pool is None:
+            #spawned workers do not inherit the threads and locks of the server process
+            config = {key:value for key,value in self.wsgi_app.config.items() if key.startswith(('DATASET','CACHE_','MAX_RESIDENT'))}
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(self.processes,mp_context=multiprocessing.get_context('spawn'),
+                                                                        initializer=_init_worker,initargs=(config,))
+        return self._process_pool
+
+    def reset_process_pool(self,pool):
+        '''
+            Drops a broken process pool, so that the next heavy request starts a new one.
+
+            Parameters:
+            pool,ProcessPoolExecutor: the broken pool, not dropped if it was already replaced by another request
+        '''
+        if self._process_pool is pool:
+            self._process_pool = None
+        pool.shutdown(wait=False)
+
+    def shutdown(self):
+        '''
+            Stops the pools.
+        '''
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False)
+            self._thread_pool = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False)
+            self._process_pool = None
+
+    async def __call__(self,scope,receive,send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type':'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.shutdown()
+                    await send({'type':'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        body=b''
+        while True:
+            message = await receive()
+            body += message.get('body',b'')
+            if not message.get('more_body',False):
+                break
+        environ = build_environ(scope,body)
+        heavy = self.processes > 0 and is_heavy(environ)
+        kind = 'heavy' if heavy else 'inline'
+        if self.pending[kind] >= self.max_pending:
+            await self.send_unavailable(send)
+            return
+        self.pending[kind] += 1
+        try:
+            if heavy:
+                pool = self.process_pool()
+                try:
+                    response = await asyncio.get_running_loop().run_in_executor(pool,run_in_worker,environ)
+                except concurrent.futures.process.BrokenProcessPool:
+                    #a worker died (e.g. killed by the OOM killer): the next heavy request gets a new pool
+                    self.reset_process_pool(pool)
+                    await self.send_unavailable(send)
+                    return
+                await send({'type':'http.response.start','status':response['status'],'headers':response['headers']})
+                await send({'type':'http.response.body','body':response['body']})
+            else:
+                await asyncio.get_running_loop().run_in_executor(self.thread_pool(),self.run_inline,environ,send,asyncio.get_running_loop())
+        finally:
+            self.pending[kind] -= 1
+
+    def run_inline(self,environ,send,loop):
+        '''
+            Serves a request in a thread of the pool, sending the chunks of the response as the app produces them.
+
+            Parameters:
+            environ,dict: the environ of the request, see build_environ
+            send,function: the ASGI send function
+            loop,AbstractEventLoop: the event loop of the server
+        '''
+        def call(message):
+            asyncio.run_coroutine_threadsafe(send(message),loop).result()
+        response={}
+        result = self.wsgi_app.wsgi_app(with_streams(environ),_start_response(response))
+        try:
+            started = False
+            for chunk in result:
+                if not started:
+                    call({'type':'http.response.start','status':response['status'],'headers':response['headers']})
+                    started = True
+                if chunk:
+                    call({'type':'http.response.body','body':chunk,'more_body':True})
+            if not started:
+                call({'type':'http.response.start','status':response['status'],'headers':response['headers']})
+            call({'type':'http.response.body','body':b''})
+        finally:
+            if hasattr(result,'close'):
+                result.close()
+
+    async def send_unavailable(self,send):
+        '''
+            Sends the response returned when too many requests are pending.
+        '''
+        body = json.dumps({'error':'Service unavailable','message':'Too many requests are pending, please retry later'}).encode()
+        await send({'type':'http.response.start','status':503,
+                    'headers':[(b'content-type',b'application/json'),(b'content-length',str(len(body)).encode()),(b'retry-after',b'1')]})
+        await send({'type':'http.response.body','body':body})
+
+
+def create_app(wsgi_app=None,**kwargs):
+    '''
+        Parameters:
+        wsgi_app,Flask: the app, the one of api.py by default
+        kwargs: the settings of AsgiApp
+
+        Return:
+        AsgiApp: the ASGI application
+    '''
+    if wsgi_app is None:
+        from api import app as wsgi_app
+    return AsgiApp(wsgi_app,**kwargs)
+
+
+#serve with any ASGI server, e.g.: uvicorn asgi:app
+app=create_app()
@@ -0,0 +1,461 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+
+SIZES={'10k':10000,'1M':1000000,'10M':10000000} #dataset sizes of the suite
+CHROMS=['chr%d'%n for n in range(1,23)]+['chrX','chrY'] #chromosomes of the synthetic datasets
+AUTH_HEADERS={'Authorization':'password','Content-Type':'application/json'}
+
+
+def write_synthetic_vcf(path,variants,seed=0):
+    '''
+        Writes a synthetic single sample vcf file with the same columns as the NA12877 dataset.
+        Variants are spread over chr1-chr22, X and Y in increasing position order and have unique rs ids rs1..rsN.
+
+        Parameters:
+        path,str: the path of the vcf file
+        variants,int: the number of variants
+        seed,int: the seed of the random generator, so that files are reproducible
+    '''
+    rng = random.Random(seed)
+    chroms = CHROMS
+    per_chrom = variants//len(chroms)+1
+    bases = 'ACGT'
+    with open(path,'w') as f:
+        f.write('##fileformat=VCFv4.1\n')
+        f.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">\n')
+        f.write('##INFO=<ID=AF,Number=A,Type=Float,Description="Allele Frequency">\n')
+        f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        f.write('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNA12877 single 20180302\n')
+        for n in range(variants):
+            chrom = chroms[n//per_chrom]
+            pos = (n%per_chrom)*100+rng.randint(1,99)
+            ref = rng.choice(bases)
+            alt = rng.choice(bases.replace(ref,''))
+            dp = rng.randint(5,80)
+            f.write('%s\t%d\trs%d\t%s\t%s\t%d\t%s\tDP=%d;AF=%.2f\tGT:DP\t%s:%d\n'%(
+                chrom,pos,n+1,ref,alt,rng.randint(10,99),'PASS' if rng.random()<0.9 else 'LowQual',
+                dp,rng.random(),rng.choice(['0/1','1/1','0/0']),dp))
+
+
+class BenchmarkDataset:
+
+    '''
+        Context manager that runs the API against a synthetic dataset written to a temporary folder.
+    '''
+
+    def __init__(self,variants,seed=0,config=None):
+        '''
+            Parameters:
+            variants,int: the number of variants of the dataset
+            seed,int: the seed of the random generator
+            config,dict: optional settings of the app config used while the dataset is served, e.g. CACHE_MAX_ENTRIES
+        '''
+        self.variants=variants
+        self.seed=seed
+        self.config=config or {}
+        self.generate_seconds=None
+
+    def __enter__(self):
+        from api import app
+        self.app=app
+        self.folder=tempfile.mkdtemp()
+        self.path=os.path.join(self.folder,'benchmark.vcf')
+        start = time.perf_counter()
+        write_synthetic_vcf(self.path,self.variants,self.seed)
+        self.generate_seconds = time.perf_counter()-start
+        self.previous_config={key:app.config.get(key) for key in ['DATASET_PATH',*self.config]}
+        app.config.update(self.config,DATASET_PATH=self.path)
+        return app.test_client()
+
+    def __exit__(self,*args):
+        self.app.config.update(self.previous_config)
+        shutil.rmtree(self.folder)
+
+
+def latency_stats(latencies,seconds=None):
+    '''
+        Parameters:
+        latencies,list: the latencies of the requests, in seconds
+        seconds,float: optional, the wall time the requests took, by default the sum of the latencies
+
+        Return:
+        dict: the number of requests, the mean, p50, p99 and max latencies in milliseconds and the throughput
+    '''
+    latencies = np.array(latencies,dtype=float)*1000
+    if not len(latencies):
+        return {'requests':0}
+    seconds = latencies.sum()/1000 if seconds is None else seconds
+    return {'requests':len(latencies),'mean_ms':round(float(latencies.mean()),3),
+            'p50_ms':round(float(np.percentile(latencies,50)),3),'p99_ms':round(float(np.percentile(latencies,99)),3),
+            'max_ms':round(float(latencies.max()),3),'throughput_rps':round(len(latencies)/seconds,1) if seconds > 0 else 0.0}
+
+
+def send(client,request):
+    '''
+        Sends a request with the test client and times it.
+
+        Parameters:
+        client,FlaskClient: the client
+        request,tuple: (method,url,kwargs of the client method)
+
+        Return:
+        float: the latency in seconds
+        int: the status code
+    '''
+    method,url,kwargs = request
+    start = time.perf_counter()
+    response = client.open(url,method=method,**kwargs)
+    response.get_data()
+    return time.perf_counter()-start,response.status_code
+
+
+def run_requests(client,requests):
+    '''
+        Sends requests one after the other.
+
+        Parameters:
+        client,FlaskClient: the client
+        requests,list: the requests, see send
+
+        Return:
+        dict: the latency stats of the requests (see latency_stats) and the count of every status code
+    '''
+    latencies,statuses = [],{}
+    for request in requests:
+        latency,status = send(client,request)
+        latencies.append(latency)
+        statuses[str(status)] = statuses.get(str(status),0)+1
+    return dict(latency_stats(latencies),statuses=statuses)
+
+
+def run_load(app,requests,concurrency):
+    '''
+        Sends requests from concurrent threads, each one with its own test client, like concurrent clients would.
+
+        Parameters:
+        app,Flask: the app
+        requests,list: the requests, see send
+        concurrency,int: the number of requests in flight at once
+
+        Return:
+        dict: the latency stats of the requests (see latency_stats), the throughput being computed over the wall time,
+              and the count of every status code
+    '''
+    clients = [app.test_client() for _ in range(concurrency)]
+    batches = [requests[n::concurrency] for n in range(concurrency)]
+    def run(n):
+        return [send(clients[n],request) for request in batches[n]]
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        results = [result for batch in pool.map(run,range(concurrency)) for result in batch]
+    seconds = time.perf_counter()-start
+    statuses={}
+    for _,status in results:
+        statuses[str(status)] = statuses.get(str(status),0)+1
+    return dict(latency_stats([latency for latency,_ in results],seconds),concurrency=concurrency,statuses=statuses)
+
+
+def scenarios(variants,requests,seed=0):
+    '''
+        Builds the requests of every scenario of the suite for a synthetic dataset (see write_synthetic_vcf).
+        Lookups use distinct random keys, the write scenarios insert, update then delete their own new variants
+        so that the dataset is the same after the suite.
+
+        Parameters:
+        variants,int: the number of variants of the dataset
+        requests,int: the number of requests per scenario
+        seed,int: the seed of the random generator
+
+        Return:
+        dict: the requests of every scenario, by name, see send
+    '''
+    rng = random.Random(seed)
+    per_chrom = variants//len(CHROMS)+1
+    chroms = CHROMS[:-(-variants//per_chrom)]
+    json_headers,xml_headers = {'headers':{'Accept':'application/json'}},{'headers':{'Accept':'application/xml'}}
+    ids = ['rs%d'%n for n in rng.sample(range(1,variants+1),min(requests,variants))]
+    regions=[]
+    for _ in range(requests):
+        start = rng.randint(0,per_chrom-10)*100
+        regions.append('%s:%d-%d'%(rng.choice(chroms),start,start+1000)) #about 10 variants
+    last_page = -(-per_chrom//10)
+    new_ids = ['rs%d'%(variants+n+1) for n in range(requests)]
+    body = lambda id: {'json':{'CHROM':'chr1','POS':rng.randint(1,10**8),'ID':id,'REF':'A','ALT':'G'},'headers':AUTH_HEADERS}
+    return {
+        'get_id_json':[('GET','/result?id=%s'%id,json_headers) for id in ids],
+        'get_id_xml':[('GET','/result?id=%s'%id,xml_headers) for id in ids],
+        'get_region_json':[('GET','/result?region=%s'%region,json_headers) for region in regions],
+        'get_region_xml':[('GET','/result?region=%s'%region,xml_headers) for region in regions],
+        'page_first':[('GET','/result?region=chr1&page=1&per_page=10',json_headers)]*requests,
+        'page_middle':[('GET','/result?region=chr1&page=%d&per_page=10'%max(1,last_page//2),json_headers)]*requests,
+        'page_last':[('GET','/result?region=chr1&page=%d&per_page=10'%last_page,json_headers)]*requests,
+        'page_filtered':[('GET','/result?region=chr1&page=1&per_page=10&filter=QUAL>50%26INFO.DP>=40%26GT=0/1',json_headers)]*requests,
+        'post':[('POST','/result',body(id)) for id in new_ids],
+        'put':[('PUT','/result?id=%s'%id,body(id)) for id in new_ids],
+        'delete':[('DELETE','/result?id=%s'%id,{'headers':AUTH_HEADERS}) for id in new_ids]}
+
+
+def bench_suite(variants,requests=200,concurrency=(1,4,16),cache=False,seed=0):
+    '''
+        Runs the benchmark suite of the /result endpoint against a synthetic dataset: dataset import and snapshot
+        load times, latency and throughput of every scenario (see scenarios) and of a concurrent load of lookups.
+
+        Parameters:
+        variants,int: the number of variants of the dataset
+        requests,int: the number of requests per scenario and per concurrency level
+        concurrency,list: the concurrency levels of the load test
+        cache,bool: False to disable the response cache, so that every lookup is computed
+        seed,int: the seed of the random generator
+
+        Return:
+        dict: the results
+    '''
+    from store import VariantStore
+    config = {} if cache else {'CACHE_MAX_ENTRIES':0}
+    dataset = BenchmarkDataset(variants,seed,config)
+    with dataset as client:
+        start = time.perf_counter()
+        VariantStore(dataset.path).refresh() #parses the vcf file and writes the snapshot
+        imported = time.perf_counter()-start
+        start = time.perf_counter()
+        client.get('/result?id=rs1',headers={'Accept':'application/json'}) #memory-maps the snapshot
+        loaded = time.perf_counter()-start
+        results = {name:run_requests(client,batch) for name,batch in scenarios(variants,requests,seed).items()}
+        load = scenarios(variants,requests*max(concurrency),seed+1)
+        mixed = [request for pair in zip(load['get_id_json'],load['get_region_json']) for request in pair]
+        levels = {str(n):run_load(dataset.app,mixed[:requests*n],n) for n in concurrency}
+    return {'variants':variants,'cache':cache,
+            'ingest':{'generate_seconds':round(dataset.generate_seconds,3),'import_seconds':round(imported,3),'snapshot_load_seconds':round(loaded,3)},
+            'scenarios':results,'concurrency':levels}
+
+
+def bench_xml(variants,page_sizes=(10,100,1000),repeat=20,seed=0):
+    '''
+        Compares the rendering of pages of entries as json, as xml through dict2xml and as xml through the xml writer
+        (see xmlwriter.to_xml), and the latency of the same GET requests in json and in xml.
+
+        Parameters:
+        variants,int: the number of variants of the synthetic dataset
+        page_sizes,list: the numbers of entries per page
+        repeat,int: the number of times every page is rendered and requested
+        seed,int: the seed of the random generator
+
+        Return:
+        dict: the mean rendering time of every approach and the p50 GET latencies, by page size
+    '''
+    from dict2xml import dict2xml
+    from store import get_store
+    from vcf import to_records
+    from xmlwriter import to_xml
+    results={}
+    with BenchmarkDataset(variants,seed,{'CACHE_MAX_ENTRIES':0}) as client:
+        store = get_store(client.application.config['DATASET_PATH'])
+        labels = store.lookup_labels(regions=[('chr1',None,None)])
+        for per_page in page_sizes:
+            page = store.rows(labels[:per_page])
+            meta = {'entries':len(labels),'entries_per_page':per_page}
+            timings={}
+            for name,render in [('json',lambda: json.dumps({'meta':meta,'data':to_records(page)})),
+                                ('xml_dict2xml',lambda: dict2xml({'meta':meta,'data':to_records(page)})),
+                                ('xml_writer',lambda: to_xml({'meta':meta,'data':page}))]:
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    render()
+                timings[name+'_ms'] = round((time.perf_counter()-start)/repeat*1000,3)
+            assert dict2xml({'meta':meta,'data':to_records(page)}) == to_xml({'meta':meta,'data':page})
+            url = '/result?region=chr1&per_page=%d'%per_page
+            for name,accept in [('get_json','application/json'),('get_xml','application/xml')]:
+                timings[name+'_p50_ms'] = run_requests(client,[('GET',url,{'headers':{'Accept':accept}})]*repeat)['p50_ms']
+            timings['xml_json_ratio_dict2xml'] = round(timings['xml_dict2xml_ms']/timings['json_ms'],2)
+            timings['xml_json_ratio_writer'] = round(timings['xml_writer_ms']/timings['json_ms'],2)
+            results[str(per_page)] = timings
+    return {'benchmark':'xml','variants':variants,'pages':results}
+
+
+def environment():
+    '''
+        Return:
+        dict: the commit, the python and pandas versions and the machine the benchmarks ran on,
+              so that results of different commits can be compared
+    '''
+    import pandas as pd
+    try:
+        commit = subprocess.run(['git','rev-parse','--short','HEAD'],capture_output=True,text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit':commit,'timestamp':time.strftime('%Y-%m-%dT%H:%M:%S'),'python':platform.python_version(),
+            'pandas':pd.__version__,'machine':platform.machine(),'cpus':os.cpu_count()}
+
+
+def compare(baseline,current,threshold=0.1):
+    '''
+        Compares the p50 and p99 latencies of two suite results.
+
+        Parameters:
+        baseline,dict: the results of the reference commit
+        current,dict: the results of the commit to check
+        threshold,float: the relative slowdown above which a latency is a regression
+
+        Return:
+        list: (variants,name,metric,baseline,current,ratio) for every latency present in both results
+        bool: True if a latency regressed more than threshold
+    '''
+    rows,regressed = [],False
+    previous = {run['variants']:run for run in baseline['results']}
+    for run in current['results']:
+        if run['variants'] not in previous:
+            continue
+        before = dict(previous[run['variants']]['scenarios'],**{'concurrency_'+n:r for n,r in previous[run['variants']]['concurrency'].items()})
+        after = dict(run['scenarios'],**{'concurrency_'+n:r for n,r in run['concurrency'].items()})
+        for name in after:
+            for metric in ['p50_ms','p99_ms']:
+                if name in before and before[name].get(metric) and metric in after[name]:
+                    ratio = after[name][metric]/before[name][metric]
+                    regressed |= ratio > 1+threshold
+                    rows.append((run['variants'],name,metric,before[name][metric],after[name][metric],round(ratio,3)))
+    return rows,regressed
+
+
+def bench_bulk_lookup(variants,keys,seed=0):
+    '''
+        Compares resolving keys ids with one POST /result/query against keys single GET /result?id= requests.
+
+        Parameters:
+        variants,int: the number of variants of the synthetic dataset
+        keys,int: the number of ids to resolve
+        seed,int: the seed of the random generator
+
+        Return:
+        dict: the timings of both approaches and the speedup of the bulk request
+    '''
+    rng = random.Random(seed)
+    ids = ['rs%d'%rng.randint(1,variants) for _ in range(keys)]
+    with BenchmarkDataset(variants,seed) as client:
+        client.get('/result?id=rs1',headers={'Accept':'application/json'}) #load the dataset
+        start = time.perf_counter()
+        for id in ids:
+            client.get('/result?id=%s'%id,headers={'Accept':'application/json'})
+        single = time.perf_counter()-start
+        start = time.perf_counter()
+        response = client.post('/result/query',headers={'Content-Type':'application/json','Accept':'application/json'},json={'ids':ids})
+        bulk = time.perf_counter()-start
+        assert response.status_code==200
+    return {'benchmark':'bulk_lookup','variants':variants,'keys':keys,
+            'single_gets_seconds':round(single,4),'bulk_seconds':round(bulk,4),'speedup':round(single/bulk,1)}
+
+
+def synthetic_payloads(records,invalid=0.01,seed=0):
+    '''
+        Generates json payloads like the ones of the POST requests, some of them being invalid.
+
+        Parameters:
+        records,int: the number of payloads
+        invalid,float: the share of invalid payloads
+        seed,int: the seed of the random generator
+
+        Return:
+        list: the payloads
+    '''
+    rng = random.Random(seed)
+    chroms = CHROMS
+    alleles = ['A','C','G','T','AT','GCC','A,T','<DEL>']
+    payloads=[]
+    for n in range(records):
+        payload = {'CHROM':rng.choice(chroms),'POS':rng.randint(1,10**8),'ID':'rs%d'%(n+1),'REF':rng.choice(alleles[:6]),'ALT':rng.choice(alleles)}
+        if rng.random() < invalid:
+            payload[rng.choice(['CHROM','ID','REF','ALT'])] = rng.choice(['chr23','rsx1','Z','chrchr1'])
+        payloads.append(payload)
+    return payloads
+
+
+def bench_validation(records,seed=0):
+    '''
+        Measures the throughput of the vectorized validation of a batch of json payloads and of a parsed vcf file,
+        compared to validating the payloads one at a time.
+
+        Parameters:
+        records,int: the number of payloads and of vcf rows
+        seed,int: the seed of the random generator
+
+        Return:
+        dict: the records per second of every approach
+    '''
+    from validation import validate_records, validate_frame
+    from vcf import open_vcf, read_header, iter_chunks
+    payloads = synthetic_payloads(records,seed=seed)
+    start = time.perf_counter()
+    errors = validate_records(payloads)
+    bulk = time.perf_counter()-start
+    sample = payloads[:min(records,2000)]
+    start = time.perf_counter()
+    for payload in sample:
+        validate_records([payload])
+    single = (time.perf_counter()-start)/len(sample)*records
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder,'benchmark.vcf')
+        write_synthetic_vcf(path,records,seed)
+        with open_vcf(path) as f:
+            header = read_header(f)
+            chunks = list(iter_chunks(f,header))
+        start = time.perf_counter()
+        for chunk in chunks:
+            validate_frame(chunk)
+        frame = time.perf_counter()-start
+    finally:
+        shutil.rmtree(folder)
+    return {'benchmark':'validation','records':records,'invalid_payloads':sum(1 for e in errors if e),
+            'bulk_records_per_sec':round(records/bulk,1),'single_records_per_sec':round(records/single,1),
+            'file_rows_per_sec':round(records/frame,1),'speedup':round(single/bulk,1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the /result endpoint, results are printed as json')
+    parser.add_argument('benchmark',choices=['suite','compare','bulk','validation','xml'])
+    parser.add_argument('files',nargs='*',help='compare: the baseline and the current results of the suite')
+    parser.add_argument('--sizes',default='10k',help='suite: comma separated dataset sizes among %s or numbers of variants'%','.join(SIZES))
+    parser.add_argument('--requests',type=int,default=200,help='suite: number of requests per scenario')
+    parser.add_argument('--concurrency',default='1,4,16',help='suite: comma separated concurrency levels of the load test')
+    parser.add_argument('--cache',action='store_true',help='suite: keep the response cache enabled')
+    parser.add_argument('--output',help='suite: also write the results to this file')
+    parser.add_argument('--threshold',type=float,default=0.1,help='compare: relative slowdown reported as a regression')
+    parser.add_argument('--variants',type=int,default=100000)
+    parser.add_argument('--keys',type=int,default=1000)
+    parser.add_argument('--records',type=int,default=1000000)
+    parser.add_argument('--seed',type=int,default=0)
+    args = parser.parse_args()
+    if args.benchmark == 'suite':
+        sizes = [SIZES[size] if size in SIZES else int(size) for size in args.sizes.split(',')]
+        concurrency = [int(n) for n in args.concurrency.split(',')]
+        results = dict(environment(),results=[bench_suite(size,args.requests,concurrency,args.cache,args.seed) for size in sizes])
+        if args.output:
+            with open(args.output,'w') as f:
+                json.dump(results,f,indent=1)
+        print(json.dumps(results))
+    elif args.benchmark == 'compare':
+        if len(args.files) != 2:
+            parser.error('compare needs the baseline and the current results files')
+        with open(args.files[0]) as f, open(args.files[1]) as g:
+            rows,regressed = compare(json.load(f),json.load(g),args.threshold)
+        for row in rows:
+            print('%d\t%s\t%s\t%.3f\t%.3f\t%.3f%s'%(row+(' REGRESSION' if row[-1] > 1+args.threshold else '',)))
+        sys.exit(1 if regressed else 0)
+    elif args.benchmark == 'bulk':
+        print(json.dumps(bench_bulk_lookup(args.variants,args.keys,args.seed)))
+    elif args.benchmark == 'validation':
+        print(json.dumps(bench_validation(args.records,args.seed)))
+    elif args.benchmark == 'xml':
+        print(json.dumps(bench_xml(args.variants,seed=args.seed)))
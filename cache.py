@@ -0,0 +1,214 @@
+import collections
+import hashlib
+import threading
+import time
+import weakref
+import numpy as np
+
+
+class CacheEntry:
+
+    '''
+        A rendered response kept by the ResponseCache.
+    '''
+
+    def __init__(self,body,mimetype,scope,expires):
+        '''
+            Parameters:
+            body,bytes: the rendered response body
+            mimetype,str: the mimetype of the body
+            scope,dict: the ids, positions and regions the response was computed from, see ResponseCache.put
+            expires,float: the time.monotonic() value after which the entry is stale
+        '''
+        self.body=body
+        self.mimetype=mimetype
+        self.scope=scope
+        self.expires=expires
+        self.etag=hashlib.sha1(body).hexdigest() #content based, so the etag only changes when the response does
+
+
+class ResponseCache:
+
+    '''
+        LRU cache of rendered responses with a time to live, bounded both in number of entries and in bytes.
+        Every entry remembers the ids, chromosome positions and regions it was computed from, so that a write
+        only invalidates the entries whose content may have changed.
+    '''
+
+    def __init__(self,max_entries=1024,max_bytes=64*1024*1024,ttl=300):
+        '''
+            Parameters:
+            max_entries,int: maximum number of cached responses
+            max_bytes,int: maximum total size of the cached bodies
+            ttl,float: number of seconds a response stays cached
+        '''
+        self.max_entries=max_entries
+        self.max_bytes=max_bytes
+        self.ttl=ttl
+        self.version=0 #incremented on every invalidation, see put
+        self._entries=collections.OrderedDict()
+        self._bytes=0
+        self._by_id=collections.defaultdict(set)
+        self._by_position=collections.defaultdict(set)
+        self._by_chrom=collections.defaultdict(dict) #chrom -> {key: [(start,end), ...]}
+        self._lock=threading.Lock()
+        self._stats={'hits':0,'misses':0,'evictions':0,'expirations':0,'invalidations':0}
+
+    def get(self,key):
+        '''
+            Parameters:
+            key,hashable: the key of the response, e.g. the representation and the query parameters
+
+            Return:
+            CacheEntry: the cached response, None if it is not cached or has expired
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires < time.monotonic():
+                self._remove(key)
+                self._stats['expirations']+=1
+                entry = None
+            if entry is None:
+                self._stats['misses']+=1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits']+=1
+            return entry
+
+    def put(self,key,body,mimetype,scope,version):
+        '''
+            Caches a rendered response.
+
+            Parameters:
+            key,hashable: the key of the response
+            body,bytes: the rendered body
+            mimetype,str: the mimetype of the body
+            scope,dict: optional 'ids' (list of ids), 'positions' (list of (chrom,pos)) and 'regions' (list of (chrom,start,end))
+                        the response was computed from
+            version,int: the value of self.version read before the response was computed; if the cache was invalidated
+                         since, the response may be stale and is not cached
+
+            Return:
+            CacheEntry: the entry of the response, cached or not
+        '''
+        entry = CacheEntry(body,mimetype,scope,time.monotonic()+self.ttl)
+        with self._lock:
+            if version != self.version or len(body) > self.max_bytes:
+                return entry
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += len(body)
+            for id in scope.get('ids',[]):
+                self._by_id[id].add(key)
+            for chrom,pos in scope.get('positions',[]):
+                self._by_position[(chrom,int(pos))].add(key)
+            for chrom,start,end in scope.get('regions',[]):
+                self._by_chrom[chrom].setdefault(key,[]).append((start,end))
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions']+=1
+        return entry
+
+    def _remove(self,key):
+        '''
+            Removes an entry and its references, the lock being held.
+        '''
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.body)
+        for id in entry.scope.get('ids',[]):
+            self._discard(self._by_id,id,key)
+        for chrom,pos in entry.scope.get('positions',[]):
+            self._discard(self._by_position,(chrom,int(pos)),key)
+        for chrom,start,end in entry.scope.get('regions',[]):
+            self._discard(self._by_chrom,chrom,key)
+
+    def _discard(self,references,name,key):
+        '''
+            Removes a key from the references of an id, a position or a chromosome.
+        '''
+        keys = references.get(name)
+        if keys is not None:
+            if isinstance(keys,dict):
+                keys.pop(key,None)
+            else:
+                keys.discard(key)
+            if not keys:
+                del references[name]
+
+    def invalidate(self,changes):
+        '''
+            Removes the entries that may be affected by changed rows.
+
+            Parameters:
+            changes,list: the (ID,CHROM,POS) values of the changed rows, before and after the change;
+                          None when the whole dataset was reloaded, which clears the cache
+
+            Return:
+            int: the number of entries removed
+        '''
+        with self._lock:
+            self.version += 1
+            if changes is None:
+                keys = set(self._entries)
+            else:
+                keys=set()
+                positions=collections.defaultdict(list)
+                for id,chrom,pos in changes:
+                    keys.update(self._by_id.get(id,()))
+                    keys.update(self._by_position.get((chrom,int(pos)),()))
+                    if chrom in self._by_chrom:
+                        positions[chrom].append(int(pos))
+                #an entry built from regions is affected if any changed position falls in one of them
+                for chrom,changed in positions.items():
+                    changed = np.sort(np.array(changed,dtype=np.int64))
+                    for key,bounds in self._by_chrom[chrom].items():
+                        for start,end in bounds:
+                            first = 0 if start is None else np.searchsorted(changed,start,side='left')
+                            last = len(changed) if end is None else np.searchsorted(changed,end,side='right')
+                            if last > first:
+                                keys.add(key)
+                                break
+            for key in keys:
+                self._remove(key)
+            self._stats['invalidations'] += len(keys)
+            return len(keys)
+
+    def stats(self):
+        '''
+            Return:
+            dict: the hit, miss, eviction (LRU), expiration (TTL) and invalidation counts, the hit ratio and the current size
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats['hits']+stats['misses']
+            stats.update({'hit_ratio':round(stats['hits']/lookups,4) if lookups else 0.0,
+                          'entries':len(self._entries),'bytes':self._bytes,
+                          'max_entries':self.max_entries,'max_bytes':self.max_bytes,'ttl':self.ttl})
+            return stats
+
+
+_caches=weakref.WeakKeyDictionary() #a cache is freed with its store, e.g. when the store is closed by the dataset registry
+_caches_lock=threading.Lock()
+
+
+def cache_for(store,max_entries=1024,max_bytes=64*1024*1024,ttl=300):
+    '''
+        Returns the response cache of a store, creating it and subscribing it to the changes of the store on first use.
+
+        Parameters:
+        store,VariantStore: the store
+        max_entries,int: see ResponseCache
+        max_bytes,int: see ResponseCache
+        ttl,float: see ResponseCache
+
+        Return:
+        ResponseCache: the cache
+    '''
+    with _caches_lock:
+        cache = _caches.get(store)
+        if cache is None:
+            cache = ResponseCache(max_entries,max_bytes,ttl)
+            store.subscribe(cache.invalidate)
+            _caches[store] = cache
+        return cache
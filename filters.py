@@ -0,0 +1,119 @@
+import operator
+import re
+import numpy as np
+import pandas as pd
+from vcf import NUMERIC_TYPES
+
+
+FIXED_FIELDS={'CHROM':'String','POS':'Integer','ID':'String','REF':'String','ALT':'String','QUAL':'Float','FILTER':'String'} #columns filters can compare, by type
+OPERATORS={'>=':operator.ge,'<=':operator.le,'!=':operator.ne,'=':operator.eq,'>':operator.gt,'<':operator.lt}
+TERM=re.compile(r'([^<>=!]+?)\s*(?:(>=|<=|!=|==|=|>|<)\s*(.*))?') #a field, optionally followed by an operator and a value
+
+
+class Condition:
+
+    '''
+        A term of a filter expression, e.g. INFO.DP>=10, evaluated on many rows at once.
+        Multi-valued keys (e.g. AF with Number=A) meet a condition when any of their values does,
+        except for != which is met when none of their values is equal. Rows without the key never meet it.
+    '''
+
+    def __init__(self,columns,key,type,op=None,value=None):
+        '''
+            Parameters:
+            columns,list: the columns read: a fixed column (e.g. QUAL), INFO, or the sample columns whose FORMAT key is compared,
+                          the condition being met when any of them meets it
+            key,str: the INFO or FORMAT key, None for the fixed columns
+            type,str: the type of the field, see vcf.field_definitions
+            op,str: one of OPERATORS, None to only check that rows have the key (e.g. for flags)
+            value: the value compared, a float for the Integer and Float fields
+        '''
+        self.columns=columns
+        self.key=key
+        self.type=type
+        self.op=op
+        self.value=value
+
+    def mask(self,present,values):
+        '''
+            Parameters:
+            present,ndarray: True for the rows having the field
+            values,ndarray: the values of the rows, one row per row and one column per value (a single column for fixed columns)
+
+            Return:
+            ndarray: True for the rows meeting the condition
+        '''
+        if self.op is None:
+            return present
+        value = self.value
+        if values.dtype.kind == 'f':
+            value = values.dtype.type(value) #e.g. QUAL is float32, 30.1 must be compared in float32
+        with np.errstate(invalid='ignore'):
+            if self.op == '!=':
+                return present & pd.notna(values).any(axis=1) & ~(values == value).any(axis=1)
+            return present & OPERATORS[self.op](values,value).any(axis=1)
+
+
+def parse_filter(expressions,columns,definitions,samples):
+    '''
+        Parses filter expressions: terms joined by &, all of which entries must meet, e.g. QUAL>30&INFO.DP>=10&GT=0/1.
+        Fields are the fixed columns (CHROM, POS, ID, REF, ALT, QUAL and FILTER), INFO.key for the INFO keys and the FORMAT
+        keys, either for any sample (GT or FORMAT.GT) or for a single one (sample.GT). A field without operator only
+        checks that entries have the key, e.g. INFO.DB for flags.
+
+        Parameters:
+        expressions,list: the expressions, the terms of all of them being combined
+        columns,list: the columns of the dataset
+        definitions,dict: the INFO and FORMAT keys of the dataset, see vcf.field_definitions
+        samples,list: the sample columns FORMAT keys are read from when no sample is named
+
+        Return:
+        conditions,list: the Condition of every term
+        errors,list: the error messages, empty if the expressions are valid
+    '''
+    columns = list(columns)
+    dataset_samples = columns[columns.index('FORMAT')+1:] if 'FORMAT' in columns else []
+    conditions,errors = [],[]
+    for expression in expressions:
+        for term in expression.split('&'):
+            match = TERM.fullmatch(term.strip())
+            if match is None:
+                errors.append('filter term "%s" must be a field, an operator among %s and a value'%(term,','.join(OPERATORS)))
+                continue
+            field,op,value = match.groups()
+            op = '=' if op == '==' else op
+            if field in FIXED_FIELDS and field in columns:
+                condition = Condition([field],None,FIXED_FIELDS[field])
+            elif field.startswith('INFO.') and field[5:] in definitions['INFO']:
+                condition = Condition(['INFO'],field[5:],definitions['INFO'][field[5:]][1])
+            elif field in definitions['FORMAT'] or (field.startswith('FORMAT.') and field[7:] in definitions['FORMAT']):
+                key = field if field in definitions['FORMAT'] else field[7:]
+                condition = Condition(list(samples),key,definitions['FORMAT'][key][1])
+            else:
+                #sample names can hold dots, the longest one prefixing the field wins
+                sample = max((sample for sample in dataset_samples if field.startswith(sample+'.') and field[len(sample)+1:] in definitions['FORMAT']),key=len,default=None)
+                if sample is None:
+                    errors.append('filter field %s is not a column of the dataset nor an INFO or FORMAT key defined in its header'%field)
+                    continue
+                key = field[len(sample)+1:]
+                condition = Condition([sample],key,definitions['FORMAT'][key][1])
+            if op is None:
+                if condition.key is None:
+                    errors.append('filter field %s must be compared to a value'%field)
+                conditions.append(condition)
+                continue
+            if condition.type == 'Flag':
+                errors.append('filter field %s is a flag, which can only be written without operator'%field)
+                continue
+            if condition.type in NUMERIC_TYPES:
+                try:
+                    value = float(value)
+                except ValueError:
+                    errors.append('filter value of %s must be a number'%field)
+                    continue
+            elif op not in ('=','!='):
+                errors.append('filter field %s can only be compared with = or !='%field)
+                continue
+            condition.op,condition.value = op,value
+            conditions.append(condition)
+    return conditions,errors
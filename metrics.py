@@ -0,0 +1,245 @@
+import bisect
+import cProfile
+import itertools
+import os
+import re
+import resource
+import threading
+import time
+
+
+STAGES=['load','lookup','filter','paginate','serialize','apply','persist'] #stages of the hot path timed by spans
+BUCKETS=(0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0) #upper bounds of the histogram buckets, in seconds
+
+
+class _NoSpan:
+
+    '''
+        The span returned while metrics are disabled, which does nothing.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        return False
+
+
+_NO_SPAN=_NoSpan()
+
+
+class _Span:
+
+    '''
+        Times a stage of the hot path and records its duration in the stage histogram when it ends.
+    '''
+
+    def __init__(self,metrics,stage):
+        self.metrics=metrics
+        self.stage=stage
+
+    def __enter__(self):
+        self.start=time.perf_counter()
+        return self
+
+    def __exit__(self,*args):
+        self.metrics.observe('vcf_api_stage_duration_seconds',(('stage',self.stage),),time.perf_counter()-self.start)
+        return False
+
+
+class Metrics:
+
+    '''
+        Process-wide registry of counters and latency histograms, rendered in the Prometheus text format.
+        Recording is off until enabled; while it is off, a span costs a single attribute check.
+    '''
+
+    def __init__(self,buckets=BUCKETS):
+        '''
+            Parameters:
+            buckets,tuple: the upper bounds of the histogram buckets, in seconds
+        '''
+        self.enabled=False
+        self.buckets=buckets
+        self._counters={} #(name,labels) -> value
+        self._histograms={} #(name,labels) -> [bucket counts, sum, count]
+        self._lock=threading.Lock()
+        self._requests=itertools.count(1)
+
+    def span(self,stage):
+        '''
+            Parameters:
+            stage,str: the stage timed, one of STAGES
+
+            Return:
+            context manager: times the code it wraps, spans of nested stages are counted in both stages
+        '''
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self,stage)
+
+    def inc(self,name,labels,value=1):
+        '''
+            Increments a counter.
+
+            Parameters:
+            name,str: the name of the counter
+            labels,tuple: the (label,value) pairs of the counter
+            value,float: the increment
+        '''
+        with self._lock:
+            self._counters[(name,labels)] = self._counters.get((name,labels),0)+value
+
+    def observe(self,name,labels,seconds):
+        '''
+            Records a duration in a histogram.
+
+            Parameters:
+            name,str: the name of the histogram
+            labels,tuple: the (label,value) pairs of the histogram
+            seconds,float: the duration
+        '''
+        bucket = bisect.bisect_left(self.buckets,seconds)
+        with self._lock:
+            histogram = self._histograms.get((name,labels))
+            if histogram is None:
+                histogram = self._histograms[(name,labels)] = [[0]*(len(self.buckets)+1),0.0,0]
+            histogram[0][bucket]+=1
+            histogram[1]+=seconds
+            histogram[2]+=1
+
+    def next_request(self):
+        '''
+            Return:
+            int: the number of the request being served, counting from 1
+        '''
+        return next(self._requests)
+
+    def reset(self):
+        '''
+            Forgets every recorded value.
+        '''
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self,gauges=None):
+        '''
+            Parameters:
+            gauges,dict: optional current values to report as gauges, by name, e.g. the size of the dataset
+
+            Return:
+            str: the counters, the histograms and the gauges in the Prometheus text format
+        '''
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key,[list(value[0]),value[1],value[2]]) for key,value in self._histograms.items())
+        lines=[]
+        typed=set()
+        def declare(name,kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s'%(name,kind))
+        for (name,labels),value in counters:
+            declare(name,'counter')
+            lines.append('%s%s %s'%(name,_labels(labels),_number(value)))
+        for (name,labels),(buckets,total,count) in histograms:
+            declare(name,'histogram')
+            cumulative=0
+            for bound,n in zip(self.buckets+(float('inf'),),buckets):
+                cumulative+=n
+                lines.append('%s_bucket%s %d'%(name,_labels(labels+(('le','+Inf' if bound == float('inf') else repr(bound)),)),cumulative))
+            lines.append('%s_sum%s %s'%(name,_labels(labels),_number(total)))
+            lines.append('%s_count%s %d'%(name,_labels(labels),count))
+        for name,value in sorted((gauges or {}).items()):
+            declare(name,'gauge')
+            lines.append('%s %s'%(name,_number(value)))
+        return '\n'.join(lines)+'\n'
+
+
+def _labels(labels):
+    '''
+        Return:
+        str: the labels of a sample in the Prometheus text format, e.g. {method="GET",status="200"}
+    '''
+    if not labels:
+        return ''
+    return '{'+','.join('%s="%s"'%(name,str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')) for name,value in labels)+'}'
+
+
+def _number(value):
+    '''
+        Return:
+        str: a sample value, integers without a decimal part
+    '''
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def process_memory():
+    '''
+        Return:
+        int: the resident memory of the process in bytes (the peak one where the current one cannot be read)
+        int: the peak resident memory of the process in bytes
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024 #kilobytes on linux
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError,ValueError,IndexError):
+        current = peak
+    return current,max(current,peak)
+
+
+class Profiler:
+
+    '''
+        Opt-in sampling profiler: one request out of every N is run under cProfile and its statistics are
+        dumped to a folder, to be read with pstats or snakeviz.
+    '''
+
+    def __init__(self,folder):
+        '''
+            Parameters:
+            folder,str: the folder the .prof files are written to
+        '''
+        self.folder=folder
+        self.profile=cProfile.Profile()
+
+    def start(self):
+        '''
+            Return:
+            bool: False if the profiler could not be started, e.g. because another profiler is running in this thread
+        '''
+        try:
+            self.profile.enable()
+        except ValueError:
+            return False
+        return True
+
+    def stop(self,number,method,path):
+        '''
+            Stops the profiler and dumps its statistics.
+
+            Parameters:
+            number,int: the number of the request, see Metrics.next_request
+            method,str: the method of the request
+            path,str: the path of the request
+
+            Return:
+            str: the path of the .prof file
+        '''
+        self.profile.disable()
+        os.makedirs(self.folder,exist_ok=True)
+        name = '%06d-%s-%s.prof'%(number,method,re.sub('[^A-Za-z0-9]+','_',path).strip('_') or 'root')
+        self.profile.dump_stats(os.path.join(self.folder,name))
+        return os.path.join(self.folder,name)
+
+
+metrics=Metrics()
+
+
+def span(stage):
+    '''
+        Times a stage of the hot path in the process-wide registry, see Metrics.span.
+    '''
+    return metrics.span(stage)
@@ -0,0 +1,500 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import ExtensionArray, ExtensionDtype, take
+from pandas.api.indexers import check_array_indexer
+from pandas.api.types import is_integer, is_list_like
+from vcf import SparseColumn
+
+
+MANIFEST='manifest.json'
+FORMAT_VERSION=2
+
+
+class StringDictionary:
+
+    '''
+        Distinct strings stored as a single utf-8 buffer and the offsets of the strings in it, sorted so that a string
+        is found by a binary search. Both are NumPy arrays that can be memory-mapped like the columns of a snapshot:
+        only the strings that are read are decoded.
+    '''
+
+    def __init__(self,offsets,buffer):
+        '''
+            Parameters:
+            offsets,ndarray: the int64 offset of every string in the buffer, followed by the size of the buffer
+            buffer,ndarray: the uint8 bytes of the strings
+        '''
+        self.offsets=offsets
+        self.buffer=buffer
+        self._view=memoryview(buffer) #slices of a memoryview are much cheaper than slices of a memmap
+
+    @classmethod
+    def load(cls,folder,name,mmap_mode):
+        '''
+            Return:
+            StringDictionary: the dictionary saved by save
+        '''
+        return cls(np.load(os.path.join(folder,name+'-offsets.npy'),mmap_mode=mmap_mode),
+                   np.load(os.path.join(folder,name+'-strings.npy'),mmap_mode=mmap_mode))
+
+    def save(self,folder,name):
+        '''
+            Saves the offsets and the buffer as the npy files <name>-offsets.npy and <name>-strings.npy.
+        '''
+        np.save(os.path.join(folder,name+'-offsets.npy'),self.offsets)
+        np.save(os.path.join(folder,name+'-strings.npy'),self.buffer)
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes+self.buffer.nbytes
+
+    def __getitem__(self,code):
+        '''
+            Return:
+            str: the string having the given code
+        '''
+        return bytes(self._view[self.offsets[code]:self.offsets[code+1]]).decode('utf-8','surrogatepass')
+
+    def strings(self,codes):
+        '''
+            Decodes many strings at once, the buffer being read in one go when most of the strings are decoded.
+
+            Parameters:
+            codes,ndarray: the codes of the strings
+
+            Return:
+            list: the strings
+        '''
+        buffer = bytes(self._view) if len(codes) > len(self)//8 else self._view
+        starts,stops = self.offsets[codes].tolist(),self.offsets[codes+1].tolist()
+        return [bytes(buffer[start:stop]).decode('utf-8','surrogatepass') for start,stop in zip(starts,stops)]
+
+    def search(self,key):
+        '''
+            Return:
+            int: the code of the first string that is not below a key given as utf-8 bytes, len(self) if there is none
+        '''
+        low,high = 0,len(self)
+        while low < high:
+            middle = (low+high)//2
+            if bytes(self._view[self.offsets[middle]:self.offsets[middle+1]]) < key:
+                low = middle+1
+            else:
+                high = middle
+        return low
+
+    def get_loc(self,key):
+        '''
+            Return:
+            int: the code of a string, -1 if the dictionary does not have it
+        '''
+        if not isinstance(key,str):
+            return -1
+        key = key.encode('utf-8','surrogatepass')
+        code = self.search(key)
+        return code if code < len(self) and bytes(self._view[self.offsets[code]:self.offsets[code+1]]) == key else -1
+
+    def __contains__(self,key):
+        return self.get_loc(key) >= 0
+
+    def get_indexer(self,keys):
+        '''
+            Return:
+            ndarray: the code of every key, -1 for the keys the dictionary does not have
+        '''
+        return np.array([self.get_loc(key) for key in keys],dtype=np.int64)
+
+    def decode(self,codes,others=()):
+        '''
+            Decodes an array of codes, every distinct code once.
+
+            Parameters:
+            codes,ndarray: the codes, -1 for missing values and len(self)+i for others[i]
+            others,list: the values that are not in the dictionary
+
+            Return:
+            ndarray: the values as python objects, None for missing values, with the shape of the codes
+        '''
+        codes = np.asarray(codes)
+        uniques,inverse = np.unique(codes,return_inverse=True)
+        values = np.empty(len(uniques),dtype=object)
+        known = np.flatnonzero((uniques >= 0) & (uniques < len(self)))
+        for i,value in zip(known.tolist(),self.strings(uniques[known])):
+            values[i] = value
+        for i in np.flatnonzero(uniques >= len(self)).tolist():
+            values[i] = others[uniques[i]-len(self)]
+        return values.take(inverse).reshape(codes.shape)
+
+
+def _encode(values):
+    '''
+        Dictionary-encodes a column of python objects: the distinct strings go to a StringDictionary, the other
+        distinct values (e.g. numbers written through the api) are kept aside.
+
+        Parameters:
+        values,array: the column, of any shape
+
+        Return:
+        codes,ndarray: the int32 code of every cell, -1 for missing values and len(dictionary)+i for others[i]
+        dictionary,StringDictionary: the distinct strings
+        others,list: the distinct values that are not strings
+    '''
+    values = np.asarray(values,dtype=object)
+    codes,uniques = pd.factorize(values.ravel())
+    is_string = np.array([isinstance(x,str) for x in uniques],dtype=bool)
+    encoded = np.array([x.encode('utf-8','surrogatepass') for x in uniques[is_string]],dtype=object)
+    order = np.argsort(encoded,kind='stable')
+    #new code of every distinct value, the trailing -1 being taken by the missing values
+    mapping = np.full(len(uniques)+1,-1,dtype=np.int32)
+    mapping[np.flatnonzero(is_string)[order]] = np.arange(len(order))
+    mapping[np.flatnonzero(~is_string)] = len(order)+np.arange((~is_string).sum())
+    offsets = np.zeros(len(order)+1,dtype=np.int64)
+    np.cumsum([len(x) for x in encoded[order]],out=offsets[1:])
+    buffer = np.frombuffer(b''.join(encoded[order]),dtype=np.uint8)
+    others = [x.item() if isinstance(x,np.generic) else x for x in uniques[~is_string]]
+    return mapping.take(codes).reshape(values.shape),StringDictionary(offsets,buffer),others
+
+
+def _merged(values):
+    '''
+        Encodes a DictionaryArray again without decoding its dictionary: the strings of its other values are inserted
+        into a copy of the dictionary and the strings that no row uses any more are left out.
+
+        Parameters:
+        values,DictionaryArray: the column
+
+        Return:
+        codes,ndarray: see _encode
+        dictionary,StringDictionary: the distinct strings
+        others,list: the distinct values that are not strings
+    '''
+    dictionary,codes,size = values.dictionary,np.asarray(values.codes),len(values.dictionary)
+    others = np.empty(len(values.others),dtype=object)
+    others[:] = values.others
+    used = np.zeros(size+len(others),dtype=bool)
+    used[codes[codes >= 0]] = True
+    kept = used[:size]
+    is_string = np.array([isinstance(x,str) for x in others],dtype=bool)
+    new = np.flatnonzero(used[size:] & is_string)
+    encoded = np.array([x.encode('utf-8','surrogatepass') for x in others[new]],dtype=object)
+    order = np.argsort(encoded,kind='stable')
+    new,encoded = new[order],encoded[order]
+    #a new string goes before the string of the dictionary found at its insertion point
+    points = np.array([dictionary.search(x) for x in encoded],dtype=np.int64)
+    before = np.concatenate([[0],np.cumsum(kept)])
+    mapping = np.full(size+len(others)+1,-1,dtype=np.int32)
+    mapping[:size][kept] = (before[:-1]+np.searchsorted(points,np.arange(size),side='right'))[kept]
+    mapping[size+new] = before[points]+np.arange(len(new))
+    strings = before[-1]+len(new)
+    rest = np.flatnonzero(used[size:] & ~is_string)
+    mapping[size+rest] = strings+np.arange(len(rest))
+    lengths,new_lengths = np.diff(dictionary.offsets),np.array([len(x) for x in encoded],dtype=np.int64)
+    merged_lengths = np.zeros(strings,dtype=np.int64)
+    merged_lengths[mapping[:size][kept]] = lengths[kept]
+    merged_lengths[mapping[size+new]] = new_lengths
+    offsets = np.zeros(strings+1,dtype=np.int64)
+    np.cumsum(merged_lengths,out=offsets[1:])
+    buffer = np.asarray(dictionary.buffer)[np.repeat(kept,lengths)]
+    bytes_before = np.concatenate([[0],np.cumsum(lengths*kept)])
+    buffer = np.insert(buffer,np.repeat(bytes_before[points],new_lengths),np.frombuffer(b''.join(encoded),dtype=np.uint8))
+    return mapping.take(codes),StringDictionary(offsets,buffer),list(others[rest])
+
+
+class DictionaryDtype(ExtensionDtype):
+
+    '''
+        The pandas type of the string columns read from a snapshot, see DictionaryArray.
+    '''
+
+    name='dictionary'
+    type=str
+    kind='O'
+    na_value=None
+
+    @classmethod
+    def construct_array_type(cls):
+        return DictionaryArray
+
+    def _get_common_dtype(self,dtypes):
+        #object columns concatenated with a string column of a snapshot are encoded with its dictionary
+        return self if all(isinstance(dtype,DictionaryDtype) or dtype == object for dtype in dtypes) else None
+
+
+class DictionaryArray(ExtensionArray):
+
+    '''
+        A string column of a snapshot: the memory-mapped codes of its values in a StringDictionary, so that
+        loading the column decodes nothing and only the rows that are read are decoded.
+        Values written afterwards that the dictionary does not have are appended to a list of other values.
+    '''
+
+    def __init__(self,codes,dictionary,others=None):
+        '''
+            Parameters:
+            codes,ndarray: the int32 codes, -1 for missing values and len(dictionary)+i for others[i]
+            dictionary,StringDictionary: the distinct strings
+            others,list: optional, the values that are not in the dictionary, shared with the arrays taken from this one
+        '''
+        self.codes=codes
+        self.dictionary=dictionary
+        self.others=[] if others is None else others
+
+    @classmethod
+    def _from_sequence(cls,scalars,dtype=None,copy=False):
+        return cls(*_encode(scalars))
+
+    @classmethod
+    def _from_factorized(cls,values,original):
+        return cls._from_sequence(values)
+
+    @classmethod
+    def _concat_same_type(cls,to_concat):
+        first = to_concat[0]
+        if all(x.dictionary is first.dictionary and x.others is first.others for x in to_concat):
+            return cls(np.concatenate([x.codes for x in to_concat]),first.dictionary,first.others)
+        #the distinct values of the other arrays are given codes in the dictionary of the first one
+        result = cls(None,first.dictionary,list(first.others))
+        codes=[]
+        for x in to_concat:
+            if x is first:
+                codes.append(x.codes)
+                continue
+            uniques,inverse = np.unique(x.codes,return_inverse=True)
+            mapping = np.array([result._code(x._value(code)) for code in uniques.tolist()],dtype=np.int32)
+            codes.append(mapping.take(inverse).reshape(x.codes.shape))
+        result.codes = np.concatenate(codes).astype(np.int32,copy=False)
+        return result
+
+    @property
+    def dtype(self):
+        return DictionaryDtype()
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes+self.dictionary.nbytes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def decode(self):
+        '''
+            Return:
+            ndarray: the values as python objects, None for missing values
+        '''
+        return self.dictionary.decode(self.codes,self.others)
+
+    def __array__(self,dtype=None):
+        return np.asarray(self.decode(),dtype=dtype)
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def _value(self,code):
+        if code < 0:
+            return None
+        return self.dictionary[code] if code < len(self.dictionary) else self.others[code-len(self.dictionary)]
+
+    def _code(self,value):
+        '''
+            Return:
+            int: the code of a value, which is appended to the other values if needed
+        '''
+        if pd.isna(value):
+            return -1
+        code = self.dictionary.get_loc(value)
+        if code >= 0:
+            return code
+        for i,other in enumerate(self.others):
+            if type(other) is type(value) and other == value:
+                return len(self.dictionary)+i
+        self.others.append(value)
+        return len(self.dictionary)+len(self.others)-1
+
+    def __getitem__(self,item):
+        if is_integer(item):
+            return self._value(int(self.codes[item]))
+        if not isinstance(item,slice):
+            item = check_array_indexer(self,item)
+        return DictionaryArray(self.codes[item],self.dictionary,self.others)
+
+    def __setitem__(self,key,value):
+        if not is_integer(key) and not isinstance(key,slice):
+            key = check_array_indexer(self,key)
+        self.codes[key] = [self._code(x) for x in value] if is_list_like(value) else self._code(value)
+
+    def __eq__(self,other):
+        if isinstance(other,str):
+            code = self.dictionary.get_loc(other)
+            equal = self.codes == code if code >= 0 else np.zeros(len(self),dtype=bool)
+            for i,value in enumerate(self.others):
+                if value == other:
+                    equal |= self.codes == len(self.dictionary)+i
+            return equal
+        return self.decode() == (np.asarray(other,dtype=object) if is_list_like(other) else other)
+
+    def isna(self):
+        return self.codes < 0
+
+    def take(self,indices,allow_fill=False,fill_value=None):
+        fill = -1 if fill_value is None or pd.isna(fill_value) else self._code(fill_value)
+        return DictionaryArray(take(self.codes,indices,allow_fill=allow_fill,fill_value=fill),self.dictionary,self.others)
+
+    def copy(self):
+        return DictionaryArray(self.codes.copy(),self.dictionary,list(self.others))
+
+    def _values_for_factorize(self):
+        return self.decode(),None
+
+
+def _save_strings(values,folder,name,entry):
+    '''
+        Saves a column of python objects as its dictionary codes (<name>.npy) and its StringDictionary,
+        the values that are not strings being stored in the manifest entry.
+
+        Return:
+        ndarray: the codes
+    '''
+    codes,dictionary,others = _merged(values) if isinstance(values,DictionaryArray) else _encode(values)
+    dictionary.save(folder,name)
+    entry['kind'] = 'dictionary'
+    entry['others'] = others
+    np.save(os.path.join(folder,name+'.npy'),codes)
+    return codes
+
+
+def write_snapshot(df,folder,header=None,parsed=None):
+    '''
+        Writes a typed dataset as a binary columnar snapshot: one NumPy .npy file per column that can be memory-mapped.
+        Categorical columns are stored as their codes, their categories being stored in the manifest with the vcf header.
+        String columns are stored as codes in a StringDictionary saved next to them, so that their distinct strings
+        are memory-mapped too.
+        The parsed INFO and FORMAT keys are stored the same way, as the labels and the values of their sparse columns.
+        The snapshot is written to a temporary folder that is renamed once complete.
+
+        Parameters:
+        df,DataFrame: the typed dataset, see vcf.to_columnar
+        folder,str: the folder of the snapshot, which must not exist yet
+        header,VcfHeader: optional, the header of the vcf file the dataset was imported from
+        parsed,dict: optional, the SparseColumn of every (column,key) pair, see vcf.parse_columns
+    '''
+    tmp_folder = folder+'.tmp'
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    manifest = {'version':FORMAT_VERSION,'rows':df.shape[0],'columns':[],
+                'header':None if header is None else {'lines':header.lines,'columns':header.columns}}
+    np.save(os.path.join(tmp_folder,'index.npy'),df.index.values.astype(np.int64))
+    for i,col in enumerate(df.columns):
+        values = df[col]
+        entry = {'name':col,'file':'c%d.npy'%i}
+        if isinstance(values.dtype,pd.CategoricalDtype):
+            entry['kind'] = 'categorical'
+            entry['categories'] = [x.item() if isinstance(x,np.generic) else x for x in values.cat.categories]
+            np.save(os.path.join(tmp_folder,entry['file']),values.cat.codes.values)
+        elif values.dtype == object or isinstance(values.dtype,DictionaryDtype):
+            _save_strings(values.values,tmp_folder,'c%d'%i,entry)
+        else:
+            entry['kind'] = 'numeric'
+            np.save(os.path.join(tmp_folder,entry['file']),values.values)
+        manifest['columns'].append(entry)
+    if parsed is not None:
+        manifest['parsed']=[]
+        for i,((column,key),sparse) in enumerate(parsed.items()):
+            entry = {'column':column,'key':key,'type':sparse.type,'labels':'p%d-labels.npy'%i,'file':'p%d.npy'%i}
+            np.save(os.path.join(tmp_folder,entry['labels']),sparse.labels.astype(np.int64))
+            if sparse.dictionary is not None:
+                _save_strings(DictionaryArray(sparse.values,sparse.dictionary),tmp_folder,'p%d'%i,entry)
+            elif sparse.values.dtype == object:
+                _save_strings(sparse.values,tmp_folder,'p%d'%i,entry)
+            else:
+                entry['kind'] = 'numeric'
+                np.save(os.path.join(tmp_folder,entry['file']),sparse.values)
+            manifest['parsed'].append(entry)
+    with open(os.path.join(tmp_folder,MANIFEST),'w') as f:
+        json.dump(manifest,f)
+    for name in os.listdir(tmp_folder):
+        with open(os.path.join(tmp_folder,name),'rb') as f:
+            os.fsync(f.fileno())
+    os.rename(tmp_folder,folder)
+
+
+def _read_manifest(folder):
+    with open(os.path.join(folder,MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest['version'] > FORMAT_VERSION:
+        raise ValueError('Unsupported snapshot version %s'%manifest['version'])
+    return manifest
+
+
+def read_snapshot(folder,mmap=True):
+    '''
+        Loads a snapshot written by write_snapshot.
+        Every column is memory-mapped (copy-on-write) with the index: numeric columns, categorical codes, and the codes
+        and the dictionaries of the string columns, which are read as DictionaryArray columns decoding only the rows
+        that are read. Loading is near-instant and the pages are shared through the OS page cache by every process
+        reading the snapshot. The string columns of version 1 snapshots, whose distinct values are in the manifest,
+        are decoded when loaded.
+
+        Parameters:
+        folder,str: the folder of the snapshot
+        mmap,bool: False to read the columns into memory instead
+
+        Return:
+        df,DataFrame: the typed dataset
+        header,dict: the 'lines' and 'columns' of the vcf header, None if the snapshot has no header
+    '''
+    manifest = _read_manifest(folder)
+    mmap_mode = 'c' if mmap else None
+    columns={}
+    for i,entry in enumerate(manifest['columns']):
+        data = np.load(os.path.join(folder,entry['file']),mmap_mode=mmap_mode)
+        if entry['kind'] == 'categorical':
+            columns[entry['name']] = pd.Categorical.from_codes(data,dtype=pd.CategoricalDtype(entry['categories']))
+        elif entry['kind'] == 'dictionary':
+            columns[entry['name']] = DictionaryArray(data,StringDictionary.load(folder,'c%d'%i,mmap_mode),list(entry['others']))
+        elif entry['kind'] == 'strings':
+            uniques = np.array(entry['values']+[None],dtype=object)
+            #missing values have code -1, which picks the trailing None
+            columns[entry['name']] = uniques.take(data)
+        else:
+            columns[entry['name']] = data
+    index = pd.Index(np.load(os.path.join(folder,'index.npy'),mmap_mode=mmap_mode))
+    #the columns are in the order of the manifest, naming them again would make pandas copy them as objects
+    df = pd.DataFrame(columns,index=index,copy=False)
+    return df,manifest['header']
+
+
+def read_parsed(folder,mmap=True):
+    '''
+        Loads the parsed INFO and FORMAT keys of a snapshot written by write_snapshot, memory-mapped like its columns.
+        The values of string keys stay codes in their StringDictionary, decoded by SparseColumn.take.
+
+        Parameters:
+        folder,str: the folder of the snapshot
+        mmap,bool: False to read the values into memory instead
+
+        Return:
+        dict: the SparseColumn of every (column,key) pair, None if the snapshot was written without them
+    '''
+    manifest = _read_manifest(folder)
+    if 'parsed' not in manifest:
+        return None
+    mmap_mode = 'c' if mmap else None
+    parsed={}
+    for i,entry in enumerate(manifest['parsed']):
+        labels = np.load(os.path.join(folder,entry['labels']),mmap_mode=mmap_mode)
+        values = np.load(os.path.join(folder,entry['file']),mmap_mode=mmap_mode)
+        dictionary = None
+        if entry['kind'] == 'dictionary':
+            #the values of parsed keys are all strings, the dictionary has them all
+            dictionary = StringDictionary.load(folder,'p%d'%i,mmap_mode)
+        elif entry['kind'] == 'strings':
+            values = np.array(entry['values']+[None],dtype=object).take(values)
+        parsed[(entry['column'],entry['key'])] = SparseColumn(entry['type'],labels,values,dictionary)
+    return parsed
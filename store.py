@@ -0,0 +1,1817 @@
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import pandas as pd
+from metrics import span
+from snapshot import DictionaryArray, DictionaryDtype, read_parsed, read_snapshot, write_snapshot
+from vcf import NUMERIC_TYPES, SparseColumn, VcfHeader, field_definitions, ingest, open_vcf, parse_columns, read_header, to_columnar
+try:
+    import fcntl
+except ImportError: #not available on Windows, where only the in-process locking is used
+    fcntl = None
+
+
+DATASET_PATH='./NA12877_API_10.vcf' #default location of the "database"
+
+
+def base_path(path):
+    '''
+        Returns the path of a dataset file without its extension(s), used to name the files kept next to it.
+
+        Parameters:
+        path,str: The path to the dataset file, e.g. ./sample.vcf or ./sample.vcf.gz
+
+        Return:
+        str: The path without extension, e.g. ./sample
+    '''
+    if path.endswith('.gz'):
+        path = path[:-3]
+    return os.path.splitext(path)[0]
+
+
+def csv_path_for(path):
+    '''
+        Returns the path of the csv copy that is kept next to a vcf dataset.
+
+        Parameters:
+        path,str: The path to the dataset file
+
+        Return:
+        str: The path of the csv version of the dataset
+    '''
+    return base_path(path)+'.csv'
+
+
+def atomic_write(path,write,before_replace=None,mode='w'):
+    '''
+        Writes a file through a temporary file of the same folder that is fsynced and then renamed over the target,
+        so that readers only ever see the old or the new version of the file, never a truncated one.
+
+        Parameters:
+        path,str: The path of the file to write
+        write,function: called with the open temporary file to write its content
+        before_replace,function: optional, called with the path of the complete temporary file right before the rename
+        mode,str: 'w' to write text, 'wb' to write bytes
+    '''
+    fd,tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),prefix=os.path.basename(path)+'.',suffix='.tmp')
+    try:
+        with os.fdopen(fd,mode,**({} if 'b' in mode else {'newline':''})) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if before_replace is not None:
+            before_replace(tmp_path)
+        os.replace(tmp_path,path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_vcf(path):
+    '''
+            Auxiliary function used to import the "database" from text.
+            If a csv version of the dataset exists next to the vcf file then the function will read in that file,
+            otherwise the vcf file (plain or gzip/bgzip compressed) is streamed in chunks, see vcf.ingest.
+            The store keeps the imported dataset as a binary snapshot, see VariantStore.
+
+            Parameters:
+            path,str: The path to the dataset file
+
+            Return:
+            df,DataFrame: A pandas DataFrame containing the dataset's data, in its typed representation (see vcf.to_columnar)
+        '''
+    csv_path = csv_path_for(path)
+    if os.path.exists(csv_path):
+        df = to_columnar(pd.read_csv(csv_path))
+    else:
+        df,_,_ = ingest(path)
+    return df
+
+
+def _position(pos):
+    '''
+        Normalizes a POS value so that text and numeric positions share the same index key.
+
+        Parameters:
+        pos: the POS value as found in the dataset or in a request
+
+        Return:
+        int or str: the integer position, or the value itself if it is not a number
+    '''
+    try:
+        return int(pos)
+    except (TypeError,ValueError):
+        return pos
+
+
+def _with_categories(dtype,values):
+    '''
+        Appends the values missing from the categories of a categorical type, so that the codes of the values
+        already written keep designating the same categories.
+
+        Parameters:
+        dtype,CategoricalDtype: the type
+        values,array: the values, missing values being left out
+
+        Return:
+        CategoricalDtype: the type itself if it has all the values, otherwise a new type
+    '''
+    uniques = pd.unique(pd.Series(values,dtype=object).dropna())
+    missing = uniques[dtype.categories.get_indexer(uniques) < 0]
+    if len(missing) == 0:
+        return dtype
+    return pd.CategoricalDtype(dtype.categories.append(pd.Index(missing,dtype=dtype.categories.dtype)))
+
+
+def _typed_values(dtypes,values):
+    '''
+        Prepares new values for the columns of a typed dataset so that writes keep the column types:
+        categories are added to categorical columns when needed and values of numeric columns are converted
+        (missing or non numeric values become NaN).
+
+        Parameters:
+        dtypes,dict: the types of the columns of the dataset, whose categorical types may be given new categories
+        values,dict: the new values by column
+
+        Return:
+        dict: the converted values, without the values of columns the dataset does not have
+    '''
+    typed={}
+    for col,value in values.items():
+        if col not in dtypes:
+            continue
+        dtype = dtypes[col]
+        if isinstance(dtype,pd.CategoricalDtype):
+            dtypes[col] = _with_categories(dtype,[value])
+        elif dtype.kind == 'f':
+            value = pd.to_numeric(pd.Series([value]),errors='coerce').astype(dtype).iloc[0]
+        elif dtype.kind == 'i':
+            value = pd.to_numeric(value)
+        typed[col]=value
+    return typed
+
+
+def _rows_frame(dtypes,labels,rows):
+    '''
+        Builds a DataFrame of new rows with the columns and the column types of a typed dataset.
+        The new categories of the categorical columns are added to their types once for all the rows.
+
+        Parameters:
+        dtypes,dict: the types of the columns of the dataset, whose categorical types may be given new categories
+        labels,list: the labels of the new rows
+        rows,list: the values of the new rows, as dicts having all the columns of the dataset
+
+        Return:
+        DataFrame: the new rows
+    '''
+    columns={}
+    for col,dtype in dtypes.items():
+        values = pd.Series([row[col] for row in rows],dtype=object)
+        if isinstance(dtype,pd.CategoricalDtype):
+            dtype = dtypes[col] = _with_categories(dtype,values)
+            columns[col] = pd.Categorical.from_codes(dtype.categories.get_indexer(values),dtype=dtype)
+        elif dtype.kind == 'i':
+            values = pd.to_numeric(values).values
+            limits = np.iinfo(dtype)
+            #positions that do not fit the column type upcast it when the rows are read with the other ones
+            if values.dtype.kind == 'i' and (len(values) == 0 or (values.min() >= limits.min and values.max() <= limits.max)):
+                values = values.astype(dtype)
+            columns[col] = values
+        elif dtype.kind == 'f':
+            columns[col] = pd.to_numeric(values,errors='coerce').astype(dtype).values
+        else:
+            columns[col] = values.values
+    return pd.DataFrame(columns,index=labels)
+
+
+def _widened(values,width):
+    '''
+        Return:
+        ndarray: the values of a SparseColumn padded with missing values to the given number of columns
+    '''
+    if values.shape[1] >= width:
+        return values
+    padding = np.full((values.shape[0],width-values.shape[1]),np.nan if values.dtype.kind == 'f' else None,dtype=values.dtype)
+    return np.hstack([values,padding])
+
+
+class LabelMap:
+
+    '''
+        Maps keys to the labels of the rows having them.
+        The map built when the dataset is loaded is a compact array layout computed with pandas/NumPy primitives
+        (factorize and argsort), so that building it stays fast on millions of rows; the rows added and removed
+        afterwards are kept in a small dictionary and a set until the next load.
+        Keys read from a snapshot are already dictionary encoded: their memory-mapped dictionary is searched
+        without decoding the keys.
+    '''
+
+    def __init__(self,keys,labels):
+        '''
+            Parameters:
+            keys,array: the key of every row
+            labels,ndarray: the label of every row
+        '''
+        self._added = {}
+        self._removed = set()
+        if isinstance(keys,DictionaryArray):
+            self._keys = keys.dictionary
+            #the keys that are not in the dictionary are added like the keys of new rows
+            others = np.flatnonzero(keys.codes >= len(keys.dictionary))
+            for key,label in zip(keys[others],labels[others].tolist()):
+                self.add(key,label)
+            codes = np.where(keys.codes >= len(keys.dictionary),-1,keys.codes)
+        else:
+            codes,uniques = pd.factorize(keys)
+            self._keys = pd.Index(uniques)
+        order = np.argsort(codes,kind='stable')
+        self._labels = labels[order]
+        #the labels of the key with code c are self._labels[self._offsets[c]:self._offsets[c+1]]
+        self._offsets = np.searchsorted(codes[order],np.arange(len(self._keys)+1))
+
+    def get(self,key):
+        '''
+            Return:
+            list: the labels of the rows having the key
+        '''
+        labels = []
+        if key in self._keys:
+            code = self._keys.get_loc(key)
+            labels = [label for label in self._labels[self._offsets[code]:self._offsets[code+1]].tolist() if label not in self._removed]
+        return labels+self._added.get(key,[])
+
+    def get_many(self,keys):
+        '''
+            Looks up many keys at once, the keys of the compact layout being hashed in a single vectorized call.
+
+            Parameters:
+            keys,list: the keys
+
+            Return:
+            list: for every key, the labels of the rows having it
+        '''
+        codes = self._keys.get_indexer(pd.Index(keys,dtype=object)) if len(keys) else []
+        result=[]
+        for key,code in zip(keys,codes):
+            labels = [] if code < 0 else [label for label in self._labels[self._offsets[code]:self._offsets[code+1]].tolist() if label not in self._removed]
+            result.append(labels+self._added.get(key,[]))
+        return result
+
+    def add(self,key,label):
+        '''
+            Maps a key to the label of a row.
+        '''
+        self._added.setdefault(key,[]).append(label)
+
+    def remove(self,key,label):
+        '''
+            Removes the label of a row from the labels of a key.
+        '''
+        added = self._added.get(key,[])
+        if label in added:
+            added.remove(label)
+            if not added:
+                del self._added[key]
+        else:
+            self._removed.add(label)
+
+
+class VariantIndex:
+
+    '''
+        Hash index over a dataset: it maps every ID and every (CHROM,POS) pair to the labels of its rows.
+        Lookups cost the same no matter how many entries the dataset holds.
+        Row labels are expected to be given in increasing order to the rows added after the index is built.
+    '''
+
+    def __init__(self,data):
+        '''
+            Parameters:
+            data,DataFrame: the dataset to index
+        '''
+        labels = data.index.values.astype(np.int64)
+        chrom_codes,chroms = pd.factorize(data['CHROM'])
+        positions = data['POS'].values.astype(np.int64)
+        self._chrom_codes = {chrom:code for code,chrom in enumerate(chroms)}
+        self.ids = LabelMap(data['ID'].values,labels)
+        self.positions = LabelMap(self._position_keys(chrom_codes,positions),labels)
+        #per chromosome arrays of positions and labels, sorted by (POS,label), used for region queries
+        self.chromosomes = {}
+        order = np.lexsort((labels,positions,chrom_codes))
+        bounds = np.searchsorted(chrom_codes[order],np.arange(len(chroms)+1))
+        for code,chrom in enumerate(chroms):
+            rows = order[bounds[code]:bounds[code+1]]
+            self.chromosomes[chrom] = (positions[rows],labels[rows])
+
+    def _position_keys(self,chrom_codes,positions):
+        '''
+            Combines chromosome codes and positions into single integer keys.
+
+            Parameters:
+            chrom_codes,ndarray or int: the codes of the chromosomes
+            positions,ndarray or int: the positions
+
+            Return:
+            ndarray or int: the keys
+        '''
+        return chrom_codes*(1<<40)+positions
+
+    def _position_key(self,chrom,pos):
+        '''
+            Return:
+            int: the key of a chromosome position, a new chromosome being given a new code
+        '''
+        code = self._chrom_codes.setdefault(chrom,len(self._chrom_codes))
+        return self._position_keys(code,int(pos))
+
+    def add(self,label,row):
+        '''
+            Adds a row to the index.
+
+            Parameters:
+            label,int: the label of the row in the dataset
+            row,dict or Series: the ID, CHROM and POS values of the row
+        '''
+        pos = int(row['POS'])
+        self.ids.add(row['ID'],label)
+        self.positions.add(self._position_key(row['CHROM'],pos),label)
+        positions,labels = self.chromosomes.get(row['CHROM'],(np.empty(0,np.int64),np.empty(0,np.int64)))
+        #rows sharing a position stay sorted by label, an updated row keeping its label
+        first,last = np.searchsorted(positions,pos,side='left'),np.searchsorted(positions,pos,side='right')
+        at = first+np.searchsorted(labels[first:last],label)
+        self.chromosomes[row['CHROM']] = (np.insert(positions,at,pos),np.insert(labels,at,label))
+
+    def add_many(self,labels,rows):
+        '''
+            Adds many rows to the index, the sorted arrays of every chromosome being rebuilt once
+            instead of once per row.
+
+            Parameters:
+            labels,list: the labels of the rows in the dataset, in increasing order
+            rows,list: the ID, CHROM and POS values of the rows, as dicts
+        '''
+        added={}
+        for label,row in zip(labels,rows):
+            pos = int(row['POS'])
+            self.ids.add(row['ID'],label)
+            self.positions.add(self._position_key(row['CHROM'],pos),label)
+            added.setdefault(row['CHROM'],[]).append((pos,label))
+        for chrom,entries in added.items():
+            positions,chrom_labels = self.chromosomes.get(chrom,(np.empty(0,np.int64),np.empty(0,np.int64)))
+            entries = np.array(entries,dtype=np.int64)
+            positions = np.concatenate([positions,entries[:,0]])
+            chrom_labels = np.concatenate([chrom_labels,entries[:,1]])
+            order = np.lexsort((chrom_labels,positions))
+            self.chromosomes[chrom] = (positions[order],chrom_labels[order])
+
+    def remove(self,label,row):
+        '''
+            Removes a row from the index.
+
+            Parameters:
+            label,int: the label of the row in the dataset
+            row,dict or Series: the ID, CHROM and POS values the row was indexed with
+        '''
+        pos = int(row['POS'])
+        self.ids.remove(row['ID'],label)
+        self.positions.remove(self._position_key(row['CHROM'],pos),label)
+        if row['CHROM'] in self.chromosomes:
+            positions,labels = self.chromosomes[row['CHROM']]
+            first,last = np.searchsorted(positions,pos,side='left'),np.searchsorted(positions,pos,side='right')
+            at = first+np.flatnonzero(labels[first:last] == label)
+            if len(at) > 0:
+                self.chromosomes[row['CHROM']] = (np.delete(positions,at),np.delete(labels,at))
+
+    def lookup_id(self,id):
+        '''
+            Return:
+            list: the labels of the rows having the given id
+        '''
+        return self.ids.get(id)
+
+    def lookup_ids(self,ids):
+        '''
+            Return:
+            list: for every id, the labels of the rows having it
+        '''
+        return self.ids.get_many(ids)
+
+    def lookup_position(self,chrom,pos):
+        '''
+            Return:
+            list: the labels of the rows at the given chromosome position
+        '''
+        pos = _position(pos)
+        if chrom not in self._chrom_codes or not isinstance(pos,int):
+            return []
+        return self.positions.get(self._position_key(chrom,pos))
+
+    def lookup_region(self,chrom,start=None,end=None):
+        '''
+            Finds the rows of a chromosome region with a binary search on the sorted positions.
+
+            Parameters:
+            chrom,str: the chromosome
+            start,int: the first position of the region (inclusive), None for the beginning of the chromosome
+            end,int: the last position of the region (inclusive), None for the end of the chromosome
+
+            Return:
+            ndarray: the labels of the rows in the region, sorted by position
+        '''
+        if chrom not in self.chromosomes:
+            return np.empty(0,np.int64)
+        positions,labels = self.chromosomes[chrom]
+        first = 0 if start is None else np.searchsorted(positions,start,side='left')
+        last = len(positions) if end is None else np.searchsorted(positions,end,side='right')
+        return labels[first:last]
+
+    def chromosome_order(self,chrom):
+        '''
+            Return:
+            int: the rank of a chromosome in the order of first appearance in the dataset, None if it is not in the dataset
+        '''
+        return self._chrom_codes.get(chrom)
+
+    def region_ranges(self,regions):
+        '''
+            Converts regions into ranges of the sorted arrays of their chromosomes, overlapping regions being merged.
+
+            Parameters:
+            regions,list: list of (chrom,start,end) tuples, see lookup_region
+
+            Return:
+            list: (chrom,ranges) tuples in chromosome order (see chromosome_order), ranges being a sorted list of
+                  disjoint (first,last) index ranges of self.chromosomes[chrom]
+        '''
+        by_chrom={}
+        for chrom,start,end in regions:
+            if chrom not in self.chromosomes:
+                continue
+            positions,_ = self.chromosomes[chrom]
+            first = 0 if start is None else np.searchsorted(positions,start,side='left')
+            last = len(positions) if end is None else np.searchsorted(positions,end,side='right')
+            if last > first:
+                by_chrom.setdefault(chrom,[]).append((int(first),int(last)))
+        result=[]
+        for chrom in sorted(by_chrom,key=self.chromosome_order):
+            merged=[]
+            for first,last in sorted(by_chrom[chrom]):
+                if merged and first <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0],max(merged[-1][1],last))
+                else:
+                    merged.append((first,last))
+            result.append((chrom,merged))
+        return result
+
+    def cursor_index(self,chrom,pos,label):
+        '''
+            Return:
+            int: the index of the first row of self.chromosomes[chrom] coming after the (pos,label) key
+        '''
+        positions,labels = self.chromosomes[chrom]
+        first,last = np.searchsorted(positions,pos,side='left'),np.searchsorted(positions,pos,side='right')
+        return int(first+np.searchsorted(labels[first:last],label,side='right'))
+
+
+class DeltaFrame:
+
+    '''
+        The in-memory dataset: the frame loaded from the snapshot (the base) and the changes written since then.
+        Inserted rows are appended to delta segments and deleted rows are only marked (tombstones), so that no write
+        copies the base, whose memory-mapped pages stay shared between the processes; updated values are written
+        in place. Reads take the rows from the base and the segments and leave the deleted ones out (the index only
+        returns rows that are not deleted), and the changes are merged into a new base by the compaction.
+        Consecutive segments are merged as soon as the last one is as big as the one before it, like the levels of a
+        log-structured merge tree, so that there are only a few segments and every row is copied a few times.
+        The categorical columns of the base and of the segments share their categories: new categories are appended
+        to the types of the dataset (see dtypes), the codes of the older rows staying valid. The string columns of
+        the base are dictionary encoded (see snapshot.DictionaryArray) and only decoded for the rows taken.
+    '''
+
+    def __init__(self,base):
+        '''
+            Parameters:
+            base,DataFrame: the dataset loaded from the snapshot, its labels being below the labels of the new rows
+        '''
+        self.base=base
+        self.segments=[] #frames of the inserted rows, each one holding consecutive labels, in increasing order
+        self.deleted=set()
+        #the types of the columns, categorical types holding all the categories, string columns being plain object columns
+        self.dtypes={col:np.dtype(object) if isinstance(dtype,DictionaryDtype) else dtype for col,dtype in base.dtypes.items()}
+        self._encoded=[col for col,dtype in base.dtypes.items() if isinstance(dtype,DictionaryDtype)]
+        self._starts=np.empty(0,np.int64) #the first label of every segment
+        self._deleted=None #the deleted labels as an array, built on demand
+        self._maxima={}
+
+    @property
+    def columns(self):
+        '''
+            Return:
+            Index: the columns of the dataset
+        '''
+        return self.base.columns
+
+    def __len__(self):
+        '''
+            Return:
+            int: the number of rows of the dataset, deleted rows left out
+        '''
+        return self.base.shape[0]+sum(segment.shape[0] for segment in self.segments)-len(self.deleted)
+
+    def memory_usage(self):
+        '''
+            Return:
+            int: the number of bytes of the columns and labels of the base and of the segments
+        '''
+        return int(sum(frame.memory_usage(index=True,deep=False).sum() for frame in [self.base]+self.segments))
+
+    def _latest(self,frame):
+        '''
+            Return:
+            DataFrame: the frame, its categorical columns being given all the categories of the dataset
+        '''
+        columns = {col:pd.Categorical.from_codes(frame[col].cat.codes.values,dtype=self.dtypes[col]) for col,dtype in frame.dtypes.items()
+                   if isinstance(dtype,pd.CategoricalDtype) and len(dtype.categories) != len(self.dtypes[col].categories)}
+        return frame.assign(**columns) if columns else frame
+
+    def _segment_of(self,labels):
+        '''
+            Return:
+            ndarray: for every label, 0 for the base and i for the segment self.segments[i-1]
+        '''
+        return np.searchsorted(self._starts,labels,side='right')
+
+    def take(self,labels,columns=None):
+        '''
+            Takes rows of the dataset, which must have the given labels (deleted rows included).
+            Rows of a single frame are taken from it directly, with the categories of that frame; rows spread over
+            the base and the segments are gathered column by column, categorical columns through their codes.
+
+            Parameters:
+            labels,ndarray: the labels
+            columns,list: optional, the columns taken, all of them by default
+
+            Return:
+            DataFrame: the rows, in the order of the labels
+        '''
+        labels = np.asarray(labels,dtype=np.int64)
+        segment = self._segment_of(labels)
+        parts,order = [],[]
+        for i,frame in enumerate([self.base]+self.segments):
+            rows = np.flatnonzero(segment == i)
+            if len(rows) > 0:
+                parts.append((frame,frame.index.get_indexer(labels[rows]) if i == 0 else labels[rows]-self._starts[i-1]))
+                order.append(rows)
+        if len(parts) == 1 or not self.segments:
+            frame,positions = parts[0] if parts else (self.base,[])
+            taken = frame.iloc[positions,slice(None) if columns is None else [frame.columns.get_loc(col) for col in columns]]
+            decoded = {col:taken[col].values.decode() for col in self._encoded if col in taken.columns} if frame is self.base else {}
+            return taken.assign(**decoded) if decoded else taken
+        #the rows of the parts are put back in the order of the labels
+        order = np.argsort(np.concatenate(order),kind='stable') if order else np.empty(0,np.int64)
+        taken={}
+        for col in (self.base.columns if columns is None else columns):
+            dtype = self.dtypes[col]
+            if isinstance(dtype,pd.CategoricalDtype):
+                codes = np.concatenate([frame[col].values.codes[positions] for frame,positions in parts]) if parts else np.empty(0,np.int8)
+                taken[col] = pd.Categorical.from_codes(codes[order],dtype=dtype)
+            else:
+                values = np.concatenate([frame[col].values[positions] for frame,positions in parts]) if parts else np.empty(0,dtype)
+                taken[col] = values[order]
+        return pd.DataFrame(taken,index=pd.Index(labels))
+
+    def alive(self,labels):
+        '''
+            Return:
+            ndarray: True for the labels of rows that are in the dataset and are not deleted
+        '''
+        labels = np.asarray(labels,dtype=np.int64)
+        segment = self._segment_of(labels)
+        alive = np.ones(len(labels),dtype=bool)
+        alive[segment == 0] = self.base.index.get_indexer(labels[segment == 0]) >= 0
+        if self.segments:
+            alive &= labels < self._starts[-1]+self.segments[-1].shape[0]
+        if self.deleted:
+            if self._deleted is None:
+                self._deleted = np.fromiter(self.deleted,dtype=np.int64,count=len(self.deleted))
+            alive &= ~np.isin(labels,self._deleted)
+        return alive
+
+    def keys(self,label):
+        '''
+            Returns the indexed fields of a row of the dataset.
+
+            Parameters:
+            label,int: the label of the row
+
+            Return:
+            dict: the ID, CHROM and POS values of the row
+        '''
+        segment = int(self._segment_of(label))
+        frame = self.base if segment == 0 else self.segments[segment-1]
+        return {col:frame.at[label,col] for col in ('ID','CHROM','POS')}
+
+    def append(self,labels,rows):
+        '''
+            Appends new rows as a new segment, merged with the previous segments while they are not bigger.
+
+            Parameters:
+            labels,list: the labels of the rows, consecutive and above all the labels of the dataset
+            rows,list: the rows, as dicts having all the columns of the dataset
+        '''
+        self.segments.append(_rows_frame(self.dtypes,labels,rows))
+        while len(self.segments) > 1 and self.segments[-2].shape[0] <= self.segments[-1].shape[0]:
+            last = self.segments.pop()
+            self.segments[-1] = pd.concat([self._latest(self.segments[-1]),self._latest(last)])
+        self._starts = np.array([segment.index[0] for segment in self.segments],dtype=np.int64)
+
+    def update(self,labels,values):
+        '''
+            Writes values in place in the rows having the given labels.
+
+            Parameters:
+            labels,list: the labels of the rows
+            values,dict: the values by column, see _typed_values
+        '''
+        labels = np.asarray(labels,dtype=np.int64)
+        segment = self._segment_of(labels)
+        for i in np.unique(segment):
+            frame = self.base if i == 0 else self.segments[i-1]
+            for col,value in values.items():
+                dtype = self.dtypes[col]
+                if isinstance(dtype,pd.CategoricalDtype) and len(frame[col].cat.categories) != len(dtype.categories):
+                    #only the frame written to is given the new categories
+                    frame[col] = frame[col].cat.add_categories(dtype.categories[len(frame[col].cat.categories):])
+                frame.loc[labels[segment == i],col] = value
+
+    def delete(self,labels):
+        '''
+            Marks rows as deleted.
+        '''
+        self.deleted.update(labels)
+        self._deleted = None
+
+    def next_value(self,col):
+        '''
+            Return:
+            int: the value following the largest value of an integer column, deleted rows included, 0 if the dataset is empty
+        '''
+        if col not in self._maxima:
+            self._maxima[col] = int(self.base[col].max()) if self.base.shape[0] > 0 else -1
+        return max([self._maxima[col]]+[int(segment[col].max()) for segment in self.segments])+1
+
+    def frame(self):
+        '''
+            Merges the changes into a single frame, e.g. to write a new snapshot, which copies the whole dataset.
+
+            Return:
+            DataFrame: the rows of the dataset that are not deleted, the base itself if there is no change
+        '''
+        if not self.segments and not self.deleted:
+            return self.base
+        frames = [self._latest(frame) for frame in [self.base]+self.segments]
+        labels = np.concatenate([frame.index.values for frame in frames])
+        keep = ~np.isin(labels,np.fromiter(self.deleted,dtype=np.int64,count=len(self.deleted))) if self.deleted else slice(None)
+        #the columns are concatenated one by one, the string columns of the base keeping their dictionary
+        columns = {col:pd.concat([frame[col] for frame in frames],ignore_index=True).values[keep] for col in self.base.columns}
+        return pd.DataFrame(columns,index=pd.Index(labels[keep]))
+
+
+class ReadWriteLock:
+
+    '''
+        Reader/writer lock: any number of threads can read at the same time while writers get exclusive access.
+        Waiting writers are served before new readers so that a steady flow of reads cannot starve them.
+        The thread holding the write lock can take it again and can also read.
+    '''
+
+    def __init__(self):
+        self._cond=threading.Condition()
+        self._readers=0
+        self._writer=None
+        self._writes=0
+        self._waiting_writers=0
+
+    @contextlib.contextmanager
+    def read(self):
+        '''
+            Holds the lock in shared mode for the duration of the with block.
+        '''
+        with self._cond:
+            if self._writer != threading.get_ident():
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+            self._readers+=1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers-=1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        '''
+            Holds the lock in exclusive mode for the duration of the with block.
+        '''
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._waiting_writers+=1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._waiting_writers-=1
+                self._writer=me
+            self._writes+=1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writes-=1
+                if self._writes == 0:
+                    self._writer=None
+                    self._cond.notify_all()
+
+
+class VariantStore:
+
+    '''
+        The VariantStore class keeps a dataset resident in memory so that it is parsed only once per process.
+        The dataset is kept on disk as a binary columnar snapshot (see snapshot.py) next to the vcf file: the first
+        load imports the vcf (or its legacy csv copy) and writes the snapshot, later loads memory-map it, which makes
+        the start of a worker near-instant and lets all the workers share its pages. The csv and vcf formats are only
+        used to import and export the dataset (see export).
+        The snapshots are versioned in generations, the CURRENT file naming the current one. That file is watched
+        through its (mtime,size,inode) signature and the dataset is reloaded only when that signature changes on disk.
+        Writes are applied to the in-memory copy directly.
+
+        Writes are not persisted by rewriting the snapshot: every batch of changes is appended to a change log
+        (one json operation per line) and fsynced before it is acknowledged. The log is merged into a new snapshot
+        generation by a background compaction, periodically or as soon as it grows past a size threshold.
+        Loading the dataset replays the log, so no acknowledged write is lost.
+
+        Within a process, lookups share a reader/writer lock so they run in parallel while writes are serialized.
+        A compaction writes the new generation while only holding the read lock (writes waiting meanwhile), and
+        takes the write lock just long enough to swap the dataset for the new generation, see compact.
+        Between processes (e.g. gunicorn workers) writes and reloads are serialized through a lock file, every
+        writer first catches up with the log entries of the other processes, and files are only ever replaced
+        through a temporary file and an atomic rename.
+    '''
+
+    def __init__(self,path,compact_bytes=16*1024*1024,compact_interval=300):
+        '''
+            Parameters:
+            path,str: The path to the vcf dataset file
+            compact_bytes,int: size of the change log above which a compaction is started
+            compact_interval,float: number of seconds between two background compactions
+        '''
+        self.path=path
+        self.csv_path=csv_path_for(path)
+        self.log_path=base_path(path)+'.log'
+        self.lock_path=base_path(path)+'.lock'
+        self.snapshot_path=base_path(path)+'.snapshot'
+        self.current_path=os.path.join(self.snapshot_path,'CURRENT')
+        self.compact_bytes=compact_bytes
+        self.compact_interval=compact_interval
+        self._lock=ReadWriteLock()
+        self._writing=threading.RLock()
+        self._file_locked=False
+        self._data=None
+        self._index=None
+        self._header=None
+        self._parsed=None
+        self._stale=set()
+        self._generation=None
+        self._signature=None
+        self._log_offset=0
+        self._next_label=0
+        self._compactor=None
+        self._compact_event=threading.Event()
+        self._closed=False
+        self._listeners=[]
+        self._changes=[]
+
+    def subscribe(self,listener):
+        '''
+            Registers a function called after every change of the in-memory dataset, whether the change was written
+            by this process or replayed from the change log of another one.
+
+            Parameters:
+            listener,function: called with the list of the (ID,CHROM,POS) values of the changed rows, before and after
+                               the change, or with None when the whole dataset was (re)loaded
+        '''
+        self._listeners.append(listener)
+
+    def _notify(self,changes):
+        '''
+            Calls the listeners registered with subscribe.
+        '''
+        for listener in self._listeners:
+            listener(changes)
+
+    def _snapshot_signature(self):
+        '''
+            Computes the signature of the file naming the current snapshot generation.
+
+            Return:
+            tuple: (mtime,size,inode) of the CURRENT file, None if no snapshot was written yet
+        '''
+        try:
+            st = os.stat(self.current_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns,st.st_size,st.st_ino)
+
+    def _log_size(self):
+        '''
+            Return:
+            int: the size of the change log, 0 if there is no log
+        '''
+        try:
+            return os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            return 0
+
+    @contextlib.contextmanager
+    def _file_lock(self,exclusive):
+        '''
+            Holds the lock file shared between processes for the duration of the with block.
+            It must be taken while holding self._writing, which serializes the threads changing the dataset
+            (before the reader/writer lock), and it is not taken again if this thread already holds it.
+
+            Parameters:
+            exclusive,bool: True to lock out every other process, False to only lock out exclusive holders
+        '''
+        if fcntl is None or self._file_locked:
+            yield
+            return
+        with open(self.lock_path,'a') as f:
+            fcntl.flock(f.fileno(),fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._file_locked=True
+            try:
+                yield
+            finally:
+                self._file_locked=False
+                fcntl.flock(f.fileno(),fcntl.LOCK_UN)
+
+    def refresh(self):
+        '''
+            Reloads the dataset if it has never been loaded or if a new snapshot generation was written,
+            and applies the operations appended to the change log since the last refresh.
+        '''
+        signature = self._snapshot_signature()
+        if self._data is not None and signature == self._signature and self._log_size() == self._log_offset:
+            return
+        #the first load of a dataset writes its snapshot, which is done by one process at a time
+        with self._writing, self._file_lock(exclusive=signature is None), self._lock.write():
+            signature = self._snapshot_signature()
+            if self._data is None or signature != self._signature:
+                with span('load'):
+                    self._load()
+            elif self._log_size() != self._log_offset:
+                with span('load'):
+                    self._replay_log()
+
+    def _load(self):
+        '''
+            Loads the current snapshot generation, importing the dataset first if it has no snapshot yet,
+            and replays the change log on top of it.
+        '''
+        self._header = None
+        try:
+            with open(self.current_path) as f:
+                generation = f.read().strip()
+        except FileNotFoundError:
+            generation = self._write_generation(read_vcf(self.path),self.header)
+            self._set_current(generation)
+        data,header = read_snapshot(os.path.join(self.snapshot_path,generation))
+        if header is not None:
+            self._header = VcfHeader(header['lines'],header['columns'])
+        self._parsed = read_parsed(os.path.join(self.snapshot_path,generation))
+        if self._parsed is None:
+            #the snapshot was written before the INFO and FORMAT keys were parsed with it, they are parsed once here
+            #under the write lock rather than by concurrent readers
+            self._parsed = parse_columns(data,self.header)
+        self._stale = set()
+        self._data = DeltaFrame(data)
+        self._index = VariantIndex(data)
+        self._next_label = int(data.index.max())+1 if data.shape[0]>0 else 0
+        self._generation = generation
+        self._signature = self._snapshot_signature()
+        self._log_offset = 0
+        self._replay_log(checkpointed=True)
+        self._notify(None)
+
+    def _write_generation(self,data,header):
+        '''
+            Writes a new snapshot generation, without making it the current one.
+            The INFO and FORMAT keys defined in the header are parsed and stored with it, see vcf.parse_columns.
+
+            Parameters:
+            data,DataFrame: the dataset
+            header,VcfHeader: the vcf header kept with the dataset, can be None
+
+            Return:
+            str: the name of the generation
+        '''
+        generation = 'gen-%d-%d'%(time.time_ns(),os.getpid())
+        os.makedirs(self.snapshot_path,exist_ok=True)
+        with span('persist'):
+            write_snapshot(data,os.path.join(self.snapshot_path,generation),header,parse_columns(data,header))
+        return generation
+
+    def _set_current(self,generation):
+        '''
+            Atomically makes a snapshot generation the current one and removes the older generations.
+            Processes that still have an older generation memory-mapped keep reading it until they reload.
+
+            Parameters:
+            generation,str: the name of the generation
+        '''
+        atomic_write(self.current_path,lambda f: f.write(generation))
+        for name in os.listdir(self.snapshot_path):
+            if name.startswith('gen-') and name != generation:
+                shutil.rmtree(os.path.join(self.snapshot_path,name),ignore_errors=True)
+
+    def _read_log(self,offset):
+        '''
+            Reads the complete operations written in the change log after the given offset.
+            A trailing line without newline belongs to a batch that was never acknowledged and is ignored.
+
+            Parameters:
+            offset,int: the position in the log where reading starts
+
+            Return:
+            ops,list: the operations read from the log
+            offset,int: the position in the log after the last complete operation
+        '''
+        ops=[]
+        try:
+            with open(self.log_path,'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    ops.append(json.loads(line))
+                    offset+=len(line)
+        except FileNotFoundError:
+            pass
+        return ops,offset
+
+    def _replay_log(self,checkpointed=False):
+        '''
+            Applies to the in-memory dataset the operations of the change log that it does not contain yet.
+
+            Parameters:
+            checkpointed,bool: True when the dataset was just read from disk, in which case the operations
+                               preceding a checkpoint of the current snapshot are already part of it and are skipped
+        '''
+        ops,self._log_offset = self._read_log(self._log_offset)
+        if checkpointed:
+            done = [i for i,op in enumerate(ops) if op['op'] == 'checkpoint' and op['snapshot'] == self._generation]
+            if done:
+                ops = ops[done[-1]+1:]
+        self._apply_all([op for op in ops if op['op'] != 'checkpoint'])
+
+    @property
+    def header(self):
+        '''
+            Return:
+            VcfHeader: the header of the vcf file, '##' metadata included, None if it is not known
+        '''
+        if self._header is None and os.path.exists(self.path):
+            with open_vcf(self.path) as f:
+                self._header = read_header(f)
+        return self._header
+
+    @property
+    def data(self):
+        '''
+            Return:
+            DataFrame: The up to date in-memory dataset, a copy merging the changes since the snapshot if there are some
+                       (see DeltaFrame.frame), which lookups (see rows) do not need
+        '''
+        self.refresh()
+        with self._lock.read():
+            return self._data.frame()
+
+    @property
+    def columns(self):
+        '''
+            Return:
+            Index: the columns of the dataset
+        '''
+        self.refresh()
+        return self._data.columns
+
+    @property
+    def resident_size(self):
+        '''
+            Return:
+            tuple: the number of rows and the number of bytes of the in-memory dataset as of the last refresh,
+                   without checking the files; None if it was never loaded
+        '''
+        data = self._data
+        return None if data is None else (len(data),data.memory_usage())
+
+    @property
+    def samples(self):
+        '''
+            Return:
+            list: the sample columns of the dataset, the ones following the FORMAT column
+        '''
+        columns = list(self.header.columns if self.header is not None else self.columns)
+        return columns[columns.index('FORMAT')+1:] if 'FORMAT' in columns else []
+
+    @property
+    def fields(self):
+        '''
+            Return:
+            list: the columns the rows written to the dataset can have, the 'Unnamed' index columns being filled by the store
+        '''
+        return [col for col in self.columns if 'Unnamed' not in col]
+
+    @property
+    def definitions(self):
+        '''
+            Return:
+            dict: the INFO and FORMAT keys defined in the header of the dataset, see vcf.field_definitions
+        '''
+        return field_definitions(self.header)
+
+    def lookup_id(self,id):
+        '''
+            Returns the entries having the given id through the hash index.
+
+            Parameters:
+            id,str: the id to look for
+
+            Return:
+            DataFrame: the matching entries
+        '''
+        self.refresh()
+        with self._lock.read(), span('lookup'):
+            return self._data.take(self._index.lookup_id(id))
+
+    def lookup_position(self,chrom,pos):
+        '''
+            Returns the entries found at the given chromosome position through the hash index.
+
+            Parameters:
+            chrom,str: the chromosome
+            pos,int: the position on the chromosome
+
+            Return:
+            DataFrame: the matching entries
+        '''
+        self.refresh()
+        with self._lock.read(), span('lookup'):
+            return self._data.take(self._index.lookup_position(chrom,pos))
+
+    def lookup_regions(self,regions):
+        '''
+            Returns the entries found in one or more chromosome regions.
+            Entries falling in overlapping regions are returned only once.
+
+            Parameters:
+            regions,list: list of (chrom,start,end) tuples, start and end can be None for open ended regions
+
+            Return:
+            DataFrame: the matching entries, in the order of the regions and sorted by position within a region
+        '''
+        self.refresh()
+        with self._lock.read(), span('lookup'):
+            labels = [self._index.lookup_region(chrom,start,end) for chrom,start,end in regions]
+            labels = pd.unique(np.concatenate(labels)) if labels else []
+            return self._data.take(labels)
+
+    def _sort_keys(self,labels):
+        '''
+            Computes the (chromosome order,POS,label) keys of rows, the order results are returned in.
+
+            Parameters:
+            labels,list: the labels of the rows
+
+            Return:
+            list: the keys, as (chromosome order,POS,label,CHROM) tuples
+        '''
+        keys=[]
+        for label in labels:
+            row = self._data.keys(label)
+            keys.append((self._index.chromosome_order(row['CHROM']),int(row['POS']),int(label),row['CHROM']))
+        return keys
+
+    def _labels(self,id,chrom,pos,regions):
+        '''
+            Return:
+            ndarray: the labels of the entries matched like in lookup_labels, the read lock being held by the caller
+        '''
+        if id or (chrom and pos is not None):
+            labels = self._index.lookup_id(id) if id else self._index.lookup_position(chrom,pos)
+            labels = [key[2] for key in sorted(self._sort_keys(labels))]
+        else:
+            labels = [self._index.chromosomes[chrom][1][first:last] for chrom,ranges in self._index.region_ranges(regions) for first,last in ranges]
+            labels = np.concatenate(labels) if labels else []
+        return np.asarray(labels,dtype=np.int64)
+
+    def _parsed_column(self,column,key,type,labels,stale):
+        '''
+            Reads a parsed INFO or FORMAT key of rows of the dataset, see vcf.parse_columns.
+
+            Parameters:
+            column,str: INFO or a sample column
+            key,str: the key
+            type,str: the type of the key
+            labels,ndarray: the labels of the rows
+            stale,ndarray: True for the rows written since the snapshot was taken, whose keys are parsed on the fly
+
+            Return:
+            present,ndarray: True for the rows having the key
+            values,ndarray: the values of the rows, see SparseColumn
+        '''
+        empty = SparseColumn(type,np.empty(0,np.int64),np.empty((0,0 if type == 'Flag' else 1),dtype=np.float64 if type in NUMERIC_TYPES+['Flag'] else object))
+        present,values = self._parsed.get((column,key),empty).take(labels)
+        if stale.any():
+            rows = self._data.take(labels[stale])
+            stale_present,stale_values = parse_columns(rows,self.header,keys={(column,key)}).get((column,key),empty).take(labels[stale])
+            width = max(values.shape[1],stale_values.shape[1])
+            values,stale_values = _widened(values,width),_widened(stale_values,width)
+            present[stale],values[stale] = stale_present,stale_values
+        return present,values
+
+    def _filter(self,labels,conditions):
+        '''
+            Keeps the entries meeting filter conditions, every condition being evaluated at once on the entries meeting
+            the previous ones. Fixed columns are read from the dataset (categorical ones through their categories),
+            INFO and FORMAT keys from their parsed sparse columns. The read lock must be held by the caller.
+
+            Parameters:
+            labels,ndarray: the labels of the entries
+            conditions,list: the conditions, see filters.parse_filter
+
+            Return:
+            ndarray: the labels of the entries meeting all the conditions, in the same order
+        '''
+        labels = np.asarray(labels,dtype=np.int64)
+        stale = np.isin(labels,np.fromiter(self._stale,dtype=np.int64,count=len(self._stale)))
+        for condition in conditions:
+            mask = np.zeros(len(labels),dtype=bool)
+            fixed = self._data.take(labels,condition.columns) if condition.key is None else None
+            for column in condition.columns:
+                if condition.key is not None:
+                    mask |= condition.mask(*self._parsed_column(column,condition.key,condition.type,labels,stale))
+                    continue
+                values = fixed[column]
+                if isinstance(values.dtype,pd.CategoricalDtype):
+                    categories = np.asarray(values.cat.categories,dtype=object).reshape(-1,1)
+                    #code -1 (missing value) takes the trailing False
+                    matches = np.append(condition.mask(np.ones(len(categories),dtype=bool),categories),False)
+                    mask |= matches.take(values.cat.codes.values)
+                else:
+                    values = values.values
+                    mask |= condition.mask(pd.notna(values),values.reshape(-1,1))
+            labels,stale = labels[mask],stale[mask]
+        return labels
+
+    def lookup_labels(self,id=None,chrom=None,pos=None,regions=None,where=None):
+        '''
+            Returns the labels of the entries having an id, found at a chromosome position or found in regions,
+            without taking the entries from the dataset (see rows).
+
+            Parameters:
+            id,str: the id to look for
+            chrom,str: the chromosome, used with pos when no id is given
+            pos,int: the position on the chromosome
+            regions,list: list of (chrom,start,end) tuples used when no id nor position is given, see lookup_regions
+            where,list: optional, the filter conditions the entries must meet, see filters.parse_filter
+
+            Return:
+            ndarray: the labels, sorted by chromosome (in dataset order), position and label, see lookup_page
+        '''
+        self.refresh()
+        with self._lock.read():
+            with span('lookup'):
+                labels = self._labels(id,chrom,pos,regions)
+            if where:
+                with span('filter'):
+                    labels = self._filter(labels,where)
+            return labels
+
+    def lookup_page(self,id=None,chrom=None,pos=None,regions=None,after=None,limit=10,where=None):
+        '''
+            Returns one page of the entries matched like in lookup_labels, starting after a (CHROM,POS,label) key
+            instead of an offset: for regions only the sorted positions following the key are read,
+            so that every page costs the same, and the pages do not shift when entries are added or deleted before the key.
+            Filtered pages are taken from all the entries meeting the filter, which must all be evaluated to count them.
+
+            Parameters:
+            id,str: see lookup_labels
+            chrom,str: see lookup_labels
+            pos,int: see lookup_labels
+            regions,list: see lookup_labels
+            after,tuple: the (CHROM,POS,label) key of the last entry of the previous page, None for the first page
+            limit,int: the number of entries of the page
+            where,list: optional, the filter conditions the entries must meet, see filters.parse_filter
+
+            Return:
+            labels,ndarray: the labels of the entries of the page
+            total,int: the number of entries matched by the query
+            next,tuple: the (CHROM,POS,label) key of the last entry of the page, None if no entry follows
+        '''
+        self.refresh()
+        with self._lock.read(), span('lookup'):
+            after_rank = None if after is None else (self._index.chromosome_order(after[0]),int(after[1]),int(after[2]))
+            if after_rank is not None and after_rank[0] is None:
+                return np.empty(0,np.int64),0,None #the key does not belong to any chromosome of the dataset
+            if where:
+                labels = self._labels(id,chrom,pos,regions)
+                with span('filter'):
+                    labels = self._filter(labels,where)
+                total = len(labels)
+                keys = self._data.take(labels,['CHROM','POS'])
+                chroms = keys['CHROM'].values
+                positions = keys['POS'].values.astype(np.int64)
+                start = 0
+                if after_rank is not None:
+                    codes,uniques = pd.factorize(chroms)
+                    ranks = np.array([self._index.chromosome_order(chrom) for chrom in uniques],dtype=np.int64).take(codes)
+                    rank,after_pos,after_label = after_rank
+                    #the labels are sorted by (chromosome order,POS,label), the page starts at the first key above the cursor
+                    above = (ranks > rank) | ((ranks == rank) & ((positions > after_pos) | ((positions == after_pos) & (labels > after_label))))
+                    start = int(np.argmax(above)) if above.any() else total
+                page = [(chroms[i],int(positions[i]),int(labels[i])) for i in range(start,min(start+limit+1,total))]
+            elif id or (chrom and pos is not None):
+                labels = self._index.lookup_id(id) if id else self._index.lookup_position(chrom,pos)
+                keys = sorted(self._sort_keys(labels))
+                total = len(keys)
+                if after_rank is not None:
+                    keys = [key for key in keys if key[:3] > after_rank]
+                page = [(key[3],key[1],key[2]) for key in keys[:limit+1]]
+            else:
+                ranges = self._index.region_ranges(regions)
+                total = sum(last-first for _,chrom_ranges in ranges for first,last in chrom_ranges)
+                page=[]
+                for chrom,chrom_ranges in ranges:
+                    if len(page) > limit:
+                        break
+                    rank = self._index.chromosome_order(chrom)
+                    if after_rank is not None and rank < after_rank[0]:
+                        continue
+                    start = self._index.cursor_index(chrom,after_rank[1],after_rank[2]) if after_rank is not None and rank == after_rank[0] else 0
+                    positions,chrom_labels = self._index.chromosomes[chrom]
+                    for first,last in chrom_ranges:
+                        first = max(first,start)
+                        last = min(last,first+limit+1-len(page))
+                        page.extend((chrom,int(p),int(l)) for p,l in zip(positions[first:last],chrom_labels[first:last]))
+                        if len(page) > limit:
+                            break
+            next = page[limit-1] if len(page) > limit and limit > 0 else None
+            return np.array([key[2] for key in page[:limit]],dtype=np.int64),total,next
+
+    def rows(self,labels):
+        '''
+            Returns the entries having the given labels, skipping the ones deleted since the labels were looked up.
+
+            Parameters:
+            labels,ndarray: the labels, see lookup_labels
+
+            Return:
+            DataFrame: the entries, in the order of the labels
+        '''
+        self.refresh()
+        with self._lock.read():
+            labels = np.asarray(labels,dtype=np.int64)
+            return self._data.take(labels[self._data.alive(labels)])
+
+    def lookup_many(self,ids,regions):
+        '''
+            Resolves many ids and regions in one pass: the ids are looked up together in the hash index,
+            the regions in the sorted positions, and all the matching entries are taken from the dataset at once.
+
+            Parameters:
+            ids,list: the ids to look for
+            regions,list: list of (chrom,start,end) tuples, see lookup_regions
+
+            Return:
+            data,DataFrame: the entries matching any id or region, each entry appearing once
+            groups,list: for every id and then every region, the labels of its entries in data
+        '''
+        self.refresh()
+        with self._lock.read(), span('lookup'):
+            groups = self._index.lookup_ids(ids)
+            groups += [self._index.lookup_region(chrom,start,end).tolist() for chrom,start,end in regions]
+            labels = pd.unique(np.array([label for group in groups for label in group],dtype=np.int64))
+            return self._data.take(labels),groups
+
+    def _apply(self,op):
+        '''
+            Applies one update or delete to the in-memory dataset and its index.
+
+            Parameters:
+            op,dict: the operation, {'op':'update','id':...,'fields':...} or {'op':'delete','id':...}
+
+            Return:
+            bool: whether the id was found
+        '''
+        data = self._data
+        labels = list(self._index.lookup_id(op['id']))
+        if not labels:
+            return False
+        #the values are typed before the index is changed, so that a value that cannot be written leaves it as it was
+        fields = _typed_values(data.dtypes,op['fields']) if op['op'] == 'update' else None
+        for label in labels:
+            keys = data.keys(label)
+            self._index.remove(label,keys)
+            self._changes.append((keys['ID'],keys['CHROM'],keys['POS']))
+        if op['op'] == 'delete':
+            #the rows are only marked as deleted, see DeltaFrame
+            data.delete(labels)
+            self._stale.difference_update(labels)
+            return True
+        self._stale.update(labels)
+        data.update(labels,fields)
+        for label in labels:
+            keys = data.keys(label)
+            self._index.add(label,keys)
+            self._changes.append((keys['ID'],keys['CHROM'],keys['POS']))
+        return True
+
+    def _insert_rows(self,rows):
+        '''
+            Appends new rows to the in-memory dataset (as a delta segment, see DeltaFrame) and to its index.
+
+            Parameters:
+            rows,list: the rows, as dicts having all the columns of the dataset
+
+            Return:
+            labels,list: the labels given to the rows
+        '''
+        #labels are never reused, so that a label keeps designating the same row
+        labels = list(range(self._next_label,self._next_label+len(rows)))
+        self._next_label += len(rows)
+        self._data.append(labels,rows)
+        self._index.add_many(labels,rows)
+        self._stale.update(labels)
+        self._changes.extend((row['ID'],row['CHROM'],row['POS']) for row in rows)
+        return labels
+
+    def _apply_all(self,ops):
+        '''
+            Applies operations in order, consecutive inserts being appended together (see _insert_rows),
+            and notifies the listeners of the changed rows (see subscribe).
+
+            Parameters:
+            ops,list: the operations, {'op':'insert','row':...}, {'op':'update','id':...,'fields':...} or {'op':'delete','id':...}
+
+            Return:
+            results,list: the label of the new row for inserts, whether the id was found for updates and deletes
+        '''
+        results=[]
+        rows=[]
+        for op in ops+[None]:
+            if op is not None and op['op'] == 'insert':
+                rows.append(op['row'])
+                continue
+            if rows:
+                results.extend(self._insert_rows(rows))
+                rows=[]
+            if op is not None:
+                results.append(self._apply(op))
+        changes,self._changes = self._changes,[]
+        if changes:
+            self._notify(changes)
+        return results
+
+    def _complete_rows(self,ops):
+        '''
+            Fills the rows of insert operations: columns missing from a row are filled with '-' while
+            'Unnamed' index columns are given the next free values.
+
+            Parameters:
+            ops,list: the operations
+
+            Return:
+            list: the operations, inserts having complete rows
+        '''
+        data = self._data
+        counters = {col:data.next_value(col) for col in data.columns if 'Unnamed' in col}
+        completed=[]
+        for op in ops:
+            if op['op'] == 'insert':
+                row={}
+                for col in data.columns:
+                    if col in counters:
+                        row[col]=counters[col]
+                        counters[col]+=1
+                    else:
+                        row[col]=op['row'].get(col,'-')
+                op = {'op':'insert','row':row}
+            completed.append(op)
+        return completed
+
+    def _missing_ids(self,ops):
+        '''
+            Finds the updates and deletes of a batch whose id will not be in the dataset when they are applied,
+            taking the inserts, the id changes and the deletes of the preceding operations into account.
+
+            Parameters:
+            ops,list: the operations
+
+            Return:
+            list: the positions of those operations in ops
+        '''
+        counts={}
+        def count(id):
+            return counts[id] if id in counts else len(self._index.lookup_id(id))
+        missing=[]
+        for i,op in enumerate(ops):
+            if op['op'] == 'insert':
+                counts[op['row']['ID']] = count(op['row']['ID'])+1
+            elif count(op['id']) == 0:
+                missing.append(i)
+            elif op['op'] == 'delete':
+                counts[op['id']] = 0
+            elif op['fields'].get('ID',op['id']) != op['id']:
+                counts[op['fields']['ID']] = count(op['fields']['ID'])+count(op['id'])
+                counts[op['id']] = 0
+        return missing
+
+    def _append_log(self,ops):
+        '''
+            Appends a batch of operations to the change log and fsyncs it.
+
+            Parameters:
+            ops,list: the operations to persist
+        '''
+        with span('persist'), open(self.log_path,'ab') as f:
+            for op in ops:
+                f.write(json.dumps(op).encode()+b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_offset = self._log_size()
+
+    def apply(self,ops,strict=False):
+        '''
+            Applies a batch of operations to the dataset and persists them with a single write to the change log.
+            Updates and deletes of ids that are not in the dataset are not logged.
+
+            Parameters:
+            ops,list: the operations to apply, see _apply_all; columns missing from inserted rows are filled, see _complete_rows
+            strict,bool: True to apply none of the operations if an update or a delete targets a missing id
+
+            Return:
+            results,list: the result of every operation, see _apply_all; in strict mode, when nothing is applied,
+                          False for the operations targeting a missing id and None for the others
+        '''
+        with self._writing, self._file_lock(exclusive=True), self._lock.write():
+            #catch up with the changes written by other processes before applying ours
+            self.refresh()
+            ops = self._complete_rows(ops)
+            if strict:
+                missing = self._missing_ids(ops)
+                if missing:
+                    missing = set(missing)
+                    return [False if i in missing else None for i in range(len(ops))]
+            with span('apply'):
+                results = self._apply_all(ops)
+            logged = [op for op,result in zip(ops,results) if result is not False]
+            if logged:
+                self._append_log(logged)
+                self._schedule_compaction()
+            return results
+
+    def _schedule_compaction(self):
+        '''
+            Starts the background compaction thread on the first write and wakes it up when the log is too big.
+        '''
+        if self._closed:
+            return #the log of a closed store is compacted by the next store opening the dataset
+        if self._compactor is None:
+            self._compactor = threading.Thread(target=self._compaction_loop,daemon=True)
+            self._compactor.start()
+        if self._log_offset >= self.compact_bytes:
+            self._compact_event.set()
+
+    def _compaction_loop(self):
+        '''
+            Body of the background compaction thread.
+        '''
+        while True:
+            self._compact_event.wait(self.compact_interval)
+            self._compact_event.clear()
+            if self._closed:
+                return
+            try:
+                self.compact()
+            except OSError:
+                #the next round will try again, the log still holds every change
+                pass
+
+    def close(self):
+        '''
+            Stops the background compaction, so that the store is freed once the requests using it are done.
+            The store can still be read and written meanwhile, its log being compacted by the next store opening the dataset.
+        '''
+        self._closed = True
+        self._compact_event.set()
+
+    def compact(self):
+        '''
+            Merges the change log into a new snapshot generation and empties the log, which is when the rows inserted
+            and deleted since the last snapshot are merged into the frame of the dataset (see DeltaFrame).
+            A checkpoint naming the new generation is logged before it becomes the current one,
+            so that a crash at any point never applies an operation twice.
+            The dataset is then memory-mapped from the new generation, so that its pages are shared again.
+            Writes wait for the whole compaction, as well as lookups that have to catch up with the changes of
+            another process (see refresh), while the other lookups only wait for the swap of the dataset.
+        '''
+        with self._writing, self._file_lock(exclusive=True):
+            self.refresh()
+            if self._log_size() == 0:
+                return
+            #nothing can change the dataset meanwhile, neither this process (self._writing) nor another one (the lock file)
+            with self._lock.read():
+                generation = self._write_generation(self._data.frame(),self.header)
+            data,_ = read_snapshot(os.path.join(self.snapshot_path,generation))
+            parsed = read_parsed(os.path.join(self.snapshot_path,generation))
+            with self._lock.write():
+                self._append_log([{'op':'checkpoint','snapshot':generation}])
+                self._set_current(generation)
+                atomic_write(self.log_path,lambda f: None)
+                self._data,self._parsed,self._stale = DeltaFrame(data),parsed,set()
+                self._generation = generation
+                self._signature = self._snapshot_signature()
+                self._log_offset = 0
+
+    def export(self,path):
+        '''
+            Exports the dataset as a csv file, or as a vcf file (gzip compressed if the path ends with .gz)
+            that includes the header metadata of the imported vcf.
+
+            Parameters:
+            path,str: the path of the exported file, ending with .csv, .vcf or .vcf.gz
+        '''
+        self.refresh()
+        with self._lock.read():
+            data = self._data.frame()
+            header = self.header
+            if path.endswith('.csv'):
+                atomic_write(path,lambda f: data.to_csv(f,index=False))
+                return
+            def write(f):
+                text = io.TextIOWrapper(gzip.GzipFile(fileobj=f,mode='wb') if path.endswith('.gz') else f,newline='')
+                for line in (header.lines if header is not None else ['fileformat=VCFv4.2']):
+                    text.write('##'+line+'\n')
+                text.write('\t'.join(['#CHROM' if col == 'CHROM' else col for col in data.columns])+'\n')
+                data.to_csv(text,sep='\t',header=False,index=False,na_rep='.',float_format='%g',quoting=csv.QUOTE_NONE)
+                text.flush()
+                if path.endswith('.gz'):
+                    text.detach().close()
+                else:
+                    text.detach()
+            atomic_write(path,write,mode='wb')
+
+    def insert(self,row):
+        '''
+            Appends a new entry to the dataset.
+            Columns missing from the row are filled with '-' while 'Unnamed' index columns are given the next free value.
+
+            Parameters:
+            row,dict: the fields of the new entry
+
+            Return:
+            new_data,DataFrame: the newly inserted entry
+        '''
+        #no other thread can change the dataset before the entry is taken from it, see apply
+        with self._writing:
+            label = self.apply([{'op':'insert','row':row}])[0]
+            return self._data.take([label])
+
+    def update(self,id,fields):
+        '''
+            Changes all the entries having the given id.
+
+            Parameters:
+            id,str: the id of the entries to change
+            fields,dict: the new values of the fields
+
+            Return:
+            bool: False if no entry has the given id, True otherwise
+        '''
+        return self.apply([{'op':'update','id':id,'fields':fields}])[0]
+
+    def delete(self,id):
+        '''
+            Deletes all the entries having the given id.
+
+            Parameters:
+            id,str: the id of the entries to delete
+
+            Return:
+            bool: False if no entry has the given id, True otherwise
+        '''
+        return self.apply([{'op':'delete','id':id}])[0]
+
+
+class DatasetRegistry:
+
+    '''
+        The DatasetRegistry class keeps the datasets served by the API, each one being a vcf file registered under a name
+        (or found in a folder) with its own VariantStore. Stores are opened lazily on first use and at most max_resident
+        of them are kept open: opening another one closes the least recently used one, which bounds the memory used
+        by the datasets to max_resident of them plus the ones being queried at that time.
+    '''
+
+    def __init__(self,max_resident=8,folder=None,threads=8):
+        '''
+            Parameters:
+            max_resident,int: the maximum number of open stores
+            folder,str: optional, a folder whose name.vcf and name.vcf.gz files are the datasets of that name
+            threads,int: the number of threads querying datasets in parallel, see map
+        '''
+        self.max_resident=max_resident
+        self.folder=folder
+        self.threads=threads
+        self._paths={} #name -> path
+        self._stores=collections.OrderedDict() #path -> store, least recently used first
+        self._samples={} #path -> ((mtime,size),samples)
+        self._lock=threading.Lock()
+        self._pool=None
+
+    def register(self,name,path):
+        '''
+            Registers a dataset.
+
+            Parameters:
+            name,str: the name of the dataset
+            path,str: the path to its vcf file
+        '''
+        with self._lock:
+            self._paths[name]=path
+
+    def replace(self,paths):
+        '''
+            Registers exactly the given datasets, the registered datasets missing from paths being unregistered.
+            Their open stores are closed like the other ones, when they become the least recently used, see open.
+
+            Parameters:
+            paths,dict: the paths to the vcf files, by dataset name
+        '''
+        with self._lock:
+            if paths != self._paths:
+                self._paths = dict(paths)
+
+    def _folder_paths(self):
+        '''
+            Return:
+            dict: the paths to the vcf files of the folder, by dataset name
+        '''
+        if not self.folder or not os.path.isdir(self.folder):
+            return {}
+        return {os.path.basename(base_path(name)):os.path.join(self.folder,name) for name in sorted(os.listdir(self.folder))
+                if name.endswith('.vcf') or name.endswith('.vcf.gz')}
+
+    def names(self):
+        '''
+            Return:
+            list: the names of the registered datasets and of the datasets of the folder, sorted
+        '''
+        with self._lock:
+            names = set(self._paths)
+        return sorted(names | set(self._folder_paths()))
+
+    def path(self,name):
+        '''
+            Parameters:
+            name,str: the name of a dataset
+
+            Return:
+            str: the path to its vcf file, None if there is no such dataset
+        '''
+        with self._lock:
+            path = self._paths.get(name)
+        if path is None and self.folder:
+            for candidate in [os.path.join(self.folder,name+'.vcf'),os.path.join(self.folder,name+'.vcf.gz')]:
+                if os.path.basename(name) == name and os.path.exists(candidate):
+                    return candidate
+        return path
+
+    def open(self,path):
+        '''
+            Returns the store of a dataset file, opening it if needed and closing the least recently used store
+            if more than max_resident stores are then open.
+
+            Parameters:
+            path,str: the path to the dataset file
+
+            Return:
+            VariantStore: the store shared by all the request handlers
+        '''
+        evicted=[]
+        with self._lock:
+            store = self._stores.get(path)
+            if store is None:
+                store = self._stores[path] = VariantStore(path)
+            self._stores.move_to_end(path)
+            while len(self._stores) > max(self.max_resident,1):
+                evicted.append(self._stores.popitem(last=False)[1])
+        for old in evicted:
+            old.close()
+        return store
+
+    def get(self,name):
+        '''
+            Parameters:
+            name,str: the name of a dataset
+
+            Return:
+            VariantStore: its store, see open
+        '''
+        path = self.path(name)
+        if path is None:
+            raise KeyError(name)
+        return self.open(path)
+
+    def samples(self,name):
+        '''
+            Reads the sample columns of a dataset from the header of its file, without opening its store.
+
+            Parameters:
+            name,str: the name of a dataset
+
+            Return:
+            list: the sample columns, see VariantStore.samples
+        '''
+        path = self.path(name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return self.get(name).samples #the dataset only exists as a legacy csv file
+        cached = self._samples.get(path)
+        if cached is None or cached[0] != (st.st_mtime_ns,st.st_size):
+            with open_vcf(path) as f:
+                columns = read_header(f).columns
+            cached = self._samples[path] = ((st.st_mtime_ns,st.st_size),columns[columns.index('FORMAT')+1:] if 'FORMAT' in columns else [])
+        return cached[1]
+
+    def resident(self):
+        '''
+            Return:
+            list: the open stores, least recently used first
+        '''
+        with self._lock:
+            return list(self._stores.values())
+
+    def map(self,function,items):
+        '''
+            Calls a function on several items in parallel, e.g. to query several datasets at once.
+
+            Parameters:
+            function,function: the function, called with one item
+            items,list: the items
+
+            Return:
+            list: the results, in the order of the items
+        '''
+        if len(items) <= 1:
+            return [function(item) for item in items]
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(self.threads,thread_name_prefix='datasets')
+        return list(self._pool.map(function,items))
+
+
+registry=DatasetRegistry()
+
+
+def get_store(path=DATASET_PATH):
+    '''
+        Returns the process-wide store for a dataset, creating it on first use, see DatasetRegistry.open.
+
+        Parameters:
+        path,str: The path to the dataset file
+
+        Return:
+        VariantStore: the store shared by all the request handlers
+    '''
+    return registry.open(path)
+
+
+if __name__ == '__main__':
+    #usage: python store.py export <output.csv|output.vcf|output.vcf.gz> [dataset.vcf]
+    if len(sys.argv) < 3 or sys.argv[1] != 'export':
+        sys.exit('usage: python store.py export <output.csv|output.vcf|output.vcf.gz> [dataset.vcf]')
+    get_store(sys.argv[3] if len(sys.argv) > 3 else DATASET_PATH).export(sys.argv[2])
@@ -1,10 +1,53 @@
 from api import app
+from asgi import create_app, is_heavy, build_environ
+from cache import ResponseCache
+from metrics import metrics
+from snapshot import DictionaryArray, read_parsed, read_snapshot
+from store import VariantStore, DatasetRegistry
+from validation import validate_records, validate_frame, SMALL_BATCH
+from vcf import ingest, memory_report, parse_columns, to_records
+from xmlwriter import to_xml
+from dict2xml import dict2xml
+import asyncio
+import gzip
+import json
+import os
+import numpy as np
+import pandas as pd
+import shutil
+import tempfile
+import threading
+import time
+import multiprocessing
 import unittest
 
 POST_BODY={"CHROM": "chrX", "POS": 102222200, "ALT": "A", "REF": "G","ID": "rs123"}
 POST_BODY_WRONG={"CHROM": "wrongCHROM", "POS": 102222200, "ALT": "A", "REF": "G","ID": "rs123"}
 PUT_BODY={"CHROM": "chr21", "POS": 1, "ALT": "G", "REF": "A","ID": "rs123"}
 
+VCF_HEADER='##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNA12877 single 20180302\n'
+VCF_ROW='%s\t%d\t%s\tA\tG\t50\tPASS\tDP=10\tGT\t0/1\n'
+
+
+def write_vcf(folder,rows,name='dataset.vcf'):
+    '''
+        Writes a small vcf file for the store tests.
+
+        Parameters:
+        folder,str: the folder where the file is created
+        rows,list: list of (CHROM,POS,ID) tuples
+        name,str: the name of the file
+
+        Return:
+        str: the path of the vcf file
+    '''
+    path=os.path.join(folder,name)
+    with open(path,'w') as f:
+        f.write(VCF_HEADER)
+        for row in rows:
+            f.write(VCF_ROW%row)
+    return path
+
 class FlaskTest(unittest.TestCase):
 
     ##TEST GET
@@ -47,7 +90,8 @@ class FlaskTest(unittest.TestCase):
     #check get request response when etag is provided
     def test_6_get_304_wrong_etag(self):
         tester=app.test_client(self)
-        response=tester.get('/result?id=rs123',headers={'Accept':'application/json','If-None-Match':'rs123_1_10'})
+        etag=tester.get('/result?id=rs62635297',headers={'Accept':'application/json'}).headers['etag']
+        response=tester.get('/result?id=rs62635297',headers={'Accept':'application/json','If-None-Match':etag})
         status_code=response.status_code
         self.assertEqual(status_code,304)
     
@@ -58,6 +102,14 @@ class FlaskTest(unittest.TestCase):
         status_code=response.status_code
         self.assertEqual(status_code,404)
     
+    #check failed region request due to a malformed chromosome or span
+    def test_7_get_400_bad_region(self):
+        tester=app.test_client(self)
+        response=tester.get('/result?region=chr99:1-10',headers={'Accept':'application/json'})
+        self.assertEqual(response.status_code,400)
+        response=tester.get('/result?region=chr1:20-10',headers={'Accept':'application/json'})
+        self.assertEqual(response.status_code,400)
+
     ##TEST POST
 
     #check failed post request due to unauthorized user (no password provided)
@@ -181,5 +233,837 @@ class FlaskTest(unittest.TestCase):
         status_code=response.status_code
         self.assertEqual(status_code,204)
 
+
+class EndpointTest(unittest.TestCase):
+
+    '''
+        Tests of the /result endpoints against a small known dataset
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder=tempfile.mkdtemp()
+        cls.previous_path=app.config['DATASET_PATH']
+        app.config['DATASET_PATH']=write_vcf(cls.folder,[('chr1',100,'rs1'),('chr1',200,'rs2'),('chr1',300,'rs3'),('chr2',50,'rs4'),('chr2',50,'rs4')])
+
+    @classmethod
+    def tearDownClass(cls):
+        app.config['DATASET_PATH']=cls.previous_path
+        shutil.rmtree(cls.folder)
+
+    #check successful region request
+    def test_1_get_200_region(self):
+        tester=app.test_client(self)
+        response=tester.get('/result?region=chr1:1,00-2,00&region=chr2',headers={'Accept':'application/json'})
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.json['meta']['entries'],4)
+
+    #check successful bulk lookup, results being grouped by key in the order of the request
+    def test_2_query_200(self):
+        tester=app.test_client(self)
+        response=tester.post('/result/query',headers={'Content-Type':'application/json','Accept':'application/json'},json={'ids':['rs4','rs1','rs9'],'regions':['chr1:150-300']})
+        self.assertEqual(response.status_code,200)
+        self.assertEqual([(result['key'],result['entries']) for result in response.json['results']],[('rs4',2),('rs1',1),('rs9',0),('chr1:150-300',2)])
+        self.assertEqual(response.json['meta']['not_found'],['rs9'])
+        self.assertEqual([row['ID'] for row in response.json['results'][3]['data'].values()],['rs2','rs3'])
+        response=tester.post('/result/query',headers={'Content-Type':'application/json','Accept':'application/xml'},json={'ids':['rs1']})
+        self.assertEqual(response.status_code,200)
+        self.assertIn(b'<key>rs1</key>',response.data)
+
+    #check failed bulk lookups due to a wrong body, region, content type or accept header
+    def test_3_query_errors(self):
+        tester=app.test_client(self)
+        headers={'Content-Type':'application/json','Accept':'application/json'}
+        self.assertEqual(tester.post('/result/query',headers=headers,json={'ids':'rs1'}).status_code,400)
+        self.assertEqual(tester.post('/result/query',headers=headers,json={}).status_code,400)
+        self.assertEqual(tester.post('/result/query',headers=headers,json={'regions':['chr99:1-2']}).status_code,400)
+        self.assertEqual(tester.post('/result/query',headers={'Content-Type':'text/plain','Accept':'application/json'},data='x').status_code,400)
+        self.assertEqual(tester.post('/result/query',headers={'Content-Type':'application/json','Accept':'text/html'},json={'ids':['rs1']}).status_code,406)
+
+    #check that a batch applies its valid operations and reports the failed ones
+    def test_4_batch_200(self):
+        tester=app.test_client(self)
+        row={"CHROM": "chr3", "POS": 10, "ALT": "A", "REF": "G","ID": "rs10"}
+        response=tester.post('/result/batch',headers={'Content-Type':'application/json','Authorization':'password'},json={'operations':[
+            {'op':'insert','data':row},
+            {'op':'update','id':'rs10','data':dict(row,POS=20)},
+            {'op':'delete','id':'rs99'},
+            {'op':'insert','data':dict(row,ALT='Z')},
+            {'op':'upsert','id':'rs10'}]})
+        self.assertEqual(response.status_code,200)
+        self.assertEqual([result['status'] for result in response.json['results']],[201,200,404,400,400])
+        self.assertEqual(response.json['meta']['applied'],2)
+        response=tester.get('/result?id=rs10',headers={'Accept':'application/json'})
+        self.assertEqual([row['POS'] for row in response.json['data'].values()],[20])
+
+    #check that a strict batch is not applied at all when one of its operations fails
+    def test_5_batch_strict(self):
+        tester=app.test_client(self)
+        headers={'Content-Type':'application/json','Authorization':'password'}
+        response=tester.post('/result/batch',headers=headers,json={'strict':True,'operations':[{'op':'delete','id':'rs2'},{'op':'delete','id':'rs99'}]})
+        self.assertEqual(response.status_code,404)
+        self.assertEqual([result['status'] for result in response.json['results']],[409,404])
+        response=tester.post('/result/batch',headers=headers,json={'strict':True,'operations':[{'op':'delete','id':'rs2'},{'op':'insert','data':{}}]})
+        self.assertEqual(response.status_code,400)
+        self.assertEqual(tester.get('/result?id=rs2',headers={'Accept':'application/json'}).status_code,200)
+        #operations can target the ids inserted earlier in the same batch
+        row={"CHROM": "chr3", "POS": 30, "ALT": "A", "REF": "G","ID": "rs11"}
+        response=tester.post('/result/batch',headers=headers,json={'strict':True,'operations':[{'op':'insert','data':row},{'op':'delete','id':'rs11'}]})
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(tester.post('/result/batch',headers={'Content-Type':'application/json'},json={'operations':[]}).status_code,403)
+        self.assertEqual(tester.post('/result/batch',headers=headers,json={'operations':[]}).status_code,400)
+
+    #check that GET responses are cached, that their etag follows their content and that writes only invalidate the affected ones
+    def test_6_cache_invalidation(self):
+        tester=app.test_client(self)
+        headers={'Accept':'application/json'}
+        first=tester.get('/result?id=rs1',headers=headers)
+        self.assertEqual(first.headers['X-Cache'],'MISS')
+        second=tester.get('/result?id=rs1',headers=headers)
+        self.assertEqual((second.headers['X-Cache'],second.headers['etag'],second.data),('HIT',first.headers['etag'],first.data))
+        self.assertEqual(tester.get('/result?id=rs1',headers=dict(headers,**{'If-None-Match':first.headers['etag']})).status_code,304)
+        tester.get('/result?region=chr1:50-150',headers=headers)
+        tester.get('/result?region=chr1:250-350',headers=headers)
+        tester.get('/result?id=rs3',headers=headers)
+        response=tester.put('/result?id=rs1',headers={'Content-Type':'application/json','Authorization':'password'},
+                            json={"CHROM": "chr1", "POS": 120, "ALT": "A", "REF": "G","ID": "rs1"})
+        self.assertEqual(response.status_code,200)
+        response=tester.get('/result?id=rs1',headers=headers)
+        self.assertEqual(response.headers['X-Cache'],'MISS')
+        self.assertNotEqual(response.headers['etag'],first.headers['etag'])
+        self.assertEqual(tester.get('/result?region=chr1:50-150',headers=headers).headers['X-Cache'],'MISS')
+        self.assertEqual(tester.get('/result?region=chr1:250-350',headers=headers).headers['X-Cache'],'HIT')
+        self.assertEqual(tester.get('/result?id=rs3',headers=headers).headers['X-Cache'],'HIT')
+        stats=tester.get('/result/cache').json
+        self.assertGreaterEqual(stats['hits'],3)
+        self.assertGreaterEqual(stats['invalidations'],2)
+
+    #check that entries are streamed one per line as ndjson, or as the data element of the xml response
+    def test_7_stream(self):
+        tester=app.test_client(self)
+        response=tester.get('/result?region=chr1',headers={'Accept':'application/x-ndjson'})
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.headers['X-Total-Count'],'3')
+        self.assertEqual([json.loads(line)['ID'] for line in response.data.decode().splitlines()],['rs1','rs2','rs3'])
+        response=tester.get('/result?region=chr1&page=2&per_page=2',headers={'Accept':'application/x-ndjson'})
+        self.assertEqual(len(response.data.decode().splitlines()),1)
+        streamed=tester.get('/result?region=chr1&stream=true',headers={'Accept':'application/xml'}).data.decode()
+        document=tester.get('/result?region=chr1',headers={'Accept':'application/xml'}).data.decode()
+        self.assertIn(streamed,document)
+        self.assertEqual(tester.get('/result?region=chr9',headers={'Accept':'application/x-ndjson'}).status_code,404)
+        #a cursor cannot be followed by streamed responses, which have no next cursor
+        next=tester.get('/result?region=chr1&per_page=2',headers={'Accept':'application/json'}).json['meta']['next']
+        self.assertEqual(tester.get('/result?region=chr1&per_page=2&cursor='+next,headers={'Accept':'application/x-ndjson'}).status_code,400)
+        self.assertEqual(tester.get('/result?region=chr1&stream=true&cursor='+next,headers={'Accept':'application/xml'}).status_code,400)
+        self.assertEqual(tester.post('/result/query',headers={'Content-Type':'application/json','Accept':'application/x-ndjson'},json={'ids':['rs1']}).status_code,406)
+
+    #check that cursor pages neither skip nor repeat entries when entries are inserted or deleted during the traversal
+    def test_8_cursor_pagination(self):
+        tester=app.test_client(self)
+        headers={'Accept':'application/json'}
+        writer={'Content-Type':'application/json','Authorization':'password'}
+        response=tester.get('/result?region=chr5&per_page=2',headers=headers)
+        self.assertEqual(response.status_code,404)
+        operations=[{'op':'insert','data':{"CHROM": "chr5", "POS": n*10, "ALT": "A", "REF": "G","ID": "rs5%d"%n}} for n in range(1,7)]
+        self.assertEqual(tester.post('/result/batch',headers=writer,json={'operations':operations}).status_code,200)
+        meta=tester.get('/result?region=chr5&per_page=3',headers=headers).json['meta']
+        self.assertEqual((meta['pages'],meta['has_next_page']),(2,True))
+        response=tester.get('/result?region=chr5&per_page=2',headers=headers).json
+        ids=[row['ID'] for row in response['data'].values()]
+        tester.post('/result/batch',headers=writer,json={'operations':[{'op':'delete','id':'rs51'},
+            {'op':'insert','data':{"CHROM": "chr5", "POS": 5, "ALT": "A", "REF": "G","ID": "rs50"}}]})
+        while response['meta']['next']:
+            response=tester.get('/result?region=chr5&per_page=2&cursor='+response['meta']['next'],headers=headers).json
+            ids+=sorted(row['ID'] for row in response['data'].values())
+        self.assertEqual(ids,['rs51','rs52','rs53','rs54','rs55','rs56'])
+        next=tester.get('/result?region=chr5&per_page=2',headers=headers).json['meta']['next']
+        self.assertEqual(tester.get('/result?region=chr1&per_page=2&cursor='+next,headers=headers).status_code,400)
+        self.assertEqual(tester.get('/result?region=chr5&page=2&cursor='+next,headers=headers).status_code,400)
+        self.assertEqual(tester.get('/result?region=chr5&cursor=abc',headers=headers).status_code,400)
+
+    #check that lists and objects are rejected before they reach the dataset, which keeps the entry readable and writable
+    def test_9_put_400_non_scalar(self):
+        tester=app.test_client(self)
+        writer={'Content-Type':'application/json','Authorization':'password'}
+        body={"CHROM": "chr1", "POS": 300, "ALT": "A", "REF": "G","ID": "rs3"}
+        response=tester.put('/result?id=rs3',headers=writer,json=dict(body,FILTER=['PASS']))
+        self.assertEqual((response.status_code,response.json['message']),(400,['FILTER field must be a string or a number']))
+        self.assertEqual(tester.get('/result?id=rs3',headers={'Accept':'application/json'}).status_code,200)
+        self.assertEqual(tester.put('/result?id=rs3',headers=writer,json=body).status_code,200)
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder=tempfile.mkdtemp()
+        self.path=write_vcf(self.folder,[('chr1',100,'rs1'),('chr1',200,'rs2'),('chr2',50,'rs3')])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    #check that the dataset is parsed only once
+    def test_1_loaded_once(self):
+        store=VariantStore(self.path)
+        data=store.data
+        self.assertIs(store.data,data)
+        self.assertEqual(data.shape[0],3)
+
+    #check that a change of the snapshot on disk triggers a reload
+    def test_2_reload_on_file_change(self):
+        store=VariantStore(self.path)
+        store.refresh()
+        time.sleep(0.01)
+        shutil.rmtree(store.snapshot_path)
+        write_vcf(self.folder,[('chr1',100,'rs1')])
+        self.assertEqual(store.data.shape[0],1)
+
+    #check that writes update the in-memory copy without re-reading the file
+    def test_3_writes_update_memory(self):
+        store=VariantStore(self.path)
+        store.insert({"CHROM": "chrX", "POS": 1, "ALT": "A", "REF": "G","ID": "rs4"})
+        data=store.data
+        self.assertTrue(store.update('rs4',{'POS':2}))
+        self.assertTrue(store.delete('rs1'))
+        self.assertFalse(store.delete('rs1'))
+        self.assertEqual(sorted(store.data['ID']),['rs2','rs3','rs4'])
+        self.assertEqual(sorted(VariantStore(self.path).data['ID']),['rs2','rs3','rs4'])
+
+    #check that the id and position indexes follow inserts, updates and deletes
+    def test_4_index_consistency(self):
+        store=VariantStore(self.path)
+        store.insert({"CHROM": "chrX", "POS": 7, "ALT": "A", "REF": "G","ID": "rs2"})
+        self.assertEqual(store.lookup_id('rs2').shape[0],2)
+        self.assertEqual(list(store.lookup_position('chrX',7)['ID']),['rs2'])
+        store.update('rs2',{'ID':'rs5','POS':8})
+        self.assertEqual(store.lookup_id('rs2').shape[0],0)
+        self.assertEqual(store.lookup_id('rs5').shape[0],2)
+        self.assertEqual(store.lookup_position('chrX',7).shape[0],0)
+        self.assertEqual(store.lookup_position('chrX',8).shape[0],1)
+        store.delete('rs5')
+        self.assertEqual(store.lookup_id('rs5').shape[0],0)
+        self.assertEqual(store.lookup_position('chrX',8).shape[0],0)
+        self.assertEqual(list(store.lookup_position('chr1',100)['ID']),['rs1'])
+        #an update whose values cannot be written leaves the index as it was
+        with self.assertRaises(TypeError):
+            store.update('rs1',{'FILTER':['PASS']})
+        self.assertEqual(store.lookup_id('rs1').shape[0],1)
+        #columns the dataset does not have are never added by updates
+        self.assertTrue(store.update('rs1',{'foo':None}))
+        self.assertNotIn('foo',store.data.columns)
+
+    #check region queries, including overlapping regions and index maintenance
+    def test_5_region_queries(self):
+        store=VariantStore(self.path)
+        self.assertEqual(list(store.lookup_regions([('chr1',150,250)])['ID']),['rs2'])
+        self.assertEqual(list(store.lookup_regions([('chr1',None,None),('chr1',100,100),('chr2',1,50)])['ID']),['rs1','rs2','rs3'])
+        store.insert({"CHROM": "chr1", "POS": 150, "ALT": "A", "REF": "G","ID": "rs4"})
+        self.assertEqual(list(store.lookup_regions([('chr1',100,200)])['ID']),['rs1','rs4','rs2'])
+        store.delete('rs1')
+        self.assertEqual(list(store.lookup_regions([('chr1',100,200)])['ID']),['rs4','rs2'])
+        self.assertEqual(store.lookup_regions([('chr3',None,None)]).shape[0],0)
+
+    #check that writes only touch the change log and that a new process replays it
+    def test_6_change_log_replay(self):
+        store=VariantStore(self.path)
+        store.refresh()
+        snapshot_signature=store._snapshot_signature()
+        store.insert({"CHROM": "chrX", "POS": 1, "ALT": "A", "REF": "G","ID": "rs4"})
+        store.update('rs1',{'POS':101})
+        store.delete('rs2')
+        self.assertEqual(store._snapshot_signature(),snapshot_signature)
+        self.assertGreater(os.path.getsize(store.log_path),0)
+        data=VariantStore(self.path).data
+        self.assertEqual(sorted(data['ID']),['rs1','rs3','rs4'])
+        self.assertEqual(int(data.loc[data['ID']=='rs1','POS'].iloc[0]),101)
+
+    #check that compaction merges the log into a new snapshot without applying any operation twice
+    def test_7_compaction(self):
+        store=VariantStore(self.path)
+        store.insert({"CHROM": "chrX", "POS": 1, "ALT": "A", "REF": "G","ID": "rs4"})
+        store.compact()
+        self.assertEqual(os.path.getsize(store.log_path),0)
+        self.assertEqual(sorted(VariantStore(self.path).data['ID']),['rs1','rs2','rs3','rs4'])
+        #simulate a crash after the checkpoint was logged and the snapshot replaced, but before the log was emptied
+        store.insert({"CHROM": "chrX", "POS": 2, "ALT": "A", "REF": "G","ID": "rs5"})
+        with open(store.log_path,'rb') as f:
+            log=f.read()
+        store.compact()
+        with open(store.log_path,'ab') as f:
+            f.write(log+('{"op": "checkpoint", "snapshot": "%s"}\n'%store._generation).encode())
+        self.assertEqual(sorted(VariantStore(self.path).data['ID']),['rs1','rs2','rs3','rs4','rs5'])
+
+    #check that the background compaction starts once the log passes its size threshold
+    def test_8_background_compaction(self):
+        store=VariantStore(self.path,compact_bytes=1)
+        store.insert({"CHROM": "chrX", "POS": 1, "ALT": "A", "REF": "G","ID": "rs4"})
+        for _ in range(100):
+            if os.path.getsize(store.log_path)==0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(os.path.getsize(store.log_path),0)
+        with open(store.current_path) as f:
+            data,_=read_snapshot(os.path.join(store.snapshot_path,f.read()))
+        self.assertIn('rs4',list(data['ID']))
+
+    #check that a snapshot is memory-mapped and is enough to load the dataset
+    def test_9_snapshot_loading(self):
+        store=VariantStore(self.path)
+        store.insert({"CHROM": "chrX", "POS": 1, "ALT": "A", "REF": "G","ID": "rs4"})
+        store.compact()
+        os.remove(self.path)
+        store=VariantStore(self.path)
+        self.assertEqual(sorted(store.data['ID']),['rs1','rs2','rs3','rs4'])
+        self.assertTrue(isinstance(store.data['POS'].values.base,np.memmap) or isinstance(store.data['POS'].values,np.memmap))
+        self.assertEqual(store.header.meta('fileformat'),['VCFv4.1'])
+        store.update('rs4',{'POS':2})
+        self.assertEqual(int(store.lookup_id('rs4')['POS'].iloc[0]),2)
+
+    #check that the dataset can be exported as csv and as vcf
+    def test_10_export(self):
+        store=VariantStore(self.path)
+        store.insert({"CHROM": "chrX", "POS": 1, "ALT": "A", "REF": "G","ID": "rs4"})
+        store.export(os.path.join(self.folder,'export.csv'))
+        self.assertEqual(sorted(pd.read_csv(os.path.join(self.folder,'export.csv'))['ID']),['rs1','rs2','rs3','rs4'])
+        for name in ['export.vcf','export.vcf.gz']:
+            store.export(os.path.join(self.folder,name))
+            df,header,_=ingest(os.path.join(self.folder,name))
+            self.assertEqual(sorted(df['ID']),['rs1','rs2','rs3','rs4'])
+            self.assertEqual(header.meta('fileformat'),['VCFv4.1'])
+
+    #check that a batch of inserts is appended at once, logged once and replayed by a new process
+    def test_11_batch_apply(self):
+        store=VariantStore(self.path)
+        rows=[{"CHROM": "chr%d"%(n%3+1), "POS": 1000-n, "ALT": "A", "REF": "G","ID": "rs%d"%(n+10)} for n in range(100)]
+        results=store.apply([{'op':'insert','row':row} for row in rows]+[{'op':'delete','id':'rs10'},{'op':'delete','id':'rs99999'}])
+        self.assertEqual(results[-2:],[True,False])
+        with open(store.log_path) as f:
+            self.assertEqual(len(f.readlines()),101)
+        self.assertEqual(store.data.shape[0],102)
+        positions=list(store.lookup_regions([('chr2',None,None)])['POS'])
+        self.assertEqual(positions,sorted(positions))
+        self.assertEqual(VariantStore(self.path).data.shape[0],102)
+        self.assertEqual(store.apply([{'op':'delete','id':'rs11'},{'op':'update','id':'rs11','fields':{'POS':1}}],strict=True),[None,False])
+        self.assertEqual(store.lookup_id('rs11').shape[0],1)
+
+    #check that writes leave the memory-mapped snapshot frame untouched, inserts going to a few delta segments and deletes to tombstones
+    def test_12_delta_writes(self):
+        store=VariantStore(self.path)
+        store.refresh()
+        base=store._data.base
+        for n in range(100):
+            store.insert({"CHROM": "chr1", "POS": 150+n, "ALT": "AT", "REF": "G","ID": "rs%d"%(n+10),"FILTER": "q%d"%n})
+        store.delete('rs2')
+        store.delete('rs10')
+        self.assertIs(store._data.base,base)
+        self.assertLessEqual(len(store._data.segments),7)
+        self.assertEqual(list(store.lookup_regions([('chr1',100,152)])['ID']),['rs1','rs11','rs12'])
+        self.assertEqual(store.lookup_id('rs2').shape[0],0)
+        self.assertEqual(list(store.rows(np.array([0,1,2,4]))['ID']),['rs1','rs3','rs11'])
+        self.assertEqual(store.lookup_id('rs109')['FILTER'].iloc[0],'q99')
+        self.assertTrue(store.update('rs1',{'FILTER':'q5','POS':300}))
+        self.assertEqual(store.lookup_position('chr1',300)['FILTER'].dtype.name,'category')
+        self.assertEqual(store.data.shape[0],101)
+        store.compact()
+        self.assertEqual((len(store._data.segments),len(store._data.deleted)),(0,0))
+        self.assertEqual(sorted(VariantStore(self.path).data['ID']),sorted(['rs1','rs3']+['rs%d'%(n+10) for n in range(1,100)]))
+
+    #check that string columns are memory-mapped dictionaries that writes and compaction keep sorted and free of unused strings
+    def test_13_string_dictionaries(self):
+        store=VariantStore(self.path)
+        store.refresh()
+        with open(os.path.join(store.snapshot_path,store._generation,'manifest.json')) as f:
+            self.assertNotIn('rs1',f.read())
+        ids=store._data.base['ID'].values
+        self.assertIsInstance(ids,DictionaryArray)
+        self.assertIsInstance(ids.dictionary.buffer,np.memmap)
+        self.assertEqual(ids.dictionary.get_loc('rs3'),2)
+        store.insert({"CHROM": "chrX", "POS": 1, "ALT": "A", "REF": "G","ID": "rs0"})
+        self.assertTrue(store.update('rs3',{'ID':'rs30','INFO':5}))
+        store.delete('rs2')
+        self.assertEqual(store.lookup_id('rs30')['INFO'].tolist(),[5])
+        self.assertEqual(store.data['ID'].dtype.name,'dictionary')
+        store.compact()
+        data,_=read_snapshot(os.path.join(store.snapshot_path,store._generation))
+        dictionary=data['ID'].values.dictionary
+        self.assertEqual([dictionary[code] for code in range(len(dictionary))],['rs0','rs1','rs30'])
+        self.assertEqual(data.loc[data['ID']=='rs1','POS'].tolist(),[100])
+        self.assertEqual(VariantStore(self.path).lookup_id('rs30')['INFO'].tolist(),[5])
+
+
+def call_asgi(asgi_app,path,query=b'',headers=[],method='GET',body=b''):
+    '''
+        Sends one http request to an ASGI app.
+
+        Return:
+        int: the status of the response
+        bytes: the body of the response
+        int: the number of body messages the response was sent in
+    '''
+    messages=[]
+    async def receive():
+        return {'type':'http.request','body':body,'more_body':False}
+    async def send(message):
+        messages.append(message)
+    scope={'type':'http','method':method,'path':path,'query_string':query,'headers':headers,'http_version':'1.1','scheme':'http'}
+    asyncio.run(asgi_app(scope,receive,send))
+    bodies=[message['body'] for message in messages if message['type']=='http.response.body']
+    return messages[0]['status'],b''.join(bodies),len(bodies)
+
+
+class AsgiTest(unittest.TestCase):
+
+    #check that cheap requests are answered by the threads and heavy ones by the worker processes, with the same responses as the WSGI app
+    def test_1_inline_and_heavy(self):
+        asgi_app=create_app(processes=1)
+        try:
+            accept=[(b'accept',b'application/json')]
+            expected=app.test_client().get('/result?id=rs62635297',headers={'Accept':'application/json'}).data
+            self.assertEqual(call_asgi(asgi_app,'/result',b'id=rs62635297',accept)[:2],(200,expected))
+            self.assertEqual(call_asgi(asgi_app,'/result',b'id=dummyID',accept)[0],404)
+            expected=app.test_client().get('/result?region=chr1',headers={'Accept':'application/json'}).data
+            self.assertEqual(call_asgi(asgi_app,'/result',b'region=chr1',accept)[:2],(200,expected))
+            self.assertIsNotNone(asgi_app._process_pool)
+            status,body,messages=call_asgi(asgi_app,'/result',b'region=chr1',[(b'accept',b'application/x-ndjson')])
+            self.assertEqual(status,200)
+            self.assertEqual(len(body.splitlines()),10)
+        finally:
+            asgi_app.shutdown()
+
+    #check which requests are sent to the worker processes
+    def test_2_heavy_requests(self):
+        def heavy(path,query=b'',accept=b'application/json',method='GET'):
+            return is_heavy(build_environ({'method':method,'path':path,'query_string':query,'headers':[(b'accept',accept)]},b''))
+        self.assertFalse(heavy('/result',b'id=rs1'))
+        self.assertFalse(heavy('/result',b'region=chr1:1-1000'))
+        self.assertTrue(heavy('/result',b'region=chr1'))
+        self.assertTrue(heavy('/result',b'region=chr1:1-1000&per_page=5000'))
+        self.assertFalse(heavy('/result',b'region=chr1:1-1000&per_page=500',b'application/xml'))
+        self.assertFalse(heavy('/result',b'region=chr1',b'application/x-ndjson'))
+        self.assertTrue(heavy('/result/batch',method='POST'))
+
+    #check that requests are refused with 503 when too many are pending
+    def test_3_backpressure(self):
+        asgi_app=create_app(processes=0,max_pending=0)
+        status,body,_=call_asgi(asgi_app,'/result',b'id=rs62635297',[(b'accept',b'application/json')])
+        self.assertEqual(status,503)
+        self.assertEqual(json.loads(body)['error'],'Service unavailable')
+
+    #check that a worker process dying breaks only the request it was serving, the pool being started again for the next ones
+    def test_4_broken_pool(self):
+        asgi_app=create_app(processes=1)
+        try:
+            accept=[(b'accept',b'application/json')]
+            self.assertEqual(call_asgi(asgi_app,'/result',b'region=chr1',accept)[0],200)
+            pool=asgi_app._process_pool
+            for process in list(pool._processes.values()):
+                process.kill()
+                process.join()
+            self.assertEqual(call_asgi(asgi_app,'/result',b'region=chr1',accept)[0],503)
+            self.assertIsNot(asgi_app._process_pool,pool)
+            self.assertEqual(call_asgi(asgi_app,'/result',b'region=chr1',accept)[0],200)
+        finally:
+            asgi_app.shutdown()
+
+
+class CacheTest(unittest.TestCase):
+
+    #check the lru eviction, the expiration and the discarding of responses computed before an invalidation
+    def test_1_eviction(self):
+        cache=ResponseCache(max_entries=2,ttl=60)
+        for key in ['a','b','c']:
+            cache.put(key,key.encode(),'application/json',{},cache.version)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c').body,b'c')
+        version=cache.version
+        cache.invalidate([])
+        cache.put('d',b'd','application/json',{},version)
+        self.assertIsNone(cache.get('d'))
+        cache.ttl=0
+        cache.put('e',b'e','application/json',{},cache.version)
+        time.sleep(0.01)
+        self.assertIsNone(cache.get('e'))
+        self.assertEqual(cache.stats()['evictions'],2)
+        self.assertEqual(cache.stats()['expirations'],1)
+
+    #check that only the entries built from a changed id, position or region are invalidated
+    def test_2_invalidation(self):
+        cache=ResponseCache()
+        cache.put('id',b'1','application/json',{'ids':['rs1']},0)
+        cache.put('pos',b'2','application/json',{'positions':[('chr1',100)]},0)
+        cache.put('region',b'3','application/json',{'regions':[('chr2',10,20)]},0)
+        cache.put('open',b'4','application/json',{'regions':[('chr2',30,None)]},0)
+        self.assertEqual(cache.invalidate([('rs9','chr2',25),('rs8','chr3',100)]),0)
+        self.assertEqual(cache.invalidate([('rs9','chr2',15),('rs1','chr1',5)]),2)
+        self.assertEqual(cache.invalidate([('rs7','chr2',1000)]),1)
+        self.assertIsNotNone(cache.get('pos'))
+        self.assertEqual(cache.invalidate(None),1)
+
+
+class ValidationTest(unittest.TestCase):
+
+    #check the prefixes, the multi base and multi allelic REF/ALT values and that all the errors of a payload are reported
+    def test_1_rules(self):
+        valid=dict(POST_BODY,REF='AT',ALT='A,<DEL>')
+        errors=validate_records([valid,dict(POST_BODY,CHROM='chrchr1',ID='rsrs1'),{'CHROM':'chr23','POS':'1','ID':'rs1','REF':'Z'},5])
+        self.assertEqual(errors[0],[])
+        self.assertEqual(errors[1],['CHROM field must end with one character among X,Y and M','ID field must only have integers after the rs string'])
+        self.assertEqual(errors[2],["Request body is missing this requiered field(s):['ALT']",'CHROM field must end with a number between 1 and 22',
+                                    'REF field must be made of the bases A,C,G,T,N or be .','POS field must be an integer'])
+        self.assertEqual(errors[3],['Request body must be a json object'])
+        quals=[validate_records([dict(POST_BODY,QUAL=qual)]) for qual in [50,'31.5','.','1e3',None,'abc',True,'']]
+        self.assertEqual(quals,[[[]]]*5+[[['QUAL field must be a number or be .']]]*3)
+        self.assertEqual(validate_records([dict(POST_BODY,FILTER=['PASS'],INFO=1)])[0],['FILTER field must be a string or a number'])
+        self.assertEqual(validate_records([dict(POST_BODY,foo=None)])[0],["Request body has some extra unsupported field(s):['foo']"])
+
+    #check that big batches (validated column-wise) and small ones (validated record by record) give the same errors
+    def test_2_batches(self):
+        payloads=[POST_BODY,POST_BODY_WRONG,dict(POST_BODY,POS=True,ALT=['A'],extra=1),{},dict(POST_BODY,ID=None,REF='.'),dict(POST_BODY,QUAL='abc'),dict(POST_BODY,QUAL=12.5),
+                  dict(POST_BODY,FILTER=['PASS'],INFO={'DP':1}),dict(POST_BODY,foo=None),
+                  dict(POST_BODY,POS=1.0,QUAL=True),dict(POST_BODY,QUAL=1),dict(POST_BODY,QUAL=1.0)]*SMALL_BATCH
+        self.assertEqual(validate_records(payloads),[errors for payload in payloads for errors in validate_records([payload])])
+        df=pd.DataFrame([dict(POST_BODY,QUAL='.'),dict(POST_BODY,POS='12',QUAL='20'),dict(POST_BODY,POS='x',CHROM='chrX1',QUAL='high')])
+        self.assertEqual(validate_frame(df),{2:['CHROM field must end with one character among X,Y and M','POS field must be an integer','QUAL field must be a number or be .']})
+
+
+class DatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder=tempfile.mkdtemp()
+        self.config=dict(app.config)
+        write_vcf(self.folder,[('chr1',100,'rs1'),('chr1',200,'rs2')],'a.vcf')
+        write_vcf(self.folder,[('chr1',150,'rs1')],'b.vcf')
+        cohort=VCF_HEADER.replace('NA12877 single 20180302','S1\tS2')
+        with open(os.path.join(self.folder,'cohort.vcf'),'w') as f:
+            f.write(cohort+'chr1\t120\trs1\tA\tG\t50\tPASS\tDP=10\tGT\t0/1\t1/1\n')
+        app.config.update(DATASETS={'a':os.path.join(self.folder,'a.vcf')},DATASET_DIR=self.folder)
+        self.client=app.test_client()
+
+    def tearDown(self):
+        app.config.update(self.config)
+        shutil.rmtree(self.folder)
+
+    #check that requests are sent to the dataset named by the dataset parameter, with the sample columns of that dataset
+    def test_1_single_dataset(self):
+        get=lambda url: self.client.get(url,headers={'Accept':'application/json'})
+        self.assertEqual(list(get('/result?id=rs2&dataset=a').json['data'].values())[0]['POS'],200)
+        self.assertEqual(get('/result?id=rs2&dataset=b').status_code,404)
+        self.assertEqual(get('/result?id=rs1&dataset=missing').status_code,404)
+        row=list(get('/result?id=rs1&dataset=cohort&sample=S2').json['data'].values())[0]
+        self.assertEqual((row['S2'],'S1' in row),('1/1',False))
+        self.assertEqual(get('/result?id=rs1&dataset=a&sample=S2').status_code,404)
+        headers={'Authorization':'password','Content-Type':'application/json'}
+        body=dict(POST_BODY,S1='0/0',S2='0/1')
+        self.assertEqual(self.client.post('/result?dataset=cohort',headers=headers,json=body).status_code,201)
+        self.assertEqual(self.client.post('/result?dataset=b',headers=headers,json=body).status_code,400)
+        self.assertEqual(self.client.post('/result?dataset=a,b',headers=headers,json=POST_BODY).status_code,400)
+
+    #check that queries over several datasets are merged dataset by dataset and paginated over the merged entries
+    def test_2_fan_out(self):
+        get=lambda url: self.client.get(url,headers={'Accept':'application/json'})
+        body=get('/result?region=chr1&dataset=b,a&per_page=2').json
+        self.assertEqual(body['meta']['datasets'],{'a':2,'b':1})
+        self.assertEqual(sorted(body['data']),['a:0','b:0'])
+        self.assertEqual(list(get('/result?region=chr1&dataset=b,a&per_page=2&page=2').json['data']),['a:1'])
+        body=get('/result?id=rs1&dataset=*').json
+        self.assertEqual(body['meta']['datasets'],{'a':1,'b':1,'cohort':1})
+        self.assertEqual(list(get('/result?id=rs1&dataset=*&sample=S1').json['meta']['datasets']),['cohort'])
+        self.assertEqual(self.client.get('/result?id=rs1&dataset=*',headers={'Accept':'application/xml'}).status_code,200)
+        self.assertEqual(get('/result?id=rs1&dataset=a,b&cursor=x').status_code,400)
+
+    #check that a dataset removed from the config is no longer served
+    def test_4_removed_dataset(self):
+        get=lambda url: self.client.get(url,headers={'Accept':'application/json'})
+        other=tempfile.mkdtemp(dir=self.folder)
+        app.config.update(DATASETS={'a':os.path.join(self.folder,'a.vcf'),'extra':write_vcf(other,[('chr2',10,'rs1')],'extra.vcf')})
+        self.assertEqual(get('/result?id=rs1&dataset=*').json['meta']['datasets'],{'a':1,'b':1,'cohort':1,'extra':1})
+        app.config.update(DATASETS={'a':os.path.join(self.folder,'a.vcf')})
+        self.assertEqual(get('/result?id=rs1&dataset=extra').status_code,404)
+        self.assertEqual(get('/result?id=rs1&dataset=*').json['meta']['datasets'],{'a':1,'b':1,'cohort':1})
+
+    #check that at most max_resident stores are kept open, the least recently used one being closed
+    def test_3_lru_eviction(self):
+        registry=DatasetRegistry(max_resident=2,folder=self.folder)
+        self.assertEqual(registry.names(),['a','b','cohort'])
+        a,b=registry.get('a'),registry.get('b')
+        registry.get('a')
+        cohort=registry.get('cohort')
+        self.assertEqual(registry.resident(),[a,cohort])
+        self.assertTrue(b._closed)
+        self.assertEqual(registry.samples('cohort'),['S1','S2'])
+        self.assertEqual(registry.map(lambda name: registry.get(name).lookup_id('rs1').shape[0],['a','b','cohort']),[1,1,1])
+
+
+class FilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder=tempfile.mkdtemp()
+        self.config=dict(app.config)
+        header=('##fileformat=VCFv4.1\n##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth, total">\n'
+                '##INFO=<ID=AF,Number=A,Type=Float,Description="AF">\n##INFO=<ID=DB,Number=0,Type=Flag,Description="dbSNP">\n'
+                '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+                '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\n')
+        with open(os.path.join(self.folder,'cohort.vcf'),'w') as f:
+            f.write(header)
+            for i in range(10):
+                f.write('chr1\t%d\trs%d\tA\tG,T\t%d\tPASS\tDP=%d;AF=0.%d,0.5%s\tGT\t%s\t0/0\n'%(100*(i+1),i,20+i*5,i*3,i,';DB' if i%2 else '',['0/1','1/1'][i%2]))
+        app.config.update(DATASETS={'cohort':os.path.join(self.folder,'cohort.vcf')})
+        self.client=app.test_client()
+
+    def tearDown(self):
+        app.config.update(self.config)
+        shutil.rmtree(self.folder)
+
+    def get(self,url):
+        return self.client.get(url,headers={'Accept':'application/json'})
+
+    #check that the INFO and FORMAT keys are parsed into typed sparse columns stored with the snapshot
+    def test_1_parsed_columns(self):
+        store=VariantStore(os.path.join(self.folder,'cohort.vcf'))
+        store.refresh()
+        parsed=read_parsed(os.path.join(store.snapshot_path,store._generation))
+        self.assertEqual(sorted(parsed),[('INFO','AF'),('INFO','DB'),('INFO','DP'),('S1','GT'),('S2','GT')])
+        self.assertEqual(parsed[('INFO','AF')].values.shape,(10,2))
+        self.assertEqual(parsed[('INFO','DB')].labels.tolist(),[1,3,5,7,9])
+        present,values=parsed[('INFO','DP')].take(np.array([2,42]))
+        self.assertEqual((present.tolist(),values[0,0]),([True,False],6.0))
+        self.assertEqual(parse_columns(store.data,None),{})
+
+    #check that filters are evaluated before the pagination, on every key type and after writes
+    def test_2_filter(self):
+        body=self.get('/result?region=chr1&dataset=cohort&per_page=2&filter=QUAL>30%26INFO.DP>=10%26GT=1/1').json
+        self.assertEqual((body['meta']['entries'],body['meta']['pages']),(3,2))
+        self.assertEqual([row['ID'] for row in body['data'].values()],['rs5','rs7'])
+        self.assertEqual(self.get('/result?region=chr1&dataset=cohort&filter=INFO.DB&filter=INFO.AF<0.2').json['meta']['entries'],1)
+        self.assertEqual(self.get('/result?region=chr1&dataset=cohort&filter=S2.GT!=0/0').status_code,404)
+        self.assertEqual(self.get('/result?region=chr1&dataset=cohort&filter=GT=1/1&sample=S2').status_code,404)
+        self.assertEqual(self.get('/result?region=chr1&dataset=cohort&filter=FILTER=PASS%26INFO.AF=0.5').json['meta']['entries'],10)
+        for wrong in ['INFO.XX=1','QUAL>high','REF>A','INFO.DB=1','POS','QUAL>30&INFO.DP>=10']:
+            self.assertEqual(self.get('/result?region=chr1&dataset=cohort&filter='+wrong).status_code,400)
+        first=self.get('/result?region=chr1&dataset=cohort&per_page=2&filter=INFO.DB').json
+        second=self.get('/result?region=chr1&dataset=cohort&per_page=2&filter=INFO.DB&cursor='+first['meta']['next']).json
+        self.assertEqual([row['ID'] for row in second['data'].values()],['rs5','rs7'])
+        headers={'Authorization':'password','Content-Type':'application/json'}
+        self.client.put('/result?id=rs0&dataset=cohort',headers=headers,json={'CHROM':'chr1','POS':100,'ID':'rs0','REF':'A','ALT':'G','INFO':'DP=99'})
+        self.assertEqual([row['ID'] for row in self.get('/result?region=chr1&dataset=cohort&filter=INFO.DP>50').json['data'].values()],['rs0'])
+
+
+class XmlWriterTest(unittest.TestCase):
+
+    #check that the writer renders like dict2xml, quirks included: label 0 not wrapped, sanitized tags, escaping, missing values
+    def test_1_dict2xml_compatible(self):
+        df=pd.DataFrame({'CHROM':pd.Categorical(['chr1',None,'a<b']),'POS':np.array([5,0,7],dtype=np.int64),'QUAL':[50.0,float('nan'),1e20],
+                         'INFO':['DP=1&AF=2','multi\nline',None],'NA12877 single 20180302':['0/1','1|1','0/0'],'xmlcol':pd.array([1,None,3],dtype='Int64')},
+                        index=[12,0,3])
+        for data in [{'meta':{'entries':3,'next':None,'has_next_page':False},'data':df},{'data':df.iloc[:0]},
+                     {'meta':{'not_found':['rs1','<rs2>'],'keys':[]},'results':[{'key':'chr1','data':{}},{'key':'x','data':{0:{'A':1}}}]}]:
+            expected={key:to_records(value) if isinstance(value,pd.DataFrame) else value for key,value in data.items()}
+            self.assertEqual(to_xml(data),dict2xml(expected))
+
+    #check that xml GET responses are the dict2xml rendering of the json ones
+    def test_2_get_xml(self):
+        client=app.test_client()
+        for url in ['/result?id=rs62635297','/result?region=chr1&per_page=4&page=2']:
+            body=client.get(url,headers={'Accept':'application/json'}).json
+            body['data']={int(label):row for label,row in body['data'].items()}
+            self.assertEqual(client.get(url,headers={'Accept':'application/xml'}).get_data(as_text=True),dict2xml(body))
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config=dict(app.config)
+        self.client=app.test_client()
+        metrics.reset()
+
+    def tearDown(self):
+        app.config.update(self.config)
+
+    #check the request counters, the stage histograms and the dataset gauges of /metrics
+    def test_1_metrics(self):
+        self.client.get('/result?id=rs62635297',headers={'Accept':'application/json'})
+        self.client.get('/result?id=rs62635297',headers={'Accept':'application/xml'})
+        self.client.get('/result?id=rs1',headers={'Accept':'application/json'})
+        response=self.client.get('/metrics')
+        self.assertEqual(response.status_code,200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines=response.get_data(as_text=True).splitlines()
+        self.assertIn('vcf_api_requests_total{method="GET",status="200",representation="application/xml"} 1',lines)
+        self.assertIn('vcf_api_requests_total{method="GET",status="404",representation="application/json"} 1',lines)
+        self.assertIn('vcf_api_request_duration_seconds_count{method="GET",status="200",representation="application/json"} 1',lines)
+        for stage in ['lookup','paginate','serialize']:
+            self.assertTrue(any(line.startswith('vcf_api_stage_duration_seconds_count{stage="%s"}'%stage) for line in lines),stage)
+        self.assertTrue(any(line.startswith('vcf_api_dataset_rows ') for line in lines))
+        self.assertTrue(any(line.startswith('vcf_api_process_resident_bytes ') for line in lines))
+
+    #check that nothing is recorded when metrics are disabled and that the sampling profiler dumps one request out of N
+    def test_2_disabled_and_profiler(self):
+        folder=tempfile.mkdtemp()
+        app.config.update(METRICS_ENABLED=False,PROFILE_EVERY=2,PROFILE_DIR=folder)
+        for _ in range(4):
+            self.client.get('/result?id=rs62635297',headers={'Accept':'application/json'})
+        self.assertNotIn('vcf_api_requests_total',metrics.render())
+        self.assertEqual(len([name for name in os.listdir(folder) if name.endswith('-GET-result.prof')]),2)
+        shutil.rmtree(folder)
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    #check that the suite runs every scenario with the expected status codes and leaves the app config as it was
+    def test_1_suite(self):
+        import benchmark
+        config=dict(app.config)
+        results=benchmark.bench_suite(500,requests=4,concurrency=(1,2))
+        self.assertEqual(dict(app.config),config)
+        statuses={name:list(result['statuses']) for name,result in results['scenarios'].items()}
+        self.assertEqual(statuses['get_id_xml'],['200'])
+        self.assertEqual(statuses['page_last'],['200'])
+        self.assertEqual([statuses['post'],statuses['put'],statuses['delete']],[['201'],['200'],['204']])
+        self.assertEqual(results['concurrency']['2']['requests'],8)
+        rows,regressed=benchmark.compare({'results':[results]},{'results':[results]})
+        self.assertFalse(regressed)
+        self.assertEqual(len(rows),2*(len(results['scenarios'])+2))
+
+
+class IngestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder=tempfile.mkdtemp()
+        self.rows=[('chr%d'%(n%3+1),n+1,'rs%d'%n) for n in range(25)]
+        self.path=write_vcf(self.folder,self.rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    #check that a plain vcf is parsed chunk by chunk into typed columns and that its metadata is kept
+    def test_1_ingest_chunks(self):
+        progress=[]
+        df,header,stats=ingest(self.path,chunksize=10,progress=lambda stats: progress.append(stats.rows))
+        self.assertEqual(progress,[10,20,25])
+        self.assertEqual(stats.rows,25)
+        self.assertEqual(list(df['ID']),[row[2] for row in self.rows])
+        self.assertEqual(df['POS'].dtype,'int32')
+        self.assertEqual(df['QUAL'].dtype,'float32')
+        self.assertEqual(df['CHROM'].dtype,'category')
+        self.assertEqual(header.meta('fileformat'),['VCFv4.1'])
+        self.assertEqual(header.columns[0],'CHROM')
+
+    #check that the typed representation uses less memory than one string per cell
+    def test_3_memory_report(self):
+        df,_,_=ingest(self.path)
+        report=memory_report(df)
+        self.assertEqual(report['rows'],25)
+        self.assertLess(report['bytes_per_variant_after'],report['bytes_per_variant_before'])
+        self.assertEqual(report['columns']['CHROM']['dtype'],'category')
+
+    #check that writes keep the column types of the store
+    def test_4_writes_keep_types(self):
+        store=VariantStore(self.path)
+        dtypes={col:dtype.name for col,dtype in store.data.dtypes.items()}
+        store.insert({"CHROM": "chrY", "POS": 5, "ALT": "T", "REF": "C","ID": "rs99","QUAL":"."})
+        store.update('rs99',{'CHROM':'chrM','FILTER':'LowQual','QUAL':12})
+        self.assertEqual({col:dtype.name for col,dtype in store.data.dtypes.items()},dtypes)
+        row=store.lookup_id('rs99').iloc[0]
+        self.assertEqual((row['CHROM'],row['POS'],row['FILTER'],row['QUAL']),('chrM',5,'LowQual',12.0))
+
+    #check that gzip and bgzip (multi member gzip) files are read and served by the store
+    def test_2_ingest_gzip(self):
+        with open(self.path,'rb') as f:
+            content=f.read()
+        path=os.path.join(self.folder,'compressed.vcf.gz')
+        with open(path,'wb') as f:
+            middle=content.index(b'\nchr')+1
+            f.write(gzip.compress(content[:middle])+gzip.compress(content[middle:]))
+        df,header,_=ingest(path)
+        self.assertEqual(df.shape[0],25)
+        store=VariantStore(path)
+        self.assertEqual(store.lookup_id('rs7').shape[0],1)
+        self.assertEqual(store.header.meta('fileformat'),['VCFv4.1'])
+        self.assertTrue(os.path.exists(os.path.join(self.folder,'compressed.snapshot','CURRENT')))
+
+
+def insert_rows(path,prefix,count):
+    '''
+        Inserts count entries with ids rs<prefix><n> through a new store, used by the concurrency tests.
+
+        Parameters:
+        path,str: the path of the dataset
+        prefix,int: the prefix of the ids
+        count,int: the number of entries to insert
+    '''
+    store=VariantStore(path,compact_bytes=2048)
+    for n in range(count):
+        store.insert({"CHROM": "chrX", "POS": n+1, "ALT": "A", "REF": "G","ID": "rs%d%04d"%(prefix,n)})
+
+
+class ConcurrencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder=tempfile.mkdtemp()
+        self.path=write_vcf(self.folder,[('chr1',100,'rs1'),('chr1',200,'rs2'),('chr2',50,'rs3')])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    #check that parallel writers and readers of one store lose no update
+    def test_1_threads_no_lost_updates(self):
+        store=VariantStore(self.path,compact_bytes=2048)
+        errors=[]
+        def write(prefix):
+            for n in range(50):
+                store.insert({"CHROM": "chrX", "POS": n+1, "ALT": "A", "REF": "G","ID": "rs%d%04d"%(prefix,n)})
+                store.update('rs1',{'POS':prefix*1000+n})
+        def read():
+            for _ in range(200):
+                if store.lookup_id('rs1').shape[0]!=1 or store.lookup_regions([('chr2',None,None)]).shape[0]!=1:
+                    errors.append('inconsistent read')
+        threads=[threading.Thread(target=write,args=(prefix,)) for prefix in range(1,9)]+[threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors,[])
+        self.assertEqual(store.data.shape[0],3+8*50)
+        self.assertEqual(VariantStore(self.path).data.shape[0],3+8*50)
+
+    #check that a compaction lets lookups run while it writes the new generation, and holds back the writes
+    def test_3_compaction_blocks_writes_only(self):
+        store=VariantStore(self.path)
+        store.insert({"CHROM": "chrX", "POS": 1, "ALT": "A", "REF": "G","ID": "rs4"})
+        started,release=threading.Event(),threading.Event()
+        write_generation=store._write_generation
+        def slow_write_generation(data,header):
+            started.set()
+            release.wait(10)
+            return write_generation(data,header)
+        store._write_generation=slow_write_generation
+        compaction=threading.Thread(target=store.compact)
+        compaction.start()
+        self.assertTrue(started.wait(10))
+        self.assertEqual(store.lookup_id('rs4').shape[0],1)
+        writer=threading.Thread(target=store.insert,args=({"CHROM": "chrX", "POS": 2, "ALT": "A", "REF": "G","ID": "rs5"},))
+        writer.start()
+        writer.join(0.2)
+        self.assertTrue(writer.is_alive() and compaction.is_alive())
+        release.set()
+        compaction.join()
+        writer.join()
+        with open(store.log_path) as f:
+            self.assertEqual([json.loads(line)['op'] for line in f],['insert'])
+        self.assertEqual(sorted(VariantStore(self.path).data['ID']),['rs1','rs2','rs3','rs4','rs5'])
+
+    #check that several processes writing the same dataset lose no update
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(),'requires fork')
+    def test_2_processes_no_lost_updates(self):
+        context=multiprocessing.get_context('fork')
+        processes=[context.Process(target=insert_rows,args=(self.path,prefix,40)) for prefix in range(1,5)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertTrue(all(process.exitcode==0 for process in processes))
+        data=VariantStore(self.path).data
+        self.assertEqual(data.shape[0],3+4*40)
+        self.assertEqual(data['ID'].nunique(),3+4*40)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,317 @@
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+
+REQUIRED_FIELDS=['CHROM','ID','POS','ALT','REF'] #fields every payload must have
+ALL_FIELDS=['CHROM','POS','ID','REF','ALT','QUAL','FILTER','INFO','FORMAT','NA12877 single 20180302'] #fields of the default dataset, see VariantStore.fields
+STRING_FIELDS=['CHROM','ID','REF','ALT'] #fields that must be strings, checked by the rules below
+CHECKED_FIELDS=STRING_FIELDS+['POS','QUAL'] #fields having their own checks, the other ones must only be strings or numbers
+ALLELE=r'(?:[ACGTNacgtn]+|\*|<[^<>,]+>)' #bases, a deletion (*) or a symbolic allele (<DEL>)
+QUAL=re.compile(r'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?|\.') #a float or . for a missing quality
+QUAL_MESSAGE='QUAL field must be a number or be .'
+SMALL_BATCH=32 #batches smaller than this are validated record by record, which avoids the fixed cost of the column-wise checks
+
+
+class Rule:
+
+    '''
+        A check of one column: values are valid when they fully match a regular expression.
+        A rule can be limited to the values matching another expression, so that a value gets
+        the message of the most precise rule it breaks.
+    '''
+
+    def __init__(self,column,message,pattern,when=None):
+        '''
+            Parameters:
+            column,str: the column checked
+            message,str: the error message of the values breaking the rule
+            pattern,str: the expression valid values fully match
+            when,str: optional, the rule only applies to the values fully matching this expression
+        '''
+        self.column=column
+        self.message=message
+        self.pattern=pattern
+        self.when=when
+        self._pattern=re.compile(pattern,re.DOTALL)
+        self._when=None if when is None else re.compile(when,re.DOTALL)
+
+    def valid(self,values):
+        '''
+            Parameters:
+            values,Series: strings
+
+            Return:
+            ndarray: a boolean per value, True if the value does not break the rule
+        '''
+        valid = values.str.fullmatch(self.pattern,flags=re.DOTALL).values.astype(bool)
+        if self.when is not None:
+            valid |= ~values.str.fullmatch(self.when,flags=re.DOTALL).values.astype(bool)
+        return valid
+
+    def valid_value(self,value):
+        '''
+            Parameters:
+            value,str: a string
+
+            Return:
+            bool: True if the value does not break the rule
+        '''
+        return (self._when is not None and self._when.fullmatch(value) is None) or self._pattern.fullmatch(value) is not None
+
+
+RULES=[
+    Rule('CHROM','CHROM field must start with chr',r'chr.*'),
+    Rule('CHROM','CHROM field must end with a number between 1 and 22',r'chr0*(?:[1-9]|1[0-9]|2[0-2])',when=r'chr[0-9]+'),
+    Rule('CHROM','CHROM field must end with one character among X,Y and M',r'chr(?:[0-9]+|[XYM])',when=r'chr.*'),
+    Rule('ID','ID field must start with rs',r'rs.*'),
+    Rule('ID','ID field must only have integers after the rs string',r'rs[0-9]+',when=r'rs.*'),
+    Rule('REF','REF field must be made of the bases A,C,G,T,N or be .',r'[ACGTNacgtn]+|\.'),
+    Rule('ALT','ALT field must be a comma separated list of alleles made of the bases A,C,G,T,N (or *, <ID>) or be .',
+         r'%s(?:,%s)*|\.'%(ALLELE,ALLELE)),
+]
+
+
+def validate_value(column,value):
+    '''
+        Checks a single value, e.g. the chromosome of a region query.
+
+        Parameters:
+        column,str: the column of the value
+        value,str: the value
+
+        Return:
+        errors,list: the error messages, empty if the value is valid
+    '''
+    if column in STRING_FIELDS and not isinstance(value,str):
+        return ['%s field must be a string'%column]
+    return [rule.message for rule in RULES if rule.column == column and not rule.valid_value(value)]
+
+
+def _is_missing(value):
+    '''
+        Return:
+        bool: True for the values counted as missing fields, None and NaN
+    '''
+    return value is None or (isinstance(value,float) and value != value)
+
+
+def validate_record(record,fields=ALL_FIELDS):
+    '''
+        Validates a single json payload with the same rules and messages as validate_records.
+
+        Parameters:
+        record,dict: the payload
+        fields,list: the fields a payload can have, those of the dataset it is written to
+
+        Return:
+        errors,list: the error messages, empty if the payload is valid
+    '''
+    if not isinstance(record,dict):
+        return ['Request body must be a json object']
+    errors=[]
+    missing = [column for column in REQUIRED_FIELDS if _is_missing(record.get(column))]
+    if missing:
+        errors.append('Request body is missing this requiered field(s):'+str(missing))
+    #unknown keys are refused whatever their value, null included, so that they never become columns of the dataset
+    extra = [column for column in record if column not in fields]
+    if extra:
+        errors.append('Request body has some extra unsupported field(s):'+str(extra))
+    for column in STRING_FIELDS:
+        if not _is_missing(record.get(column)):
+            errors.extend(validate_value(column,record[column]))
+    if not _is_missing(record.get('POS')) and type(record['POS']) is not int:
+        errors.append('POS field must be an integer')
+    if not _is_missing(record.get('QUAL')) and not valid_qual(record['QUAL']):
+        errors.append(QUAL_MESSAGE)
+    for column in fields:
+        if column not in CHECKED_FIELDS and not _is_missing(record.get(column)) and not isinstance(record[column],(str,int,float)):
+            errors.append('%s field must be a string or a number'%column)
+    return errors
+
+
+def valid_qual(value):
+    '''
+        Return:
+        bool: True if a QUAL value is a number, or a string holding a float or .
+    '''
+    if isinstance(value,str):
+        return QUAL.fullmatch(value) is not None
+    return isinstance(value,(int,float,np.integer,np.floating)) and not isinstance(value,(bool,np.bool_))
+
+
+def _distinct(values):
+    '''
+        Factorizes a column so that rules are evaluated once per distinct value.
+
+        Parameters:
+        values,Series: the column
+
+        Return:
+        codes,ndarray: the code of every cell, -1 for missing values
+        uniques,Series: the distinct values
+    '''
+    try:
+        codes,uniques = pd.factorize(values)
+    except TypeError:
+        #lists and objects sent in json payloads are not hashable, they only need to be told apart from strings
+        codes,uniques = pd.factorize(values.map(lambda x: x if isinstance(x,(str,int,float,bool)) or x is None else type(x)))
+    return codes,pd.Series(uniques,dtype=object)
+
+
+def _numbers_or_strings(values,types,pattern=None):
+    '''
+        Checks a column whose values must be numbers of some types (booleans excluded) or strings fully matching an
+        expression. Columns of such numbers only are valid at once, the other ones are factorized and checked once per
+        distinct value, except for the cells holding integral numbers: factorize gives True, 1 and 1.0 the same code,
+        so those are told apart cell by cell.
+
+        Parameters:
+        values,Series: the column
+        types,tuple: the types of the valid numbers
+        pattern,str: the expression valid strings fully match, None if strings are not valid
+
+        Return:
+        ndarray: a boolean per cell, True if it is valid or missing
+    '''
+    kind = pd.api.types.infer_dtype(values,skipna=True)
+    if values.dtype.kind in 'iu' or kind in ('empty','integer') or (float in types and kind in ('floating','mixed-integer-float')):
+        return np.ones(len(values),dtype=bool)
+    codes,uniques = _distinct(values)
+    valid = uniques.map(lambda x: isinstance(x,types) and not isinstance(x,(bool,np.bool_))).values.astype(bool)
+    if pattern is not None:
+        is_str = uniques.map(lambda x: isinstance(x,str)).values.astype(bool)
+        valid |= is_str & uniques.where(is_str,'').astype(str).str.fullmatch(pattern).values.astype(bool)
+    integral = uniques.map(lambda x: isinstance(x,(int,np.integer)) or (isinstance(x,(float,np.floating)) and float(x).is_integer())).values.astype(bool)
+    #code -1 (missing value) takes the trailing element
+    valid,integral = np.append(valid,True).take(codes),np.append(integral,False).take(codes)
+    rows = np.flatnonzero(integral)
+    valid[rows] = [isinstance(x,types) and not isinstance(x,(bool,np.bool_)) for x in values.values[rows]]
+    return valid
+
+
+def _failures(df,present,json_types):
+    '''
+        Evaluates the rules on every column of a batch.
+
+        Parameters:
+        df,DataFrame: the batch, with the supported fields it has
+        present,dict: the boolean mask of the rows having each column
+        json_types,bool: True for json payloads, whose POS must be an integer, False for parsed files, whose POS may be digits
+
+        Return:
+        list: (message,mask) tuples, mask being True for the rows breaking the rule
+    '''
+    failures=[]
+    for column in CHECKED_FIELDS:
+        if column not in df.columns or column not in present:
+            continue
+        if column == 'QUAL':
+            valid = _numbers_or_strings(df[column],(int,float,np.integer,np.floating),QUAL.pattern)
+            failures.append((QUAL_MESSAGE,~valid & present[column]))
+            continue
+        if column == 'POS':
+            #parsed files hold the digits of the positions
+            valid = _numbers_or_strings(df[column],(int,np.integer),None if json_types else '[0-9]+')
+            failures.append(('POS field must be an integer',~valid & present[column]))
+            continue
+        codes,uniques = _distinct(df[column])
+        #code -1 (missing value) takes the last element of the arrays below, missing values are reported as missing fields
+        is_str = np.append(uniques.map(lambda x: isinstance(x,str)).values.astype(bool),True)
+        failures.append(('%s field must be a string'%column,~is_str.take(codes) & present[column]))
+        strings = uniques.where(is_str[:-1],'').astype(str)
+        for rule in RULES:
+            if rule.column == column:
+                valid = np.append(rule.valid(strings) | ~is_str[:-1],True)
+                failures.append((rule.message,~valid.take(codes) & present[column]))
+    if json_types:
+        #lists and objects cannot be written to the other columns
+        for column in df.columns:
+            if column in CHECKED_FIELDS or column not in present:
+                continue
+            codes,uniques = _distinct(df[column])
+            is_scalar = np.append(uniques.map(lambda x: isinstance(x,(str,int,float))).values.astype(bool),True)
+            failures.append(('%s field must be a string or a number'%column,~is_scalar.take(codes) & present[column]))
+    return failures
+
+
+def validate_records(records,fields=ALL_FIELDS):
+    '''
+        Validates a batch of json payloads at once: the rules are evaluated column-wise on the distinct values
+        of the batch and all the errors of every payload are collected.
+
+        Parameters:
+        records,list: the payloads, as dicts
+        fields,list: the fields a payload can have, those of the dataset it is written to
+
+        Return:
+        list: the error messages of every payload, an empty list for the valid ones
+    '''
+    if len(records) < SMALL_BATCH:
+        return [validate_record(record,fields) for record in records]
+    is_dict = np.array([isinstance(record,dict) for record in records],dtype=bool)
+    df = pd.DataFrame([record if isinstance(record,dict) else {} for record in records],dtype=object) if records else pd.DataFrame()
+    fields = list(fields)+[column for column in REQUIRED_FIELDS if column not in fields]
+    present = {column:df[column].notna().values if column in df.columns else np.zeros(len(records),dtype=bool) for column in fields}
+    failures = [('Request body must be a json object',~is_dict)]
+    missing = np.zeros(len(records),dtype=bool)
+    for column in REQUIRED_FIELDS:
+        missing |= ~present[column]
+    failures.append((None,missing & is_dict))
+    extra_columns = [column for column in df.columns if column not in fields]
+    extra = np.zeros(len(records),dtype=bool)
+    for column in extra_columns:
+        #null values are refused too, the column is not enough to tell them from missing keys
+        extra |= np.array([isinstance(record,dict) and column in record for record in records],dtype=bool)
+    failures.append((None,extra))
+    failures += _failures(df[[column for column in fields if column in df.columns]],present,json_types=True)
+
+    invalid = np.zeros(len(records),dtype=bool)
+    for _,mask in failures:
+        invalid |= mask
+    errors = [[] for _ in records]
+    for row in np.flatnonzero(invalid):
+        for i,(message,mask) in enumerate(failures):
+            if not mask[row]:
+                continue
+            if i == 1:
+                message = 'Request body is missing this requiered field(s):'+str([column for column in REQUIRED_FIELDS if not present[column][row]])
+            elif i == 2:
+                message = 'Request body has some extra unsupported field(s):'+str([column for column in records[row] if column not in fields])
+            errors[row].append(message)
+    return errors
+
+
+def validate_frame(df):
+    '''
+        Validates the rows of a parsed vcf file (see vcf.iter_chunks) with the same rules as the json payloads.
+
+        Parameters:
+        df,DataFrame: the rows, having at least the REQUIRED_FIELDS columns
+
+        Return:
+        dict: the error messages of the invalid rows, by row position
+    '''
+    present = {column:df[column].notna().values for column in REQUIRED_FIELDS+['QUAL'] if column in df.columns}
+    failures = _failures(df,present,json_types=False)
+    invalid = np.zeros(df.shape[0],dtype=bool)
+    for _,mask in failures:
+        invalid |= mask
+    return {int(row):[message for message,mask in failures if mask[row]] for row in np.flatnonzero(invalid)}
+
+
+if __name__ == '__main__':
+    #usage: python validation.py <file.vcf[.gz]>, prints the invalid rows and the validation speed
+    from vcf import open_vcf, read_header, iter_chunks
+    rows,invalid,start = 0,0,time.perf_counter()
+    with open_vcf(sys.argv[1]) as f:
+        header = read_header(f)
+        for chunk in iter_chunks(f,header):
+            for row,messages in validate_frame(chunk).items():
+                print('line %d: %s'%(rows+row+1,'; '.join(messages)))
+                invalid += 1
+            rows += chunk.shape[0]
+    seconds = time.perf_counter()-start
+    print({'rows':rows,'invalid':invalid,'seconds':round(seconds,3),'rows_per_sec':round(rows/seconds,1) if seconds > 0 else 0.0},file=sys.stderr)
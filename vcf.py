@@ -0,0 +1,477 @@
+import csv
+import gzip
+import json
+import logging
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+
+logger = logging.getLogger(__name__)
+
+GZIP_MAGIC = b'\x1f\x8b' #first bytes of gzip and bgzip (BGZF) files
+CATEGORICAL_COLUMNS = ['CHROM','REF','ALT','FILTER','FORMAT'] #columns with few distinct values, stored as categorical codes
+NUMERIC_TYPES = ['Integer','Float'] #types of the ##INFO and ##FORMAT definitions parsed as numbers, the other ones being kept as strings
+
+
+class VcfHeader:
+
+    '''
+        The VcfHeader class keeps the header of a vcf file: the '##' metadata lines and the column names.
+    '''
+
+    def __init__(self,lines,columns):
+        '''
+            Parameters:
+            lines,list: the '##' metadata lines, without the leading '##'
+            columns,list: the column names, '#CHROM' being renamed CHROM
+        '''
+        self.lines=lines
+        self.columns=columns
+
+    def meta(self,key):
+        '''
+            Returns the values of a metadata key, e.g. meta('fileformat') or meta('INFO').
+
+            Parameters:
+            key,str: the metadata key
+
+            Return:
+            list: the values of all the lines with that key, in file order
+        '''
+        return [line.partition('=')[2] for line in self.lines if line.partition('=')[0] == key]
+
+
+def open_vcf(path):
+    '''
+        Opens a vcf file for reading as text. Plain, gzip and bgzip compressed files are supported,
+        compression being detected from the content of the file rather than from its name.
+
+        Parameters:
+        path,str: the path of the vcf file
+
+        Return:
+        file: the open text file
+    '''
+    with open(path,'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+    #bgzip files are a series of gzip members, which gzip reads transparently
+    return gzip.open(path,'rt',newline='') if compressed else open(path,'r',newline='')
+
+
+def read_header(f):
+    '''
+        Reads the header of an open vcf file, leaving the file positioned on the first data line.
+
+        Parameters:
+        f,file: the open vcf file
+
+        Return:
+        VcfHeader: the header of the file
+    '''
+    lines=[]
+    for line in f:
+        line = line.rstrip('\r\n')
+        if line.startswith('##'):
+            lines.append(line[2:])
+        else:
+            columns = [x if '#' not in x else 'CHROM' for x in line.split('\t')]
+            return VcfHeader(lines,columns)
+    raise ValueError('The vcf file has no #CHROM header line')
+
+
+def iter_chunks(f,header,chunksize=100000):
+    '''
+        Parses the data lines of an open vcf file into DataFrames of at most chunksize rows,
+        so that memory use is bounded by the chunk size instead of growing with a list of all the lines.
+
+        Parameters:
+        f,file: the open vcf file, positioned on the first data line
+        header,VcfHeader: the header of the file
+        chunksize,int: the number of rows parsed at once
+
+        Return:
+        generator: the DataFrames of the successive chunks, POS being parsed as int64 and the other columns as strings
+    '''
+    dtype = {col:str for col in header.columns}
+    dtype['POS'] = np.int64
+    reader = pd.read_csv(f,sep='\t',header=None,names=header.columns,dtype=dtype,chunksize=chunksize,
+                         na_filter=False,quoting=csv.QUOTE_NONE,engine='c')
+    for chunk in reader:
+        yield chunk
+
+
+def _interned(values):
+    '''
+        Returns a column of strings where equal strings are the same (interned) object.
+
+        Parameters:
+        values,Series: the column
+
+        Return:
+        Series: the column with shared string objects
+    '''
+    codes,uniques = pd.factorize(values)
+    uniques = np.array([sys.intern(x) if isinstance(x,str) else x for x in uniques],dtype=object)
+    result = uniques.take(codes) if len(uniques) else np.array([None]*len(values),dtype=object)
+    result[codes < 0] = None
+    return pd.Series(result,index=values.index,name=values.name)
+
+
+def to_columnar(df):
+    '''
+        Converts a dataset to its compact typed representation:
+        categorical codes for CHROM, REF, ALT, FILTER and FORMAT, int32 POS (int64 if positions do not fit),
+        float32 QUAL (missing '.' values become NaN) and interned strings for INFO and the sample columns.
+
+        Parameters:
+        df,DataFrame: the dataset, with any column types
+
+        Return:
+        DataFrame: the typed dataset, with the same index and columns
+    '''
+    columns={}
+    for col in df.columns:
+        values = df[col]
+        if col in CATEGORICAL_COLUMNS:
+            values = values.astype('category')
+        elif col == 'POS':
+            values = pd.to_numeric(values)
+            if values.dtype.kind == 'i' and (len(values) == 0 or values.max() <= np.iinfo(np.int32).max):
+                values = values.astype(np.int32)
+        elif col == 'QUAL':
+            values = pd.to_numeric(values,errors='coerce').astype(np.float32)
+        elif col != 'ID' and values.dtype == object:
+            values = _interned(values)
+        columns[col] = values
+    return pd.DataFrame(columns,index=df.index)
+
+
+def concat_columnar(chunks):
+    '''
+        Concatenates typed chunks, merging the categories of their categorical columns.
+
+        Parameters:
+        chunks,list: the typed DataFrames, see to_columnar
+
+        Return:
+        DataFrame: the concatenated dataset with a new 0..n-1 index
+    '''
+    if len(chunks) == 1:
+        return chunks[0].reset_index(drop=True)
+    columns={}
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype,pd.CategoricalDtype):
+            columns[col] = pd.Series(union_categoricals([chunk[col] for chunk in chunks]))
+        else:
+            columns[col] = pd.concat([chunk[col] for chunk in chunks],ignore_index=True)
+            if col == 'POS' and columns[col].dtype != chunks[0][col].dtype:
+                columns[col] = columns[col].astype(np.int64)
+    return pd.DataFrame(columns)
+
+
+def _object_bytes(values,shared):
+    '''
+        Computes the memory used by a column of python objects.
+
+        Parameters:
+        values,iterable: the objects of the column
+        shared,bool: True to count objects referenced several times only once, False to count every cell
+
+        Return:
+        int: the number of bytes, pointers included
+    '''
+    values = list(values)
+    pointers = 8*len(values)
+    if shared:
+        values = {id(x):x for x in values}.values()
+    return pointers+sum(sys.getsizeof(x) for x in values)
+
+
+def memory_report(df):
+    '''
+        Compares the memory footprint of a typed dataset with the one of the same data stored as one string per cell,
+        which is how the dataset used to be loaded.
+
+        Parameters:
+        df,DataFrame: the typed dataset, see to_columnar
+
+        Return:
+        dict: the number of rows, the total bytes and the bytes per variant before and after, by column as well
+    '''
+    rows = max(df.shape[0],1)
+    columns={}
+    for col in df.columns:
+        values = df[col]
+        before = _object_bytes((str(x) for x in values),shared=False)
+        if isinstance(values.dtype,pd.CategoricalDtype):
+            after = values.cat.codes.values.nbytes+_object_bytes(values.cat.categories,shared=False)
+        elif values.dtype == object:
+            after = _object_bytes(values,shared=True)
+        else:
+            after = values.values.nbytes
+        columns[col] = {'dtype':str(values.dtype),'bytes_before':before,'bytes_after':after}
+    before = sum(col['bytes_before'] for col in columns.values())
+    after = sum(col['bytes_after'] for col in columns.values())
+    return {'rows':df.shape[0],
+            'bytes_before':before,
+            'bytes_after':after,
+            'bytes_per_variant_before':round(before/rows,1),
+            'bytes_per_variant_after':round(after/rows,1),
+            'columns':columns}
+
+
+def to_records(df,orient='index'):
+    '''
+        Converts a dataset to a dictionary of plain python values (int, float, str), missing values becoming None,
+        so that it can be rendered as json or xml whatever the column types.
+
+        Parameters:
+        df,DataFrame: the dataset
+        orient,str: 'index' for {label:{column:value}}, 'dict' for {column:{label:value}}
+
+        Return:
+        dict: the dataset
+    '''
+    df = df.astype(object)
+    return df.where(pd.notna(df),None).to_dict(orient=orient)
+
+
+def field_definitions(header):
+    '''
+        Reads the ##INFO and ##FORMAT definitions of a vcf header.
+
+        Parameters:
+        header,VcfHeader: the header, can be None
+
+        Return:
+        dict: the (Number,Type) of every INFO and FORMAT key, e.g. {'INFO':{'DP':('1','Integer')},'FORMAT':{'GT':('1','String')}}
+    '''
+    definitions={'INFO':{},'FORMAT':{}}
+    if header is None:
+        return definitions
+    for kind,keys in definitions.items():
+        for value in header.meta(kind):
+            #the Description is quoted and can hold commas
+            attributes = dict(re.findall(r'(?:^|,)(\w+)=("(?:[^"\\]|\\.)*"|[^,]*)',value.strip().lstrip('<').rstrip('>')))
+            if 'ID' in attributes:
+                keys[attributes['ID']] = (attributes.get('Number','.'),attributes.get('Type','String'))
+    return definitions
+
+
+class SparseColumn:
+
+    '''
+        The typed values of an INFO key, or of a FORMAT key of a sample, kept only for the rows having the key.
+        The values are a matrix with one row per row having the key and one column per comma separated value:
+        float64 for Integer and Float keys (NaN for the missing '.' values), strings for the other keys (None for the
+        missing values) and no column for flags.
+        The string values read from a snapshot are kept as their codes in a dictionary and decoded by take.
+    '''
+
+    def __init__(self,type,labels,values,dictionary=None):
+        '''
+            Parameters:
+            type,str: the Type of the header definition of the key
+            labels,ndarray: the sorted labels of the rows having the key
+            values,ndarray: the values of these rows
+            dictionary,StringDictionary: optional, the strings the values are the codes of (-1 for missing values), see snapshot.read_parsed
+        '''
+        self.type=type
+        self.labels=labels
+        self.values=values
+        self.dictionary=dictionary
+
+    def take(self,labels):
+        '''
+            Parameters:
+            labels,ndarray: labels of rows of the dataset
+
+            Return:
+            present,ndarray: True for the rows having the key
+            values,ndarray: the values of every row, only missing values for the rows not having the key
+        '''
+        labels = np.asarray(labels,dtype=np.int64)
+        at = np.searchsorted(self.labels,labels)
+        present = np.zeros(len(labels),dtype=bool)
+        if len(self.labels) > 0:
+            at = np.minimum(at,len(self.labels)-1)
+            present = self.labels[at] == labels
+        if self.dictionary is not None:
+            codes = np.full((len(labels),self.values.shape[1]),-1,dtype=self.values.dtype)
+            codes[present] = self.values[at[present]]
+            return present,self.dictionary.decode(codes)
+        values = np.full((len(labels),self.values.shape[1]),np.nan if self.values.dtype.kind == 'f' else None,dtype=self.values.dtype)
+        values[present] = self.values[at[present]]
+        return present,values
+
+
+def _typed_matrix(type,values):
+    '''
+        Converts the raw values of a key into the matrix of a SparseColumn.
+
+        Parameters:
+        type,str: the Type of the key
+        values,list: the raw value of every row having the key, None for flags
+
+        Return:
+        ndarray: the matrix, see SparseColumn
+    '''
+    if type == 'Flag':
+        return np.empty((len(values),0),dtype=np.float64)
+    items = [value.split(',') for value in values]
+    lengths = np.fromiter((len(item) for item in items),dtype=np.int64,count=len(items))
+    flat = pd.Series([x for item in items for x in item],dtype=object)
+    if type in NUMERIC_TYPES:
+        flat,missing = pd.to_numeric(flat,errors='coerce').values.astype(np.float64),np.nan
+    else:
+        flat,missing = flat.where(flat != '.',None).values,None
+    matrix = np.full((len(items),int(lengths.max()) if len(items) else 1),missing,dtype=flat.dtype)
+    rows = np.repeat(np.arange(len(items)),lengths)
+    matrix[rows,np.arange(len(flat))-np.repeat(np.cumsum(lengths)-lengths,lengths)] = flat
+    return matrix
+
+
+def _sparse_columns(labels,codes,items,definitions,column,keys):
+    '''
+        Builds the SparseColumn of every defined key of distinct values parsed once each.
+
+        Parameters:
+        labels,ndarray: the labels of the rows
+        codes,ndarray: the code of the distinct value of every row, -1 for missing values
+        items,list: the (key,raw value) pairs of every distinct value
+        definitions,dict: the (Number,Type) of the keys, see field_definitions
+        column,str: the column the keys are read from, INFO or a sample column
+        keys,set: optional, only the (column,key) pairs to parse
+
+        Return:
+        dict: the SparseColumn of every (column,key) pair
+    '''
+    found={}
+    for code,pairs in enumerate(items):
+        for key,value in pairs:
+            if key in definitions and (keys is None or (column,key) in keys):
+                entry = found.setdefault(key,({},definitions[key][1]))
+                entry[0].setdefault(code,value)
+    columns={}
+    for key,(values,type) in found.items():
+        uniques = np.fromiter(values,dtype=np.int64,count=len(values))
+        #position of every distinct value among the ones having the key, -1 (and the trailing -1 of missing values) for the others
+        slots = np.full(len(items)+1,-1,dtype=np.int64)
+        slots[uniques] = np.arange(len(uniques))
+        rows = slots.take(codes)
+        having = np.flatnonzero(rows >= 0)
+        matrix = _typed_matrix(type,list(values.values()))
+        columns[(column,key)] = SparseColumn(type,labels[having],matrix[rows[having]])
+    return columns
+
+
+def parse_columns(df,header,keys=None):
+    '''
+        Parses the INFO column and the sample columns of a dataset into typed sparse columns (see SparseColumn),
+        following the ##INFO and ##FORMAT definitions of its header; keys without definition are not parsed.
+        Every distinct INFO value and every distinct FORMAT and sample value pair is parsed once.
+
+        Parameters:
+        df,DataFrame: the dataset, with increasing labels
+        header,VcfHeader: the header of the dataset, can be None
+        keys,set: optional, only the (column,key) pairs to parse, column being INFO or a sample column
+
+        Return:
+        dict: the SparseColumn of every (column,key) pair found in the dataset
+    '''
+    definitions = field_definitions(header)
+    labels = df.index.values.astype(np.int64)
+    columns={}
+    if 'INFO' in df.columns and definitions['INFO']:
+        codes,uniques = pd.factorize(df['INFO'].values)
+        items = [[item.partition('=')[::2] if '=' in item else (item,None) for item in value.split(';')] if isinstance(value,str) else [] for value in uniques]
+        columns.update(_sparse_columns(labels,codes,items,definitions['INFO'],'INFO',keys))
+    names = list(df.columns)
+    if 'FORMAT' not in names or not definitions['FORMAT']:
+        return columns
+    format_codes,formats = pd.factorize(df['FORMAT'].values)
+    for sample in names[names.index('FORMAT')+1:]:
+        if keys is not None and not any(column == sample for column,_ in keys):
+            continue
+        sample_codes,sample_values = pd.factorize(df[sample].values)
+        #the distinct (FORMAT,sample value) pairs, missing values of either column having no key
+        pairs = np.where((format_codes < 0) | (sample_codes < 0),-1,format_codes.astype(np.int64)*(len(sample_values)+1)+sample_codes)
+        codes,uniques = pd.factorize(pairs)
+        items=[]
+        for pair in uniques:
+            if pair < 0:
+                items.append([])
+                continue
+            format_keys,values = formats[pair//(len(sample_values)+1)],sample_values[pair%(len(sample_values)+1)]
+            items.append(list(zip(str(format_keys).split(':'),str(values).split(':'))))
+        codes = np.where(pairs < 0,-1,codes)
+        columns.update(_sparse_columns(labels,codes,items,definitions['FORMAT'],sample,keys))
+    return columns
+
+
+class IngestStats:
+
+    '''
+        The IngestStats class reports the progress of an ingestion.
+    '''
+
+    def __init__(self):
+        self.rows=0
+        self.start=time.perf_counter()
+        self.seconds=0.0
+
+    def update(self,rows):
+        '''
+            Parameters:
+            rows,int: the number of rows parsed since the last update
+        '''
+        self.rows+=rows
+        self.seconds=time.perf_counter()-self.start
+
+    @property
+    def rows_per_sec(self):
+        return self.rows/self.seconds if self.seconds > 0 else 0.0
+
+    def to_dict(self):
+        return {'rows':self.rows,'seconds':round(self.seconds,3),'rows_per_sec':round(self.rows_per_sec,1)}
+
+
+def ingest(path,chunksize=100000,progress=None):
+    '''
+        Streams a (possibly compressed) vcf file into a typed DataFrame (see to_columnar) chunk by chunk.
+
+        Parameters:
+        path,str: the path of the vcf file
+        chunksize,int: the number of rows parsed at once
+        progress,function: optional, called with the IngestStats after every chunk
+
+        Return:
+        df,DataFrame: the dataset
+        header,VcfHeader: the header of the file, '##' metadata included
+        stats,IngestStats: the number of rows and the ingestion speed
+    '''
+    stats=IngestStats()
+    with open_vcf(path) as f:
+        header=read_header(f)
+        chunks=[]
+        for chunk in iter_chunks(f,header,chunksize):
+            chunks.append(to_columnar(chunk))
+            stats.update(chunk.shape[0])
+            if progress is not None:
+                progress(stats)
+    df = concat_columnar(chunks) if chunks else to_columnar(pd.DataFrame({col:pd.Series(dtype=object) for col in header.columns}))
+    stats.update(0)
+    logger.info('ingested %d rows from %s in %.2fs (%.0f rows/sec)',stats.rows,path,stats.seconds,stats.rows_per_sec)
+    return df,header,stats
+
+
+if __name__ == '__main__':
+    #usage: python vcf.py <file.vcf[.gz]> [--memory], prints the ingestion speed and optionally the memory report
+    df,header,stats = ingest(sys.argv[1],progress=lambda stats: print('%d rows, %.0f rows/sec'%(stats.rows,stats.rows_per_sec),file=sys.stderr))
+    print(stats.to_dict())
+    if '--memory' in sys.argv:
+        print(json.dumps(memory_report(df),indent=2))
@@ -0,0 +1,186 @@
+import collections
+import functools
+import numpy as np
+import pandas as pd
+from dict2xml import dict2xml
+from dict2xml.logic import Node
+from vcf import to_records
+
+
+INDENT='  ' #indentation of every nesting level, the one of dict2xml
+
+
+@functools.lru_cache(maxsize=4096)
+def _sanitized(name):
+    return Node.sanitize_element(name)
+
+
+def _tag(key):
+    '''
+        Return:
+        the tag of a dictionary key, sanitized like dict2xml does (only string keys are)
+    '''
+    return _sanitized(key) if isinstance(key,str) else key
+
+
+def _escape(value):
+    return value.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
+
+
+def _text(value):
+    '''
+        Return:
+        str: the text of a value, as rendered by dict2xml
+    '''
+    return _escape(value) if isinstance(value,str) else str(value)
+
+
+def _flat(value):
+    '''
+        Return:
+        str: the text of a value, as rendered by dict2xml once converted by to_records (missing values become None)
+    '''
+    if isinstance(value,str):
+        return _escape(value)
+    if value is None or value is pd.NA or value is pd.NaT or (isinstance(value,float) and value != value):
+        return 'None'
+    return str(value)
+
+
+def _column_text(column):
+    '''
+        Renders every value of a column at once, categories being rendered once.
+
+        Parameters:
+        column,Series: the column
+
+        Return:
+        list: the text of every value
+    '''
+    dtype = column.dtype
+    if isinstance(dtype,pd.CategoricalDtype):
+        categories = np.array([_flat(value) for value in column.cat.categories.astype(object)]+['None'],dtype=object)
+        return categories.take(column.cat.codes.values).tolist() #code -1 (missing value) takes the last element
+    if isinstance(dtype,np.dtype) and dtype.kind in 'iub':
+        return [str(value) for value in column.values.tolist()]
+    if isinstance(dtype,np.dtype) and dtype.kind == 'f':
+        return ['None' if value != value else str(value) for value in column.values.tolist()]
+    return [_flat(value) for value in column.astype(object).values]
+
+
+def frame_xml(df,depth=0):
+    '''
+        Renders the rows of a dataset like dict2xml renders to_records(df), reading the values column by column:
+        one element per row named after its label (rows sorted by label, the row labelled 0 not being wrapped)
+        holding one element per column (sorted by name).
+
+        Parameters:
+        df,DataFrame: the rows, with unique labels
+        depth,int: the nesting level of the row elements
+
+        Return:
+        str: the lines of the rows, without a trailing newline
+    '''
+    if not all(isinstance(column,str) and column for column in df.columns) or not df.index.is_unique:
+        return _indented(dict2xml(to_records(df)),depth)
+    labels = df.index.tolist()
+    order = np.argsort(df.index.values,kind='stable') if df.index.dtype.kind in 'iuf' else sorted(range(len(labels)),key=labels.__getitem__)
+    columns = sorted(df.columns)
+    outer,inner = INDENT*depth,INDENT*(depth+1)
+    texts=[]
+    for column in columns:
+        text = _column_text(df[column])
+        multiline = any('\n' in value for value in text)
+        #the lines following the first one of a multiline value are indented like the element, as dict2xml does
+        texts.append((_tag(column),text,[value.replace('\n','\n'+inner) for value in text] if multiline else text))
+    lines=[]
+    for i in order:
+        tag = _tag(labels[i])
+        if not tag:
+            #dict2xml drops the wrapper of falsy keys, e.g. the label 0, whose columns are then not nested
+            lines.extend(_indented('<%s>%s</%s>'%(column,text[i],column),depth) for column,text,_ in texts)
+            continue
+        lines.append('%s<%s>'%(outer,tag))
+        lines.extend('%s<%s>%s</%s>'%(inner,column,text[i],column) for column,_,text in texts)
+        lines.append('%s</%s>'%(outer,tag))
+    return '\n'.join(lines)
+
+
+def _indented(text,depth):
+    return INDENT*depth+text.replace('\n','\n'+INDENT*depth) if depth else text
+
+
+def _is_flat(value):
+    return isinstance(value,str) or not isinstance(value,(collections.abc.Mapping,collections.abc.Iterable))
+
+
+def _node(lines,key,value,depth):
+    '''
+        Appends the lines of a dictionary entry, rendered like dict2xml does.
+
+        Parameters:
+        lines,list: the lines of the document
+        key: the key of the entry
+        value: the value of the entry; a DataFrame is rendered like its to_records dictionary, see frame_xml
+        depth,int: the nesting level of the entry
+    '''
+    tag = _tag(key)
+    indent = INDENT*depth
+    if isinstance(value,pd.DataFrame):
+        if value.shape[0] == 0:
+            lines.append('%s<%s></%s>'%(indent,tag,tag) if tag else indent)
+        elif tag:
+            lines.append('%s<%s>'%(indent,tag))
+            lines.append(frame_xml(value,depth+1))
+            lines.append('%s</%s>'%(indent,tag))
+        else:
+            lines.append(frame_xml(value,depth))
+    elif isinstance(value,collections.abc.Mapping):
+        if not value:
+            lines.append('%s<%s></%s>'%(indent,tag,tag) if tag else indent)
+            return
+        keys = value if isinstance(value,collections.OrderedDict) else sorted(value)
+        if tag:
+            lines.append('%s<%s>'%(indent,tag))
+        for child in keys:
+            _node(lines,child,value[child],depth+1 if tag else depth)
+        if tag:
+            lines.append('%s</%s>'%(indent,tag))
+    elif isinstance(value,(list,tuple)) and tag and all(_is_flat(item) or isinstance(item,collections.abc.Mapping) for item in value):
+        if not value:
+            lines.append('%s<%s></%s>'%(indent,tag,tag))
+        for item in value:
+            if isinstance(item,collections.abc.Mapping):
+                lines.append('%s<%s>'%(indent,tag))
+                if not item:
+                    lines.append(indent+INDENT)
+                for child in (item if isinstance(item,collections.OrderedDict) else sorted(item)):
+                    _node(lines,child,item[child],depth+1)
+                lines.append('%s</%s>'%(indent,tag))
+            else:
+                lines.append(_indented('<%s>%s</%s>'%(tag,_text(item),tag),depth))
+    elif _is_flat(value):
+        lines.append(_indented('<%s>%s</%s>'%(tag,_text(value),tag) if tag else _text(value),depth))
+    else:
+        #other iterables are rare enough to be left to dict2xml
+        lines.append(_indented(dict2xml({key:value}),depth))
+
+
+def to_xml(data):
+    '''
+        Renders a response body as xml, byte for byte like dict2xml(data) but without building a node per value.
+        DataFrame values are rendered like their to_records dictionary, straight from their columns (see frame_xml),
+        so that pages of entries do not need to be converted to dictionaries first.
+
+        Parameters:
+        data,dict: the response body
+
+        Return:
+        str: the xml document
+    '''
+    if not isinstance(data,collections.abc.Mapping):
+        return dict2xml(data)
+    lines=[]
+    for key in (data if isinstance(data,collections.OrderedDict) else sorted(data)):
+        _node(lines,key,data[key],0)
+    return '\n'.join(lines)